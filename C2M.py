@@ -3,7 +3,12 @@ This file contains necessary functions for detecting the chessboard and finding
 """
 
 import cv2
+import os
 import string
+import hashlib
+import time
+import threading
+from collections import deque
 import numpy as np
 from math import pi
 from PIL import Image, ImageTk
@@ -17,17 +22,139 @@ img_resolution = (400, 400)  # Resolution of the images to be used
 num_of_squares = 8  # Number of squares in a row/column of the chessboard
 pixel_2_cm_ratio = 0  # Initialize the cm_to_pixel variable to store the conversion factor from cm to pixel
 camera_width_fov = 42  # Width field of view of the camera in degrees
+reference_corners_cache = {}  # Cache of the corners of the reference board images, keyed by (path, modification time, size)
+reference_corners_on_disk = True  # Whether to also cache the reference corners in a file next to the reference image
 
 
-def init_cam(cam_identification: int or str):
+class camera_stream:
+    """
+    Reads the camera continuously in a background thread into a small ring buffer of timestamped frames.
+
+    cv2.VideoCapture buffers frames, so reading it only when a picture is needed returns a stale frame.
+    Draining it all the time means the latest frame in the buffer is always fresh, and taking it doesn't block.
+    """
+
+    def __init__(self, cam: cv2.VideoCapture, buffer_size: int = 4):
+        """
+        Args:
+        -   cam (cv2.VideoCapture): The opened camera object.
+        -   buffer_size (int): The number of frames kept in the ring buffer.
+        """
+
+        self.cam = cam  # The camera object
+
+        self.frames = deque(maxlen=buffer_size)  # The ring buffer of (frame number, timestamp, frame)
+
+        self.frame_times = deque(maxlen=30)  # The timestamps of the last frames, to measure the FPS
+
+        self.frame_count = 0  # The number of frames read from the camera
+
+        self.dropped_count = 0  # The number of failed reads from the camera
+
+        self.skipped_count = 0  # The number of frames replaced by newer ones before they were taken
+
+        self.last_taken = 0  # The number of the last frame taken from the buffer
+
+        self.new_frame = threading.Condition()  # Notified on every new frame, and guards the counters
+
+        self.running = True  # Set to False to stop the capture thread
+
+        self.thread = threading.Thread(target=self.capture, daemon=True)
+
+        self.thread.start()  # Start reading the camera
+
+    def capture(self):
+        """
+        Reads the camera until the stream is stopped, runs in the capture thread.
+        """
+
+        while self.running:
+            result, img = self.cam.read()
+
+            timestamp = time.monotonic()
+
+            with self.new_frame:
+                if not result:
+                    self.dropped_count += 1
+                else:
+                    self.frame_count += 1
+                    self.frames.append((self.frame_count, timestamp, img))
+                    self.frame_times.append(timestamp)
+                    self.new_frame.notify_all()
+
+            if not result:
+                time.sleep(0.01)  # Don't spin if the camera stopped sending frames
+
+    def read(self, newer_than: float = 0.0, timeout: float = 1.0):
+        """
+        Takes the latest frame from the buffer.
+
+        Args:
+        -   newer_than (float): Only return a frame taken after this monotonic time, e.g. time.monotonic() for a frame taken after the call.
+        -   timeout (float): The longest time to wait for a frame in seconds.
+
+        Returns:
+        -   tuple: The timestamp and the frame, or (None, None) if no frame arrived in time.
+        """
+
+        with self.new_frame:
+            got_frame = self.new_frame.wait_for(
+                lambda: len(self.frames) > 0 and self.frames[-1][1] > newer_than,
+                timeout,
+            )
+
+            if not got_frame:
+                return (None, None)
+
+            number, timestamp, img = self.frames[-1]
+
+            if number > self.last_taken:
+                self.skipped_count += number - self.last_taken - 1  # Frames nobody took
+                self.last_taken = number
+
+        return (timestamp, img)
+
+    def get_stats(self):
+        """
+        Returns the statistics of the stream.
+
+        Returns:
+        -   dict: The achieved FPS, the number of frames read, dropped (failed reads) and skipped (never taken).
+        """
+
+        with self.new_frame:
+            if len(self.frame_times) > 1:
+                fps = (len(self.frame_times) - 1) / (self.frame_times[-1] - self.frame_times[0])
+            else:
+                fps = 0.0
+
+            return {
+                "fps": round(fps, 2),
+                "frames": self.frame_count,
+                "dropped": self.dropped_count,
+                "skipped": self.skipped_count,
+            }
+
+    def release(self):
+        """
+        Stops the capture thread and releases the camera.
+        """
+
+        self.running = False
+        self.thread.join(timeout=1.0)
+        self.cam.release()
+
+
+def init_cam(cam_identification: int or str, stream: bool = True):
     """
     Initializes the camera.
 
     Args:
     -   cam_identification (int or str): The camera identification number or the IP address of the camera.
+    -   stream (bool): Whether to read the camera continuously in a background thread. Defaults to True.
 
     Returns:
-    -   cv2.VideoCapture: The camera object, or None if the camera could not be initialized.
+    -   camera_stream or cv2.VideoCapture: The camera object, or None if the camera could not be initialized.
     """
 
     # If the camera identification is a string, it is the IP address of the camera
@@ -40,9 +167,27 @@ def init_cam(cam_identification: int or str):
     if not cam.isOpened():
         return None  # Return None if the camera could not be initialized
 
+    if stream:
+        return camera_stream(cam)  # Return the camera stream
+
     return cam  # Return the camera object
 
 
+def release_cam(cam: camera_stream or cv2.VideoCapture):
+    """
+    Releases the camera, stopping its stream if it has one.
+
+    Args:
+    -   cam (camera_stream or cv2.VideoCapture): The camera object.
+
+    Returns:
+    -   None
+    """
+
+    if cam is not None:
+        cam.release()
+
+
 def show_img(img: np.ndarray, window_name: str, image_resolution: tuple):
     """
     Display an image in a named window.
@@ -63,12 +208,13 @@ def show_img(img: np.ndarray, window_name: str, image_resolution: tuple):
     cv2.waitKey(0)  # Wait for a key press
 
 
-def grab_img(cam: cv2.VideoCapture):
+def grab_img(cam: camera_stream or cv2.VideoCapture):
     """
     Takes a picture using the camera, then returns it as a numpy array.
+    With a camera stream the latest frame is returned without waiting for the camera.
 
     Args:
-    -   cam (cv2.VideoCapture): The camera object.
+    -   cam (camera_stream or cv2.VideoCapture): The camera object.
 
     Returns:
     -   img (numpy.ndarray): The image as a numpy array, or None if the image could not be taken.
@@ -78,7 +224,11 @@ def grab_img(cam: cv2.VideoCapture):
     global pixel_2_cm_ratio  # Make the cm_to_pixel variable global
 
     # Take picture
-    result, img = cam.read()
+    if isinstance(cam, camera_stream):
+        _, img = cam.read()
+        result = img is not None
+    else:
+        result, img = cam.read()
 
     # If the picture could not be taken, return None
     if not result:
@@ -121,20 +271,17 @@ def read_img(path: str):
     return img
 
 
-def get_homography_matrix(img: np.ndarray, motherboard_path: str):
+def find_board_corners(img: np.ndarray):
     """
-    Finds the homography matrix between the current image of the board and the reference board image
+    Finds the inner corners of the chessboard in an image of the full board.
 
     Args :
-    -   img (ndarray) : The current image of the full chess board in BGR color format
-    -   motherboard_path (str) : The path to the reference board image
+    -   img (ndarray) : The image of the full chess board in BGR color format
 
     Returns :
-    -   homography_matrix (ndarray) : Homography matrix between the two images or None if the corners were not found in either image
+    -   corners (ndarray) : The corners found by cv2.findChessboardCorners or None if they were not found
     """
 
-    motherboard = read_img(motherboard_path)  # Get the reference board image
-
     lower_HSV = np.array([0, 0, 143])  # Lower HSV values for the image masks
     upper_HSV = np.array([179, 61, 252])  # Upper HSV values for the image masks
 
@@ -145,13 +292,6 @@ def get_homography_matrix(img: np.ndarray, motherboard_path: str):
         HSV_img, lower_HSV, upper_HSV
     )  # Create a mask for the board's image using the HSV values
 
-    HSV_motherboard = cv2.cvtColor(
-        motherboard, cv2.COLOR_BGR2HSV  # type: ignore
-    )  # Convert the reference board image to HSV format
-    motherboard_mask = cv2.inRange(
-        HSV_motherboard, lower_HSV, upper_HSV
-    )  # Create a mask for the reference board image using the HSV values
-
     img_kernel = cv2.getStructuringElement(
         cv2.MORPH_RECT, (50, 30)
     )  # Kernel for the board's image mask
@@ -164,21 +304,8 @@ def get_homography_matrix(img: np.ndarray, motherboard_path: str):
         dilated_img_kernel, img_mask
     )  # type: ignore # Get the board's image mask without the background
 
-    motherboard_kernel = cv2.getStructuringElement(
-        cv2.MORPH_RECT, (50, 30)
-    )  # Kernel for the mask of the reference board image
-
-    dilated_motherboard_kernel = cv2.dilate(
-        motherboard_mask, motherboard_kernel, iterations=5
-    )  # Dilate the mask of the reference board image to get the full board
-
-    result_motherboard = 255 - cv2.bitwise_and(
-        dilated_motherboard_kernel, motherboard_mask
-    )  # type: ignore # Get the mask of the reference board image without the background
-
-    # Convert the images to uint8 format
+    # Convert the image to uint8 format
     result_img = np.uint8(result_img)
-    result_motherboard = np.uint8(result_motherboard)
 
     return_img, img_corners = cv2.findChessboardCorners(
         result_img,  # type: ignore
@@ -188,16 +315,91 @@ def get_homography_matrix(img: np.ndarray, motherboard_path: str):
         + cv2.CALIB_CB_NORMALIZE_IMAGE,
     )  # type: ignore # Find the corners of the chessboard in the image
 
-    return_motherboard, motherboard_corners = cv2.findChessboardCorners(  # type: ignore
-        result_motherboard,  # type: ignore
-        board_pattern_size,
-        flags=cv2.CALIB_CB_ADAPTIVE_THRESH
-        + cv2.CALIB_CB_FAST_CHECK
-        + cv2.CALIB_CB_NORMALIZE_IMAGE,
-    )  # Find the corners of the chessboard in the reference board image
+    if not return_img:
+        return None  # Return None if the corners were not found
+
+    return img_corners  # Return the corners
+
+
+def get_reference_corners(motherboard_path: str):
+    """
+    Returns the corners of the reference board image, only processing the image the first time.
+    The corners are cached in memory, and on disk next to the image keyed by the image's hash.
+
+    Args :
+    -   motherboard_path (str) : The path to the reference board image
+
+    Returns :
+    -   corners (ndarray) : The corners of the reference board image or None if they were not found
+    """
+
+    file_stat = os.stat(motherboard_path)
+    memory_key = (motherboard_path, file_stat.st_mtime, file_stat.st_size)
+
+    # Return the corners if they are cached in memory
+    if memory_key in reference_corners_cache:
+        return reference_corners_cache[memory_key]
+
+    with open(motherboard_path, "rb") as motherboard_file:
+        file_hash = hashlib.sha1(motherboard_file.read()).hexdigest()  # Hash of the reference image
+
+    cache_path = os.path.splitext(motherboard_path)[0] + ".corners.npz"  # The disk cache of the corners
+
+    corners = None
+
+    # Load the corners from the disk cache if it is for the same image
+    if reference_corners_on_disk and os.path.exists(cache_path):
+        try:
+            cache = np.load(cache_path)
+
+            if str(cache["hash"]) == file_hash:
+                corners = cache["corners"]
+        except (OSError, ValueError, KeyError):
+            corners = None  # Ignore a broken cache file
+
+    # Find the corners in the reference image if they weren't cached
+    if corners is None:
+        motherboard = cv2.imread(motherboard_path)  # Get the reference board image
+
+        if motherboard is None:
+            return None  # Return None if the image couldn't be read
+
+        corners = find_board_corners(motherboard)
+
+        if corners is None:
+            return None  # Return None without caching, so a fixed image is processed again
+
+        if reference_corners_on_disk:
+            try:
+                np.savez(cache_path, hash=file_hash, corners=corners)
+            except OSError:
+                pass  # Keep the corners in memory only if the folder isn't writable
+
+    reference_corners_cache[memory_key] = corners
+
+    return corners  # Return the corners
+
+
+def get_homography_matrix(img: np.ndarray, motherboard_path: str):
+    """
+    Finds the homography matrix between the current image of the board and the reference board image
+
+    Args :
+    -   img (ndarray) : The current image of the full chess board in BGR color format
+    -   motherboard_path (str) : The path to the reference board image
+
+    Returns :
+    -   homography_matrix (ndarray) : Homography matrix between the two images or None if the corners were not found in either image
+    """
+
+    img_corners = find_board_corners(img)  # Find the corners of the chessboard in the image
+
+    motherboard_corners = get_reference_corners(
+        motherboard_path
+    )  # Get the corners of the chessboard in the reference board image
 
     # Check if the corners were found in both images
-    if return_img and return_motherboard:
+    if img_corners is not None and motherboard_corners is not None:
         homography_matrix, _ = cv2.findHomography(
             img_corners, motherboard_corners, cv2.RANSAC, 5.0
         )  # Find the homography matrix between the two images using the corners
@@ -207,6 +409,230 @@ def get_homography_matrix(img: np.ndarray, motherboard_path: str):
         return [None]  # Return None if the corners were not found in either image
 
 
+class homography_tracker:
+    """
+    Keeps the homography matrix valid during the game, in case the camera or the board is bumped.
+
+    Points on the border of the board, around the squares where the pieces never stand, are tracked from frame to frame
+    with sparse optical flow, which is cheap enough for every frame. The inner corners are only used until the border is seeded,
+    or when it has too few features. The homography is only re-estimated when the reprojection error of the tracked points
+    exceeds a threshold, and every time that happens a drift event is recorded.
+    """
+
+    def __init__(
+        self,
+        img: np.ndarray,
+        motherboard_path: str,
+        error_threshold: float = 2.0,
+        min_tracked_ratio: float = 0.5,
+        border_width: float = 0.6,
+        max_points: int = 80,
+        min_points: int = 12,
+    ):
+        """
+        Args:
+        -   img (np.ndarray): The image of the empty board the homography is first estimated from.
+        -   motherboard_path (str): The path to the reference board image.
+        -   error_threshold (float): The median reprojection error in pixels of the reference image above which the board has drifted.
+        -   min_tracked_ratio (float): The fraction of points that must be tracked to re-estimate the homography from them.
+        -   border_width (float): The width of the tracked border around the squares, in squares.
+        -   max_points (int): The most points tracked on the border.
+        -   min_points (int): The fewest points tracked, the points are seeded again below it.
+        """
+
+        self.motherboard_path = motherboard_path  # Path to the reference board image
+
+        self.error_threshold = error_threshold  # Reprojection error threshold
+
+        self.min_tracked_ratio = min_tracked_ratio  # Fraction of points needed for tracking
+
+        self.border_width = border_width  # Width of the tracked border in squares
+
+        self.max_points = max_points  # Most points tracked
+
+        self.min_points = min_points  # Fewest points tracked before seeding again
+
+        self.reference_corners = get_reference_corners(
+            motherboard_path
+        )  # The corners of the reference board image
+
+        if self.reference_corners is not None:
+            self.reference_corners = self.reference_corners.reshape(-1, 1, 2).astype(
+                np.float32
+            )  # One point per row, as used by the optical flow
+
+        self.homography_matrix = None  # The current homography matrix
+
+        self.corners = None  # The inner corners found by the last detection
+
+        self.points = None  # The tracked points in the last frame
+
+        self.point_references = None  # Where the tracked points are in the reference image
+
+        self.prev_gray = None  # The last frame in grayscale
+
+        self.reprojection_error = 0.0  # The reprojection error of the last frame
+
+        self.drift_events = []  # Every time the board drifted: its time, reprojection error and what was done
+
+        self.detect(img)  # Estimate the homography from the first image
+
+    def detect(self, img: np.ndarray):
+        """
+        Estimates the homography from scratch by finding the corners of the board in the image.
+        The current homography is kept if the corners aren't found or don't give a homography.
+
+        Args:
+        -   img (np.ndarray): The image of the board in BGR color format.
+
+        Returns:
+        -   bool: True if the homography was estimated.
+        """
+
+        self.prev_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+        corners = find_board_corners(img)
+
+        if corners is None or self.reference_corners is None:
+            return False
+
+        homography_matrix, _ = cv2.findHomography(
+            corners, self.reference_corners, cv2.RANSAC, 5.0
+        )
+
+        if homography_matrix is None:
+            return False  # Degenerate corners, keep the current homography
+
+        self.homography_matrix = homography_matrix
+
+        self.corners = corners.reshape(-1, 1, 2).astype(np.float32)
+
+        self.seed_points(self.prev_gray)
+
+        return True
+
+    def seed_points(self, gray: np.ndarray):
+        """
+        Chooses the points to track: features on the border of the board around the squares,
+        or the inner corners if the border has too few features.
+
+        Args:
+        -   gray (np.ndarray): The current frame in grayscale.
+
+        Returns:
+        -   None
+        """
+
+        # The squares span 8 squares and the inner corners 6, scale the corners around their center to get the outlines
+        center = self.reference_corners.mean(axis=0)  # type: ignore
+        corner_hull = cv2.convexHull(self.reference_corners) - center  # type: ignore
+        inverse_homography = np.linalg.inv(self.homography_matrix)  # type: ignore
+
+        squares_outline = cv2.perspectiveTransform(
+            corner_hull * (8 / 6) + center, inverse_homography
+        )
+        border_outline = cv2.perspectiveTransform(
+            corner_hull * ((8 + 2 * self.border_width) / 6) + center, inverse_homography
+        )
+
+        # Only the border, the squares are covered by the pieces
+        mask = np.zeros(gray.shape, np.uint8)
+        cv2.fillConvexPoly(mask, border_outline.astype(np.int32), 255)
+        cv2.fillConvexPoly(mask, squares_outline.astype(np.int32), 0)
+
+        points = cv2.goodFeaturesToTrack(
+            gray, self.max_points, qualityLevel=0.01, minDistance=8, mask=mask
+        )
+
+        if points is None or len(points) < self.min_points:
+            points = self.corners  # Fall back to the inner corners
+
+        self.points = points.reshape(-1, 1, 2).astype(np.float32)  # type: ignore
+
+        self.point_references = cv2.perspectiveTransform(
+            self.points, self.homography_matrix  # type: ignore
+        )  # The points in the reference image, they stay there as long as the board doesn't move
+
+    def update(self, img: np.ndarray):
+        """
+        Tracks the board in a new frame, re-estimating the homography only if the board drifted.
+        It is meant to be called on every frame of the camera stream.
+
+        Args:
+        -   img (np.ndarray): The new image of the board in BGR color format.
+
+        Returns:
+        -   np.ndarray: The homography matrix, or None if the board was never found.
+        """
+
+        # Without points to track, try to find the board from scratch
+        if self.points is None or self.homography_matrix is None:
+            self.detect(img)
+            return self.homography_matrix
+
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+        # Track the points from the last frame
+        new_points, status, _ = cv2.calcOpticalFlowPyrLK(
+            self.prev_gray, gray, self.points, None, winSize=(21, 21), maxLevel=3  # type: ignore
+        )
+
+        self.prev_gray = gray
+
+        tracked = status.ravel() == 1  # The points that were tracked
+
+        # Measure how far the tracked points land from their reference points with the current homography,
+        # the median ignores the few points a hand passing over the border drags along
+        if tracked.mean() >= self.min_tracked_ratio:
+            projected_points = cv2.perspectiveTransform(
+                new_points[tracked], self.homography_matrix
+            )
+            self.reprojection_error = float(
+                np.median(
+                    np.linalg.norm(
+                        projected_points - self.point_references[tracked], axis=2  # type: ignore
+                    )
+                )
+            )
+        else:
+            self.reprojection_error = float("inf")  # Too many points were lost
+
+        if self.reprojection_error <= self.error_threshold:
+            # The board didn't move, keep tracking the points that were found
+            self.points = new_points[tracked]
+            self.point_references = self.point_references[tracked]  # type: ignore
+
+            if len(self.points) < self.min_points:
+                self.seed_points(gray)
+
+            return self.homography_matrix
+
+        # The board drifted, re-estimate the homography
+        action = "lost"  # Keep the last homography until the board is found again
+
+        if self.detect(img):
+            action = "detected"
+        elif tracked.mean() >= self.min_tracked_ratio:
+            homography_matrix, _ = cv2.findHomography(
+                new_points[tracked], self.point_references[tracked], cv2.RANSAC, 5.0  # type: ignore
+            )
+
+            if homography_matrix is not None:
+                self.homography_matrix = homography_matrix
+                self.seed_points(gray)
+                action = "tracked"
+
+        self.drift_events.append(
+            {
+                "time": time.monotonic(),
+                "error": self.reprojection_error,
+                "action": action,
+            }
+        )  # Record the drift event
+
+        return self.homography_matrix
+
+
 def modify_homography_matrix(homography_matrix: np.ndarray):
     """
     Modifies the homography matrix to make fix the rotation of the warped image.
@@ -238,16 +664,16 @@ def modify_homography_matrix(homography_matrix: np.ndarray):
     return modified_homography_matrix  # Return the modified homography matrix
 
 
-def warp_img(img: np.ndarray, homography_matrix: np.ndarray):
+def get_warp_matrix(homography_matrix: np.ndarray, resolution: tuple = img_resolution):
     """
-    Warps an image using a given homography matrix.
+    Returns the matrix that warps an image to a top-down view of the board at the given resolution.
 
     Args:
-        img (np.ndarray): The input image to be warped.
         homography_matrix (np.ndarray): The homography matrix used for warping.
+        resolution (tuple): The resolution of the warped image. Defaults to img_resolution.
 
     Returns:
-        tuple: A tuple containing the warped image and a boolean indicating whether the image was flipped.
+        tuple: A tuple containing the warp matrix and a boolean indicating whether the image will be flipped.
     """
 
     flip = False  # Initialize the flip variable to False which indicates whether the image needs to be flipped or not
@@ -261,103 +687,272 @@ def warp_img(img: np.ndarray, homography_matrix: np.ndarray):
         homography_matrix = np.multiply(homography_matrix, -1)
         flip = True  # Set the flip variable to True
 
-    warped_img = cv2.warpPerspective(img, homography_matrix, img_resolution)
+    # Scale the output of the homography matrix to the resolution
+    if tuple(resolution) != tuple(img_resolution):
+        scale_matrix = np.diag(
+            [resolution[0] / img_resolution[0], resolution[1] / img_resolution[1], 1.0]
+        )
+        homography_matrix = scale_matrix @ homography_matrix
+
+    return (homography_matrix, flip)  # Return the warp matrix and the flip variable
+
+
+def warp_img(
+    img: np.ndarray,
+    homography_matrix: np.ndarray,
+    resolution: tuple = img_resolution,
+):
+    """
+    Warps an image using a given homography matrix.
+
+    Args:
+        img (np.ndarray): The input image to be warped.
+        homography_matrix (np.ndarray): The homography matrix used for warping.
+        resolution (tuple): The resolution of the warped image. Defaults to img_resolution.
+
+    Returns:
+        tuple: A tuple containing the warped image and a boolean indicating whether the image was flipped.
+    """
+
+    # Get the warp matrix at the resolution
+    warp_matrix, flip = get_warp_matrix(homography_matrix, resolution)
+
+    warped_img = cv2.warpPerspective(img, warp_matrix, tuple(resolution))
 
     return (warped_img, flip)  # Return the warped image and the flip variable
 
 
-def find_moves(prev_img: np.ndarray, cur_img: np.ndarray):
+def find_square_scores(prev_img: np.ndarray, cur_img: np.ndarray):
     """
-    Finds the moves made on a chessboard based on the difference between two images.
+    Finds how much every square of the chessboard changed between two images.
 
     Args:
     -   prev_img (np.ndarray): The previous image of the chessboard.
     -   cur_img (np.ndarray): The current image of the chessboard.
 
     Returns:
-    -   tuple: A tuple containing the moves list and the confidence rate list, or None if no moves were found.
+    -   np.ndarray: An 8x8 heatmap of the change of every square, indexed by [rank, file] (a1 is [0, 0]).
     """
 
-    max_num_of_moves = 4  # Maximum number of moves to be returned
     square_size = int(
         img_resolution[0] / num_of_squares
     )  # Size of each square in the chessboard
+    board_size = square_size * num_of_squares  # Size of the chessboard in pixels
 
-    confidence_rate_list = [
-        0 for _ in range(max_num_of_moves)
-    ]  # Initialize the confidence rate list with zeros
+    # Calculate the difference between the two images once for the whole board
+    diff = cv2.absdiff(prev_img[:board_size, :board_size], cur_img[:board_size, :board_size])
 
-    moves_list = [
-        "0" for _ in range(max_num_of_moves)
-    ]  # Initialize the moves list with zeros
+    # Sum the difference of every square from the integral image of the difference, with the channels side by side
+    diff = diff.reshape(board_size, -1)
+    integral = cv2.integral(diff)[:: square_size, :: diff.shape[1] // num_of_squares]
+    blocks = np.diff(np.diff(integral, axis=0), axis=1)
 
-    # Iterate through the chessboard squares
-    for i in range(
-        0, num_of_squares * square_size, square_size
-    ):  # Iterate through rows
-        k = 0  # Initializing a counter for each row
-        for j in range(
-            0, num_of_squares * square_size, square_size
-        ):  # Iterate through columns
-            prev_img_square = prev_img[
-                i : i + square_size, j : j + square_size
-            ]  # Get the square from the previous image
-            cur_img_square = cur_img[
-                i : i + square_size, j : j + square_size
-            ]  # Get the square from the current image
-
-            # Calculate the square notation for the current square starting from the top left corner (h1, g1, f1, ..., a1, h2, g2, ..., a8)
-            square_notation = string.ascii_lowercase[num_of_squares - k - 1] + str(
-                int(i / square_size) + 1
-            )
+    # The rows of the image are the ranks (1 at the top), and its columns are the files (h on the left)
+    heatmap = blocks[:, ::-1] / (square_size * square_size)
 
-            # Calculate the difference between the two squares
-            diff = cv2.absdiff(prev_img_square, cur_img_square)
+    return heatmap  # Return the heatmap
 
-            # Calculate the confidence rate of the difference
-            confidence_rate = np.sum(diff) / (square_size * square_size)  # type: ignore
 
-            k += 1  # Incrementing the counter for x coordinates
+def find_moves(prev_img: np.ndarray, cur_img: np.ndarray, return_heatmap: bool = False):
+    """
+    Finds the moves made on a chessboard based on the difference between two images.
 
-            # Iterate through the moves list and save the sorted moves in terms of confidence rate
-            for z in range(0, max_num_of_moves):
-                # Check if the confidence rate is greater than the confidence rate in the list
-                if confidence_rate >= confidence_rate_list[z]:
-                    confidence_rate_list.insert(
-                        z, confidence_rate
-                    )  # Save the confidence rate
+    Args:
+    -   prev_img (np.ndarray): The previous image of the chessboard.
+    -   cur_img (np.ndarray): The current image of the chessboard.
+    -   return_heatmap (bool): Whether to also return the 8x8 heatmap of every square's change. Defaults to False.
 
-                    moves_list.insert(z, square_notation)  # Save the square notation
+    Returns:
+    -   tuple: A tuple containing the moves list and the confidence rate list, or None if no moves were found.
+            The heatmap from find_square_scores is added to the tuple if return_heatmap is True.
+    """
+
+    max_num_of_moves = 4  # Maximum number of moves to be returned
 
-                    confidence_rate_list.pop()  # Remove the last element in the list
-                    moves_list.pop()  # Remove the last element in the list
-                    break  # Break out of the loop
+    heatmap = find_square_scores(prev_img, cur_img)  # Get the change of every square
 
-    # Create a threshold for the confidence rate based on the maximum confidence rate
-    threshold = confidence_rate_list[0] * 0.3
+    # The scores in the order the image is scanned (h1, g1, ..., a1, h2, ..., a8)
+    scores = heatmap[:, ::-1].ravel()
 
-    # Iterate through the confidence rate list
-    for i in range(len(confidence_rate_list) - 1, -1, -1):
-        # Check if the confidence rate is less than the threshold
-        if confidence_rate_list[i] < threshold:
-            confidence_rate_list.pop(i)  # Remove the confidence rate from the list
-            moves_list.pop(i)  # Remove the move from the list
+    # Rank the squares by score, with the last scanned square first on ties, and keep the highest ones
+    top_squares = np.lexsort((-np.arange(scores.size), -scores))[:max_num_of_moves]
 
-    # Check if no moves were found
-    if confidence_rate_list == [0 for _ in range(max_num_of_moves)]:
-        return (None, None)  # Return None if no moves were found
+    confidence_rate_list = scores[top_squares]  # Get the confidence rates
+
+    if not confidence_rate_list.any():
+        # Return None if no moves were found
+        return (None, None, heatmap) if return_heatmap else (None, None)
+
+    # Keep the squares with a confidence rate of at least 30% of the maximum confidence rate
+    top_squares = top_squares[confidence_rate_list >= confidence_rate_list[0] * 0.3]
+
+    # Calculate the square notation of every square (h1, g1, f1, ..., a1, h2, g2, ..., a8)
+    moves_list = [
+        string.ascii_lowercase[num_of_squares - square % num_of_squares - 1]
+        + str(square // num_of_squares + 1)
+        for square in top_squares
+    ]
 
     # Round the confidence rates to two decimal places
     confidence_rate_list = [
-        round(confidence_rate, 2) for confidence_rate in confidence_rate_list  # type: ignore
+        round(float(confidence_rate), 2) for confidence_rate in scores[top_squares]
     ]
 
+    if return_heatmap:
+        return (moves_list, confidence_rate_list, heatmap)
+
     return (
         moves_list,
         confidence_rate_list,
     )  # Return the moves list and the confidence rate list
 
 
+class move_detector:
+    """
+    Watches the camera stream and finds when the player has made a move, so the turn doesn't have to be switched by hand.
+
+    Every frame is warped to a small top-down view of the board and the motion energy of every square is measured
+    against the previous frame. A hand entering the board starts a motion, and once the board has been still
+    for stable_time after the hand left, the board is compared to how it was before the motion.
+    If squares changed, a move is triggered.
+    """
+
+    def __init__(
+        self,
+        resolution: tuple = (128, 128),
+        motion_threshold: float = 12.0,
+        change_threshold: float = 10.0,
+        stable_time: float = 0.7,
+    ):
+        """
+        Args:
+        -   resolution (tuple): The resolution of the warped frames, a multiple of num_of_squares.
+        -   motion_threshold (float): The mean difference of a square between two frames above which it is moving.
+        -   change_threshold (float): The mean difference of a square before and after a motion above which it changed.
+        -   stable_time (float): The time in seconds the board must be still before a move is triggered.
+        """
+
+        self.resolution = resolution  # The resolution of the warped frames
+
+        self.motion_threshold = motion_threshold  # The motion threshold
+
+        self.change_threshold = change_threshold  # The change threshold
+
+        self.stable_time = stable_time  # The time the board must be still
+
+        self.state = "idle"  # "idle", "motion" while a hand is on the board, or "settling" after it left
+
+        self.still_since = 0.0  # The time the board stopped moving
+
+        self.motion_grid = np.zeros(
+            (num_of_squares, num_of_squares), np.uint8
+        )  # The motion energy of every square in the last frame, as the image rows and columns
+
+        self.change_grid = np.zeros(
+            (num_of_squares, num_of_squares), np.uint8
+        )  # The change of every square over the last motion, as the image rows and columns
+
+        self.events = []  # The (time, event) of every hand entering or leaving the board and every move
+
+        self.homography_matrix = None  # The homography matrix the warp matrix was made from
+
+        self.warp_matrix = None  # The warp matrix at the detector's resolution
+
+        # Buffers reused for every frame
+        self.warped = np.zeros((resolution[1], resolution[0], 3), np.uint8)
+        self.frame = np.zeros((resolution[1], resolution[0]), np.uint8)
+        self.prev_frame = np.zeros_like(self.frame)
+        self.stable_frame = np.zeros_like(self.frame)
+        self.diff = np.zeros_like(self.frame)
+
+        self.has_frame = False  # Whether a previous frame exists
+
+    def reset(self):
+        """
+        Forgets the previous frames, e.g. at the start of the player's turn, so the next frame is the new still board.
+        """
+
+        self.state = "idle"
+        self.has_frame = False
+
+    def update(self, img: np.ndarray, homography_matrix: np.ndarray, timestamp: float):
+        """
+        Processes a new camera frame.
+
+        Args:
+        -   img (np.ndarray): The camera frame in BGR color format.
+        -   homography_matrix (np.ndarray): The homography matrix of the board.
+        -   timestamp (float): The monotonic time the frame was taken.
+
+        Returns:
+        -   bool: True if a move was made and the board is still again.
+        """
+
+        # Only rebuild the warp matrix when the homography changes
+        if self.homography_matrix is None or not np.array_equal(
+            self.homography_matrix, homography_matrix
+        ):
+            self.homography_matrix = np.array(homography_matrix)
+            self.warp_matrix, _ = get_warp_matrix(homography_matrix, self.resolution)
+
+        # Warp the frame to a small top-down view, then convert it to grayscale
+        cv2.warpPerspective(img, self.warp_matrix, tuple(self.resolution), dst=self.warped)  # type: ignore
+        cv2.cvtColor(self.warped, cv2.COLOR_BGR2GRAY, dst=self.frame)
+
+        if not self.has_frame:
+            self.prev_frame[:] = self.frame
+            self.stable_frame[:] = self.frame
+            self.has_frame = True
+            return False
+
+        # Measure the motion of every square since the previous frame
+        cv2.absdiff(self.frame, self.prev_frame, dst=self.diff)
+        cv2.resize(
+            self.diff,
+            (num_of_squares, num_of_squares),
+            dst=self.motion_grid,
+            interpolation=cv2.INTER_AREA,
+        )
+
+        self.prev_frame, self.frame = self.frame, self.prev_frame  # Swap the buffers instead of copying
+
+        moving = self.motion_grid.max() > self.motion_threshold
+
+        if moving:
+            if self.state == "idle":
+                self.events.append((timestamp, "hand entered"))
+
+            self.state = "motion"
+            return False
+
+        if self.state == "motion":
+            self.events.append((timestamp, "hand left"))
+            self.state = "settling"
+            self.still_since = timestamp
+
+        if self.state != "settling" or timestamp - self.still_since < self.stable_time:
+            return False
+
+        # The board is still again, compare it to how it was before the motion
+        self.state = "idle"
+
+        cv2.absdiff(self.prev_frame, self.stable_frame, dst=self.diff)
+        cv2.resize(
+            self.diff,
+            (num_of_squares, num_of_squares),
+            dst=self.change_grid,
+            interpolation=cv2.INTER_AREA,
+        )
+
+        self.stable_frame[:] = self.prev_frame  # The still board is the new reference
+
+        if self.change_grid.max() > self.change_threshold:
+            self.events.append((timestamp, "move"))
+            return True
+
+        return False  # The hand left without moving a piece
+
+
 def cv2_to_tk(img: np.ndarray or str):
     """
     Convert an OpenCV image (BGR format) to a Tkinter PhotoImage object (RGB format).
@@ -7,37 +7,281 @@ from chess import (
     pgn,
     svg,
 )  # Importing the pgn and svg modules from chess
-from stockfish import (
-    Stockfish,
-)  # Importing the Stockfish module to use the Stockfish engine
+import chess.engine  # Importing the chess.engine module to talk to the Stockfish engine over UCI
 import cairosvg  # Importing the cairosvg module to convert svg to png
 import cv2  # Importing the cv2 module to display the chess board
 import numpy as np  # Importing the numpy module to convert png to numpy array
+import threading  # Importing the threading module to start the Stockfish engines in parallel
+import queue  # Importing the queue module to hand out the Stockfish engines of the pool
 from PIL import (
     Image,
     ImageTk,
 )  # Importing the Image and ImageTk modules to display the chess board
 from DRLCE.DRLCE import (
     get_best_move,  # type: ignore
+    load_model,  # type: ignore
 )  # Importing the get_DRLCE_move function from DRLCE.py to get the move from the DRLCE engine
 
+stockfish_options = {
+    "Threads": 1,  # The number of search threads of every engine
+    "Hash": 16,  # The size of the hash table of every engine in MB
+}  # The UCI options every Stockfish engine is started with, options the engine doesn't have are skipped (e.g. "Use NNUE", "EvalFile")
 
-def init_stockfish(stockfish_path_str: str):
+# The search settings of every difficulty level, the engine stops at whichever limit it reaches first
+# (depth in plies, movetime in seconds, nodes searched), and the number of lines the analysis returns
+difficulty_settings = {
+    1: {"depth": 5, "skill": 5, "movetime": 0.1, "nodes": 20000, "MultiPV": 1},
+    2: {"depth": 10, "skill": 10, "movetime": 0.3, "nodes": 200000, "MultiPV": 1},
+    3: {"depth": 15, "skill": 15, "movetime": 1.0, "nodes": 1000000, "MultiPV": 1},
+    4: {"depth": 20, "skill": 20, "movetime": 2.0, "nodes": 4000000, "MultiPV": 1},
+    5: {"depth": 5, "skill": 5, "movetime": 0.1, "nodes": 20000, "MultiPV": 1},  # DRLCE
+}
+
+min_move_confidence = 0.6  # The lowest confidence a recognized move is played with
+min_move_margin = 0.3  # The lowest lead in confidence the recognized move must have over the second most likely move
+min_move_contrast = 0.5  # The lowest difference between the normalized change of the move's squares and of the other squares
+
+board_img_size = 400  # The size of the board image displayed in the GUI in pixels
+
+board_svg_size = 390  # The size of the SVG drawn by chess.svg.board
+board_svg_margin = 15  # The size of the coordinates margin of the SVG
+board_svg_square = 45  # The size of a square of the SVG
+
+square_edges = np.round(
+    (board_svg_margin + board_svg_square * np.arange(9)) * board_img_size / board_svg_size
+).astype(int)  # The pixel edges of the files (left to right) and ranks (top to bottom) of the board image
+
+sprite_pieces = [
+    chess.Piece(piece_type, color)
+    for color in chess.COLORS
+    for piece_type in chess.PIECE_TYPES
+]  # The pieces of the board sprites, sprite 0 is the empty board
+
+board_sprites = None  # The pre-rendered board images, the empty board and every piece on all 64 squares
+
+board_frame = None  # The last board image, updated square by square
+
+board_frame_pieces = None  # The sprite of every square of the last board image
+
+
+class stockfish_engine:
+    """
+    A persistent UCI session with the Stockfish engine.
+
+    The engine process and its hash table are kept for the whole game, the position is sent as
+    the starting position followed by the moves played since, and after every move the engine
+    ponders on the reply it expects while the player is moving. If the player makes that move,
+    the search continues as a ponderhit and the answer is (almost) instant.
+    """
+
+    def __init__(
+        self, stockfish_path_str: str, ponder: bool = True, options: dict = None  # type: ignore
+    ):
+        """
+        Args:
+        -   stockfish_path_str (str): The path to the Stockfish engine.
+        -   ponder (bool): Whether the engine thinks on the player's time.
+        -   options (dict): UCI options overriding stockfish_options.
+        """
+
+        self.engine = chess.engine.SimpleEngine.popen_uci(
+            stockfish_path_str
+        )  # Starting the engine process and doing the UCI handshake
+
+        engine_options = dict(stockfish_options, **(options or {}))
+
+        self.engine.configure(
+            {
+                name: value
+                for name, value in engine_options.items()
+                if name in self.engine.options
+            }
+        )  # Setting the options the engine has
+
+        self.engine.ping()  # Waiting until the engine is ready
+
+        self.limit = chess.engine.Limit()  # The search limit of every move
+
+        self.multipv = 1  # The number of lines returned by the analysis
+
+        self.ponder = ponder  # Setting the ponder option
+
+        self.expected_board = None  # The position the engine is pondering on
+
+        self.moves = 0  # The number of moves searched
+
+        self.ponderhits = 0  # The number of moves where the player made the expected reply
+
+    def get_metrics(self):
+        """
+        Returns the pondering metrics of the engine.
+
+        Returns:
+        -   dict: The number of moves searched, the number of ponderhits and the ponderhit rate.
+        """
+
+        return {
+            "moves": self.moves,
+            "ponderhits": self.ponderhits,
+            "ponderhit_rate": self.ponderhits / max(self.moves, 1),
+        }
+
+
+class stockfish_pool:
+    """
+    A pool of Stockfish engines, so several games (or a game and an analysis) can be served at once.
+    The engines are started and handshaken in parallel background threads, so creating the pool doesn't block.
+    """
+
+    def __init__(
+        self,
+        stockfish_path_str: str,
+        size: int,
+        ponder: bool = True,
+        options: dict = None,  # type: ignore
+    ):
+        """
+        Args:
+        -   stockfish_path_str (str): The path to the Stockfish engine.
+        -   size (int): The number of engines in the pool.
+        -   ponder (bool): Whether the engines think on the player's time.
+        -   options (dict): UCI options overriding stockfish_options.
+        """
+
+        self.available = queue.Queue()  # The engines that are ready and not in use
+
+        self.engines = []  # All the engines that were started
+
+        self.errors = []  # The errors of the engines that couldn't be started
+
+        self.lock = threading.Lock()  # Guards engines and errors
+
+        self.threads = [
+            threading.Thread(
+                target=self.spawn,
+                args=(stockfish_path_str, ponder, options),
+                daemon=True,
+            )
+            for _ in range(size)
+        ]  # Creating a thread to start every engine
+
+        for thread in self.threads:
+            thread.start()
+
+    def spawn(self, stockfish_path_str: str, ponder: bool, options: dict):
+        """
+        Starts one engine, runs in a pool thread.
+        """
+
+        try:
+            stockfish = stockfish_engine(stockfish_path_str, ponder, options)
+        except Exception as e:
+            with self.lock:
+                self.errors.append(e)
+
+            self.available.put(None)  # Wake up a waiting acquire so it can raise the error
+            return
+
+        with self.lock:
+            self.engines.append(stockfish)
+
+        self.available.put(stockfish)
+
+    def acquire(self, timeout: float = None):  # type: ignore
+        """
+        Takes an engine from the pool, waiting until one is ready.
+
+        Args:
+        -   timeout (float): The longest time to wait in seconds, None to wait forever.
+
+        Returns:
+        -   stockfish_engine: The Stockfish engine object.
+        """
+
+        stockfish = self.available.get(timeout=timeout)
+
+        if stockfish is None:
+            with self.lock:
+                raise RuntimeError("Couldn't start the Stockfish engine") from self.errors[0]
+
+        return stockfish
+
+    def release(self, stockfish: stockfish_engine):
+        """
+        Returns an engine to the pool.
+
+        Args:
+        -   stockfish (stockfish_engine): The Stockfish engine object.
+        """
+
+        self.available.put(stockfish)
+
+    def close(self):
+        """
+        Stops all the engines of the pool.
+        """
+
+        for thread in self.threads:
+            thread.join()  # Wait for the engines that are still starting
+
+        for stockfish in self.engines:
+            close_stockfish(stockfish)
+
+        self.engines = []
+
+
+def init_stockfish(
+    stockfish_path_str: str, ponder: bool = True, options: dict = None  # type: ignore
+):
     """
     Initializes the Stockfish engine.
 
     Args:
     -   stockfish_path_str (str): The path to the Stockfish engine.
+    -   ponder (bool): Whether the engine thinks on the player's time.
+    -   options (dict): UCI options overriding stockfish_options.
 
     Returns:
-    -   Stockfish: The Stockfish engine object.
+    -   stockfish_engine: The Stockfish engine object.
     """
 
-    stockfish = Stockfish(stockfish_path_str)  # Initializing the Stockfish engine
+    stockfish = stockfish_engine(
+        stockfish_path_str, ponder, options
+    )  # Initializing the Stockfish engine
 
     return stockfish  # Returning the stockfish object
 
 
+def close_stockfish(stockfish: stockfish_engine):
+    """
+    Stops the Stockfish engine process.
+
+    Args:
+    -   stockfish (stockfish_engine): The Stockfish engine object.
+
+    Returns:
+    -   None
+    """
+
+    stockfish.engine.quit()  # Quitting the engine, this also stops pondering
+
+
+def init_DRLCE(DRLCE_weights_path: str):
+    """
+    Loads and warms up the DRLCE engine once, so later moves only run the search.
+
+    Args:
+    -   DRLCE_weights_path (str): The path to the DRLCE engine weights.
+
+    Returns:
+    -   DRLCEModel: The loaded DRLCE model, its load and warm-up times are available through get_metrics().
+    """
+
+    DRLCE_model = load_model(DRLCE_weights_path)  # Loading the model (cached after the first call)
+
+    return DRLCE_model  # Returning the DRLCE model object
+
+
 def init_board():
     """
     Initializes the chess board.
@@ -68,26 +312,31 @@ def set_board_from_fen(board: chess.Board, fen_str: str):
     return board  # Returning the edited board object
 
 
-def set_engine_difficulty(stockfish: Stockfish, difficulty_int: int):
+def set_engine_difficulty(stockfish: stockfish_engine, difficulty_int: int):
     """
     Sets the difficulty level of the Stockfish engine.
 
     Args:
-    -   stockfish (Stockfish): The Stockfish engine object.
+    -   stockfish (stockfish_engine): The Stockfish engine object.
     -   difficulty_int (int): The difficulty level as an integer.
 
     Returns:
     -   stockfish: The modified Stockfish engine object.
     """
 
-    if difficulty_int == 5:
-        difficulty_int = 1
+    settings = difficulty_settings[difficulty_int]
 
-    stockfish.set_depth(difficulty_int * 5)  # Setting the depth of the engine
-    stockfish.set_skill_level(
-        difficulty_int * 5
+    stockfish.limit = chess.engine.Limit(
+        depth=settings["depth"],
+        time=settings["movetime"],
+        nodes=settings["nodes"],
+    )  # Setting the depth, time and nodes limits of the engine
+    stockfish.engine.configure(
+        {"Skill Level": settings["skill"]}
     )  # Setting the skill level of the engine
 
+    stockfish.multipv = settings["MultiPV"]  # Setting the number of analysis lines
+
     return stockfish  # Returning the edited stockfish object
 
 
@@ -103,7 +352,7 @@ def check_move(board: chess.Board, move_str: str):
     -   bool: True if the move is valid, False otherwise.
     """
 
-    if len(move_str) != 4:  # Checking if the length of the move is 4
+    if len(move_str) not in (4, 5):  # Checking if the length of the move is 4 (or 5 for a promotion)
         return False
 
     move_uci = chess.Move.from_uci(move_str)  # Converting the move to UCI format
@@ -192,39 +441,95 @@ def set_board_from_pgn(board: chess.Board, pgn_path_str: str):
     return board  # Returning the edited board object
 
 
-def get_stockfish_move(stockfish: Stockfish, board: chess.Board):
+def get_stockfish_move(stockfish: stockfish_engine, board: chess.Board):
     """
     Gets the best move from the Stockfish engine.
+    If the engine was pondering on this position, the search continues as a ponderhit.
 
     Args:
-    -   stockfish (Stockfish): The Stockfish engine object.
+    -   stockfish (stockfish_engine): The Stockfish engine object.
     -   board (chess.Board): The current state of the chess board.
 
     Returns:
     -   str: The best move in UCI format.
     """
 
-    stockfish.set_fen_position(
-        board.fen()
-    )  # Setting the position of the stockfish engine
+    # Counting the moves where the player made the reply the engine was pondering on
+    if (
+        stockfish.expected_board is not None
+        and stockfish.expected_board.move_stack == board.move_stack
+        and stockfish.expected_board == board
+    ):
+        stockfish.ponderhits += 1
+
+    stockfish.moves += 1
+
+    # python-chess sends "position startpos moves ...", and a ponderhit instead of a new search
+    # when the position is the one the engine is pondering on
+    result = stockfish.engine.play(board, stockfish.limit, ponder=stockfish.ponder)
 
-    best_move = stockfish.get_best_move()  # Getting the best move from the engine
+    stockfish.expected_board = None
+
+    if stockfish.ponder and result.move is not None and result.ponder is not None:
+        stockfish.expected_board = board.copy()
+        stockfish.expected_board.push(result.move)
+        stockfish.expected_board.push(result.ponder)
+
+    best_move = result.move.uci()  # type: ignore # Getting the best move from the engine
 
     return best_move  # Returning the best move
 
 
-def get_DRLCE_move(DRLCE_weights_path: str, board: chess.Board):
+def get_stockfish_analysis(stockfish: stockfish_engine, board: chess.Board):
+    """
+    Analyses the position with the Stockfish engine, returning its MultiPV best lines.
+
+    Args:
+    -   stockfish (stockfish_engine): The Stockfish engine object.
+    -   board (chess.Board): The current state of the chess board.
+
+    Returns:
+    -   list: The (move in UCI format, score in centipawns from the side to move) of every line, best first.
+    """
+
+    stockfish.expected_board = None  # Analysing stops the pondering
+
+    infos = stockfish.engine.analyse(
+        board, stockfish.limit, multipv=stockfish.multipv
+    )  # Analysing the position
+
+    return [
+        (info["pv"][0].uci(), info["score"].relative.score(mate_score=100000))
+        for info in infos
+        if "pv" in info
+    ]  # Returning the first move and score of every line
+
+
+def get_DRLCE_move(
+    DRLCE_weights_path: str,
+    board: chess.Board,
+    time_left_ms: float = None,  # type: ignore
+    increment_ms: float = 0,
+    stop_event=None,
+):
     """
     Returns the best move from the DRLCE engine as a string.
 
     Parameters:
     -   DRLCE_weights_path (str): The path to the DRLCE engine weights.
     -   board (chess.Board): The current chess board state.
+    -   time_left_ms (float): The time left on the engine's clock in milliseconds, the search time is taken from it.
+    -   increment_ms (float): The increment added to the engine's clock after every move in milliseconds.
+    -   stop_event (threading.Event): When set from another thread, the search stops early and returns its best move so far.
 
     Returns:
     -   str: The best move from the DRLCE engine as a string.
     """
-    return str(get_best_move(DRLCE_weights_path, board))
+    return str(
+        get_best_move(
+            DRLCE_weights_path, board, time_left_ms, increment_ms, stop_event
+        )
+    )
 
 
 def check_indicators(board: chess.Board, move_str: str):
@@ -254,28 +559,106 @@ def check_indicators(board: chess.Board, move_str: str):
     return indicators  # Returning the edited indicators
 
 
-def get_board_img(board: chess.Board):
+def render_svg(svg_str: str):
     """
-    Displays the chess board.
+    Rasterizes an SVG image to the size of the board image.
 
     Args:
-    -   board (chess.Board): The chess board object to be displayed.
+    -   svg_str (str): The SVG image.
 
     Returns:
-    -   board_tk (np.ndarray): The tkinter image of the chess board.
+    -   np.ndarray: The image as a numpy array.
     """
 
-    # Convert the board to SVG
-    svg_board = svg.board(board=board)
-
     # Convert the SVG to PNG
-    png_bytes = cairosvg.svg2png(bytestring=svg_board)
+    png_bytes = cairosvg.svg2png(bytestring=svg_str)
 
     # Convert the PNG to a numpy array
     png_array = cv2.imdecode(np.frombuffer(png_bytes, np.uint8), cv2.IMREAD_UNCHANGED)  # type: ignore
 
-    # Resize the numpy array to 400x400
-    png_array = cv2.resize(png_array, (400, 400))
+    # Resize the numpy array to the board image size
+    png_array = cv2.resize(png_array, (board_img_size, board_img_size))
+
+    return png_array  # Returning the image
+
+
+def init_board_sprites():
+    """
+    Renders the board sprites once: the empty board, and for every piece a board with that piece on all 64 squares.
+    Board images are then put together square by square from these sprites, without rendering any SVG.
+
+    Returns:
+    -   None
+    """
+
+    global board_sprites, board_frame, board_frame_pieces
+
+    sprites = [render_svg(svg.board(chess.Board(None)))]  # The empty board
+
+    for piece in sprite_pieces:
+        sprite_board = chess.Board(None)
+
+        for square in chess.SQUARES:
+            sprite_board.set_piece_at(square, piece)
+
+        sprites.append(render_svg(svg.board(sprite_board)))
+
+    board_sprites = np.stack(sprites)
+
+    board_frame = board_sprites[0].copy()  # Start from the empty board
+    board_frame_pieces = np.zeros(64, np.uint8)
+
+
+def render_board(board: chess.Board):
+    """
+    Puts the board image together from the board sprites, only redrawing the squares that changed since the last call.
+
+    Args:
+    -   board (chess.Board): The chess board object to be displayed.
+
+    Returns:
+    -   np.ndarray: The board image as a numpy array.
+    """
+
+    global board_frame_pieces
+
+    if board_sprites is None:
+        init_board_sprites()
+
+    # Get the sprite of every square
+    pieces = np.zeros(64, np.uint8)
+
+    for square, piece in board.piece_map().items():
+        pieces[square] = sprite_pieces.index(piece) + 1
+
+    # Copy the squares that changed from their sprites
+    for square in np.flatnonzero(pieces != board_frame_pieces):
+        file = square % 8
+        row = 7 - square // 8  # Rank 8 is at the top of the image
+
+        rows = slice(square_edges[row], square_edges[row + 1])
+        cols = slice(square_edges[file], square_edges[file + 1])
+
+        board_frame[rows, cols] = board_sprites[pieces[square], rows, cols]  # type: ignore
+
+    board_frame_pieces = pieces
+
+    return board_frame.copy()  # type: ignore # Returning a copy, the frame is updated in place
+
+
+def get_board_img(board: chess.Board):
+    """
+    Displays the chess board.
+
+    Args:
+    -   board (chess.Board): The chess board object to be displayed.
+
+    Returns:
+    -   board_tk (np.ndarray): The tkinter image of the chess board.
+    """
+
+    # Put the board image together from the pre-rendered sprites
+    png_array = render_board(board)
 
     # Convert the numpy array to a tkinter image
     board_tkimg = ImageTk.PhotoImage(image=Image.fromarray(png_array))
@@ -334,6 +717,135 @@ def moves_to_ACN(board: chess.Board, moves_list: list):
     return move_ACN  # Returning the move in ACN format
 
 
+def get_move_squares(board: chess.Board, move: chess.Move):
+    """
+    Returns the squares whose content changes when a move is made.
+
+    Args:
+    -   board (chess.Board): The chess board before the move.
+    -   move (chess.Move): The move.
+
+    Returns:
+    -   list: The changed squares (from, to, the captured pawn of an en passant and the rook of a castling).
+    """
+
+    if board.is_castling(move):
+        # The king and the rook both move, their squares depend on the side
+        rank = chess.square_rank(move.from_square)
+        kingside = board.is_kingside_castling(move)
+
+        king_to = chess.square(6 if kingside else 2, rank)
+        rook_from = chess.square(7 if kingside else 0, rank)
+        rook_to = chess.square(5 if kingside else 3, rank)
+
+        return [move.from_square, king_to, rook_from, rook_to]
+
+    if board.is_en_passant(move):
+        # The captured pawn is beside the moving pawn, on the file it moves to
+        captured_square = chess.square(
+            chess.square_file(move.to_square), chess.square_rank(move.from_square)
+        )
+
+        return [move.from_square, move.to_square, captured_square]
+
+    return [move.from_square, move.to_square]
+
+
+def recognize_move(board: chess.Board, heatmap: np.ndarray, temperature: float = 0.1):
+    """
+    Recognizes the move made on the board by scoring every legal move against the change of every square.
+
+    Every move is described by the squares it changes, and scores how well the normalized heatmap matches
+    that set of squares (changed squares close to 1, the others close to 0).
+    Promotions are assumed to be queen promotions, as the camera can't tell the promoted piece.
+
+    Args:
+    -   board (chess.Board): The chess board before the move.
+    -   heatmap (np.ndarray): The 8x8 change of every square indexed by [rank, file], from C2M.find_square_scores.
+    -   temperature (float): The temperature of the softmax turning the scores into confidences.
+
+    Returns:
+    -   list: The (move in UCI format, confidence) of every legal move, most likely first.
+    """
+
+    moves = [
+        move
+        for move in board.legal_moves
+        if move.promotion is None or move.promotion == chess.QUEEN
+    ]  # The candidate moves
+
+    if len(moves) == 0 or heatmap.max() <= 0:
+        return []  # Return an empty list if there are no moves or nothing changed
+
+    # The changed squares of every move as a matrix, one row per move
+    move_squares = np.zeros((len(moves), 64), np.float32)
+
+    for i, move in enumerate(moves):
+        move_squares[i, get_move_squares(board, move)] = 1.0
+
+    changes = heatmap.ravel().astype(np.float32) / heatmap.max()  # Normalized change of every square
+
+    # Score every move by how close the changes are to its squares: -||changes - squares||^2 + ||changes||^2
+    scores = 2 * (move_squares @ changes) - move_squares.sum(axis=1)
+
+    # Turn the scores into confidences
+    confidences = np.exp((scores - scores.max()) / temperature)
+    confidences /= confidences.sum()
+
+    ranking = np.argsort(-confidences, kind="stable")
+
+    return [
+        (moves[i].uci(), round(float(confidences[i]), 4)) for i in ranking
+    ]  # Returning the ranked moves
+
+
+def is_move_recognized(
+    ranked_moves: list,
+    board: chess.Board = None,  # type: ignore
+    heatmap: np.ndarray = None,  # type: ignore
+    min_confidence: float = min_move_confidence,
+    min_margin: float = min_move_margin,
+    min_contrast: float = min_move_contrast,
+):
+    """
+    Checks if the most likely move from recognize_move is certain enough to be played.
+    A bumped board, a change in the lighting or a half made move still ranks some legal move first,
+    but with a low confidence, close to the second move, or with the rest of the board changing almost as much.
+
+    Args:
+    -   ranked_moves (list): The (move in UCI format, confidence) of every legal move, most likely first.
+    -   board (chess.Board): The chess board before the move, needed with the heatmap to check the contrast.
+    -   heatmap (np.ndarray): The 8x8 change of every square given to recognize_move, or None to skip the contrast check.
+    -   min_confidence (float): The lowest confidence of the most likely move.
+    -   min_margin (float): The lowest lead in confidence of the most likely move over the second one.
+    -   min_contrast (float): The lowest difference between the mean normalized change of the move's squares and of the others.
+
+    Returns:
+    -   bool: True if the most likely move can be played.
+    """
+
+    if not ranked_moves:
+        return False  # Nothing changed on the board
+
+    top_confidence = ranked_moves[0][1]
+    second_confidence = ranked_moves[1][1] if len(ranked_moves) > 1 else 0.0
+
+    if top_confidence < min_confidence or top_confidence - second_confidence < min_margin:
+        return False  # The move doesn't stand out from the other moves
+
+    if board is None or heatmap is None:
+        return True
+
+    # The move's squares must stand out from the rest of the board, a change in the lighting changes every square
+    changes = heatmap.ravel().astype(np.float32) / heatmap.max()
+    move_squares = np.zeros(64, bool)
+    move_squares[get_move_squares(board, chess.Move.from_uci(ranked_moves[0][0]))] = True
+
+    return (
+        changes[move_squares].mean() - changes[~move_squares].mean() >= min_contrast
+    )  # Returning whether the move is certain enough
+
+
 def get_random_fen(fen_csv_path: str):
     """
     Returns a random FEN string from the FEN CSV file.
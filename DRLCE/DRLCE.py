@@ -3,54 +3,324 @@ This file contains the main function for playing chess against the computer or w
 """
 
 import chess
+import threading
+import time
 import DRLCE.MCTS as MCTS
 import torch
 import DRLCE.AlphaZeroNetwork as AlphaZeroNetwork
+import DRLCE.encoder as encoder
+from DRLCE.TranspositionTable import TranspositionTable
 
-rollouts = 10  # number of rollouts on computers turn
-threads = 1  # number of threads used per rollout
+rollouts = 10  # number of leaves evaluated on computers turn when no time budget is given
+batch_size = 16  # maximum number of leaves evaluated together in each rollout
 
+clock_fraction = 1 / 30  # fraction of the remaining clock spent on one move
+increment_fraction = 0.8  # fraction of the increment spent on one move
+move_overhead = 0.5  # seconds of the clock kept in reserve for everything besides the search
+min_move_time = 0.05  # seconds, the shortest budget a move is given
+transposition_table_size = 200000  # maximum number of positions cached per model
 
-def get_best_move(weights_file: str, board: chess.Board) -> chess.Move:
+models = {}  # loaded models, keyed by the path of their weights file
+
+search_tree = None  # root of the last search, kept so its subtree can be reused
+search_tree_move = None  # the move played from search_tree
+search_tree_fen = None  # FEN of the position after search_tree_move was played
+
+search_stats = {}  # statistics of the last search
+
+
+class DRLCEModel:
     """
-    Returns the best move for the given chess board using the AlphaZero algorithm.
+    A long-lived holder for the AlphaZero network.
+    The weights are read from disk and the network is warmed up once,
+    so every move after that only pays for the search itself.
+    """
+
+    def __init__(self, weights_file: str):
+        """
+        Args:
+            weights_file (str) the file path to the model weights
+        """
+
+        self.weights_file = weights_file
+
+        load_start = time.perf_counter()
+
+        # Initialize the neural network with the AlphaZero architecture
+        self.net = AlphaZeroNetwork.AlphaZeroNet(20, 256)
+
+        weights = torch.load(
+            weights_file, map_location=torch.device("cpu")
+        )  # load the model weights
+
+        self.net.load_state_dict(weights)  # load the weights into the model
+
+        # Freeze the weights so they are not updated during self play
+        for param in self.net.parameters():
+            param.requires_grad = False
+
+        # Set the model to evaluation mode
+        self.net.eval()
+
+        self.load_time = time.perf_counter() - load_start  # seconds spent loading
+
+        self.warmup_time = 0.0  # seconds spent in the warm-up pass
+
+        self.warmup()
+
+        # Network outputs by position, kept for every search done with this model
+        self.transposition_table = TranspositionTable(transposition_table_size)
+
+    def warmup(self):
+        """
+        Run a forward pass on a full batch of starting positions so the first
+        real move does not pay for the lazy allocations done by torch.
+
+        Returns:
+            (float) the time taken by the warm-up pass in seconds
+        """
+
+        warmup_start = time.perf_counter()
+
+        with torch.no_grad():
+            encoder.callNeuralNetworkBatched(
+                [chess.Board() for _ in range(batch_size)], self.net
+            )
+
+        self.warmup_time = time.perf_counter() - warmup_start
+
+        return self.warmup_time
+
+    def get_metrics(self):
+        """
+        Returns:
+            (dict) the load and warm-up times of the model in seconds
+        """
+
+        return {"load_time": self.load_time, "warmup_time": self.warmup_time}
+
+
+def load_model(weights_file: str) -> DRLCEModel:
+    """
+    Returns the model for the given weights file, loading and warming it up on first use.
+
+    Parameters:
+    -   weights_file (str): The file path to the model weights.
+
+    Returns:
+    -   DRLCEModel: The loaded model, shared by every game played in this process.
+    """
+
+    if weights_file not in models:
+        models[weights_file] = DRLCEModel(weights_file)
+
+    return models[weights_file]
+
+
+def clear_tree():
+    """
+    Forgets the search tree kept from the previous move, e.g. when a new game starts.
+    """
+
+    global search_tree, search_tree_move, search_tree_fen
+
+    search_tree = None
+    search_tree_move = None
+    search_tree_fen = None
+
+
+def get_reused_node(board: chess.Board):
+    """
+    Returns the node of the previous search tree that matches the given board.
+    The board must be the position reached after the engine's last move and the opponent's reply.
+
+    Parameters:
+    -   board (chess.Board): The chess board to search from.
+
+    Returns:
+    -   MCTS.Node: The expanded node for the board, or None if the tree cannot be reused.
+    """
+
+    if search_tree is None or len(board.move_stack) == 0:
+        return None
+
+    prev_board = board.copy()
+    reply = prev_board.pop()  # The opponent's reply to the engine's last move
+
+    # The tree only applies if the board continues from the engine's last move
+    if prev_board.fen() != search_tree_fen:
+        return None
+
+    engine_edge = search_tree.findEdge(search_tree_move)
+
+    if engine_edge is None or not search_tree.hasChild(engine_edge):
+        return None
+
+    engine_node = search_tree.getChild(engine_edge)
+
+    reply_edge = engine_node.findEdge(reply)  # type: ignore
+
+    if reply_edge is None or not engine_node.hasChild(reply_edge):  # type: ignore
+        return None
+
+    return engine_node.getChild(reply_edge)  # type: ignore
+
+
+def get_move_time(time_left_ms: float, increment_ms: float = 0) -> float:
+    """
+    Returns the wall-clock budget for one move from the engine's remaining clock.
+
+    Parameters:
+    -   time_left_ms (float): The time left on the engine's clock in milliseconds.
+    -   increment_ms (float): The increment added to the clock after every move in milliseconds.
+
+    Returns:
+    -   float: The time budget for the move in seconds.
+    """
+
+    time_left = time_left_ms / 1000
+    increment = increment_ms / 1000
+
+    move_time = time_left * clock_fraction + increment * increment_fraction
+
+    # Never spend more than what is left on the clock after the reserve
+    move_time = min(move_time, time_left - move_overhead)
+
+    return max(move_time, min_move_time)
+
+
+def search(
+    weights_file: str,
+    board: chess.Board,
+    time_budget: float = None,  # type: ignore
+    time_left_ms: float = None,  # type: ignore
+    increment_ms: float = 0,
+    stop_event: threading.Event = None,  # type: ignore
+):
+    """
+    Searches the given chess board using the AlphaZero algorithm.
+    With a time budget (given directly or derived from the engine's clock), rollouts are run
+    until the deadline, otherwise a fixed number of leaves (rollouts) is evaluated.
 
     Parameters:
     -   weights_file (str): The file path to the model weights.
     -   board (chess.Board): The chess board to evaluate.
+    -   time_budget (float): The wall-clock budget for the search in seconds.
+    -   time_left_ms (float): The time left on the engine's clock in milliseconds, used when no time budget is given.
+    -   increment_ms (float): The increment added to the engine's clock after every move in milliseconds.
+    -   stop_event (threading.Event): When set from another thread, the search stops after the current rollout.
 
     Returns:
-    -   chess.Move: The best move for the given board.
+    -   tuple: The best move (chess.Move) and the number of nodes searched (int).
     """
 
-    # Initialize the neural network with the AlphaZero architecture
-    alphaZeroNet = AlphaZeroNetwork.AlphaZeroNet(20, 256)
+    global search_tree, search_tree_move, search_tree_fen, search_stats
 
-    weights = torch.load(
-        weights_file, map_location=torch.device("cpu")
-    )  # load the model weights
+    start_time = time.perf_counter()
 
-    alphaZeroNet.load_state_dict(weights)  # load the weights into the model
+    if time_budget is None and time_left_ms is not None:
+        time_budget = get_move_time(time_left_ms, increment_ms)
 
-    # Freeze the weights so they are not updated during self play
-    for param in alphaZeroNet.parameters():
-        param.requires_grad = False
+    model = load_model(weights_file)
+    alphaZeroNet = model.net  # Get the already loaded network
 
-    # Set the model to evaluation mode
-    alphaZeroNet.eval()
+    transposition_table = model.transposition_table
+    transposition_table.resetStatistics()  # Count the hits of this search only
 
     # Get the best move from the MCTS algorithm
     with torch.no_grad():
         root = MCTS.Root(
-            board, alphaZeroNet
-        )  # Initialize the root node of the MCTS tree
+            board, alphaZeroNet, get_reused_node(board), transposition_table
+        )  # Initialize the root node of the MCTS tree, keeping the subtree of the previous search
+
+        start_N = root.N
+
+        if time_budget is None:
+            # Evaluate rollouts leaves in total, in batches of at most batch_size
+            leaves_left = rollouts
+
+            while leaves_left > 0:
+                if stop_event is not None and stop_event.is_set():
+                    break
+
+                leaves = min(batch_size, leaves_left)
 
-        # Run the MCTS algorithm for num_rollouts iterations
-        for i in range(rollouts):
-            root.parallelRollouts(board.copy(), alphaZeroNet, threads)
+                root.parallelRollouts(board.copy(), alphaZeroNet, leaves)
+
+                leaves_left -= leaves
+
+        else:
+            deadline = start_time + time_budget
+
+            num_rollouts = 0
+
+            # Run rollouts while another one is expected to finish before the deadline
+            while True:
+                root.parallelRollouts(board.copy(), alphaZeroNet, batch_size)
+
+                num_rollouts += 1
+
+                now = time.perf_counter()
+
+                rollout_time = (now - start_time) / num_rollouts
+
+                if now + rollout_time > deadline:
+                    break
+
+                if stop_event is not None and stop_event.is_set():
+                    break
 
     # Get the best move from the edge with the highest N value
     edge = root.maxNSelect()
-    bestmove = edge.getMove()  # type: ignore
+    bestmove = root.getMove(edge)
+
+    # Keep the tree so the next search can start from the opponent's reply
+    search_tree = root
+    search_tree_move = bestmove
+    after_board = board.copy()
+    after_board.push(bestmove)
+    search_tree_fen = after_board.fen()
+
+    nodes = int(root.N - start_N)  # Number of nodes searched during this call
+
+    search_stats = {
+        "nodes": nodes,
+        "time": time.perf_counter() - start_time,
+        "tt_hits": transposition_table.hits,
+        "tt_misses": transposition_table.misses,
+        "tt_hit_rate": transposition_table.getHitRate(),
+    }
+
+    return bestmove, nodes
+
+
+def get_best_move(
+    weights_file: str,
+    board: chess.Board,
+    time_left_ms: float = None,  # type: ignore
+    increment_ms: float = 0,
+    stop_event: threading.Event = None,  # type: ignore
+) -> chess.Move:
+    """
+    Returns the best move for the given chess board using the AlphaZero algorithm.
+
+    Parameters:
+    -   weights_file (str): The file path to the model weights.
+    -   board (chess.Board): The chess board to evaluate.
+    -   time_left_ms (float): The time left on the engine's clock in milliseconds, if None a fixed number of rollouts is run.
+    -   increment_ms (float): The increment added to the engine's clock after every move in milliseconds.
+    -   stop_event (threading.Event): When set from another thread, the search stops after the current rollout.
+
+    Returns:
+    -   chess.Move: The best move for the given board.
+    """
+
+    bestmove, _ = search(
+        weights_file,
+        board,
+        time_left_ms=time_left_ms,
+        increment_ms=increment_ms,
+        stop_event=stop_event,
+    )
 
     return bestmove  # Return the best move
@@ -3,39 +3,133 @@ This file contains the MCTS class, which is used for doing MCTS on a chess board
 """
 
 import DRLCE.encoder as encoder
-import math
-from threading import Thread
-import time
+import chess
+import numpy as np
 
+C = 1.5  # exploration constant of the UCT formula
 
-def calcUCT(edge, N_p):
+
+def encodeMoves(moves, num_moves):
+    """
+    Pack moves into integers: bits 0-5 hold the from square,
+    bits 6-11 the to square and bits 12-14 the promotion piece.
+
+    Args:
+        moves (iterable of chess.Move) the moves to pack
+        num_moves (int) the number of moves
+
+    Returns:
+        (numpy.array (num_moves) int16) the packed moves
+    """
+
+    return np.fromiter(
+        (
+            move.from_square | (move.to_square << 6) | ((move.promotion or 0) << 12)
+            for move in moves
+        ),
+        dtype=np.int16,
+        count=num_moves,
+    )
+
+
+def decodeMove(packed_move):
     """
-    Calculate the UCT formula.
+    Unpack a move packed by encodeMoves.
 
     Args:
-        edge (Edge) the edge which the UCT formula is for
-        N_p (float) the parents visit count
+        packed_move (int) the packed move
 
     Returns:
-        (float) the calculated value
+        (chess.Move) the move
     """
 
-    Q = edge.getQ()
+    packed_move = int(packed_move)
+
+    return chess.Move(
+        packed_move & 63, (packed_move >> 6) & 63, (packed_move >> 12) or None
+    )
+
+
+def callNeuralNetworkCached(boards, neuralNetwork, transpositionTable=None):
+    """
+    Run the neural network on each board given, skipping the positions
+    already stored in the transposition table.
+
+    Args:
+        boards (list of chess.Board) the input positions
+        neuralNetwork (torch.nn.Module) the neural network
+        transpositionTable (TranspositionTable) the table of already evaluated positions, or None
+
+    Returns:
+        values (list of float) the value output for each input position
+        move_probabilities (list of numpy.array (num_moves) float32) the move probabilities for each position
+    """
+
+    if transpositionTable is None:
+        values, move_probabilities = encoder.callNeuralNetworkBatched(
+            boards, neuralNetwork
+        )
+
+        return list(values), list(move_probabilities)
+
+    values = [None] * len(boards)
+    move_probabilities = [None] * len(boards)
+
+    keys = []
+    missing = []
+
+    for i, board in enumerate(boards):
+        key = transpositionTable.getKey(board)
+
+        keys.append(key)
+
+        entry = transpositionTable.lookup(key)
+
+        if entry is None:
+            missing.append(i)
+        else:
+            values[i], move_probabilities[i] = entry
+
+    if len(missing) > 0:
+        missing_values, missing_move_probabilities = encoder.callNeuralNetworkBatched(
+            [boards[i] for i in missing], neuralNetwork
+        )
+
+        for j, i in enumerate(missing):
+            num_moves = boards[i].legal_moves.count()
+
+            values[i] = float(missing_values[j])
+            move_probabilities[i] = missing_move_probabilities[j, :num_moves].copy()
+
+            transpositionTable.store(keys[i], values[i], move_probabilities[i])
+
+    return values, move_probabilities
 
-    N_c = edge.getN()
 
-    P = edge.getP()
+def calcUCT(node):
+    """
+    Calculate the UCT formula for every edge of a node at once.
+
+    Args:
+        node (Node) the node whose edges the UCT formula is for
+
+    Returns:
+        (numpy.array (num_edges) float32) the calculated values
+    """
 
-    if math.isnan(P):
-        P = 0.1
+    N_c = node.child_N + node.virtual_losses
 
-    C = 1.5
+    # Unvisited edges have no child yet and count as a Q of 0
+    Q = np.zeros_like(N_c)
 
-    UCT = Q + P * C * math.sqrt(N_p) / (1 + N_c)
+    has_child = node.child_N > 0
 
-    assert not math.isnan(UCT), "Q {} N_c {} P {}".format(Q, N_c, P)
+    Q[has_child] = 1.0 - (
+        (node.child_sum_Q[has_child] + node.virtual_losses[has_child])
+        / N_c[has_child]
+    )
 
-    return UCT
+    return Q + node.P * (C * np.sqrt(node.N) / (1 + N_c))
 
 
 class Node:
@@ -43,8 +137,11 @@ class Node:
     A node in the search tree.
     Nodes store their visit count (N), the sum of the
     win probabilities in the subtree from the point
-    of view of this node (sum_Q), and a list of
-    edges
+    of view of this node (sum_Q), and their edges.
+    The edges are stored as contiguous arrays indexed by
+    edge: the packed move, the move probability (P), the
+    child's N and sum_Q, and the virtual losses. Children
+    are only created for the edges that have been expanded.
     """
 
     def __init__(self, board, new_Q, move_probabilities):
@@ -58,11 +155,21 @@ class Node:
 
         self.sum_Q = new_Q
 
-        self.edges = []
+        num_moves = board.legal_moves.count()
+
+        self.moves = encodeMoves(board.legal_moves, num_moves)
+
+        self.P = np.nan_to_num(
+            np.asarray(move_probabilities[:num_moves], dtype=np.float32), nan=0.1
+        )
+
+        self.child_N = np.zeros(num_moves, dtype=np.float32)
 
-        for idx, move in enumerate(board.legal_moves):
-            edge = Edge(move, move_probabilities[idx])
-            self.edges.append(edge)
+        self.child_sum_Q = np.zeros(num_moves, dtype=np.float32)
+
+        self.virtual_losses = np.zeros(num_moves, dtype=np.float32)
+
+        self.children = {}
 
     def getN(self):
         """
@@ -85,40 +192,24 @@ class Node:
         Get the edge that maximizes the UCT formula, or none
         if this node is terminal.
         Returns:
-            max_edge (Edge) the edge maximizing the UCT formula.
+            max_edge (int) the index of the edge maximizing the UCT formula.
         """
 
-        max_uct = -1000.0
-        max_edge = None
-
-        for edge in self.edges:
-            uct = calcUCT(edge, self.N)
-
-            if max_uct < uct:
-                max_uct = uct
-                max_edge = edge
-
-        assert not (max_edge == None and not self.isTerminal())
+        if self.isTerminal():
+            return None
 
-        return max_edge
+        return int(np.argmax(calcUCT(self)))
 
     def maxNSelect(self):
         """
         Returns:
-            max_edge (Edge) the edge with maximum N.
+            max_edge (int) the index of the edge with maximum N.
         """
 
-        max_N = -1
-        max_edge = None
+        if self.isTerminal():
+            return None
 
-        for edge in self.edges:
-            N = edge.getN()
-
-            if max_N < N:
-                max_N = N
-                max_edge = edge
-
-        return max_edge
+        return int(np.argmax(self.child_N + self.virtual_losses))
 
     def getStatisticsString(self):
         """
@@ -131,25 +222,15 @@ class Node:
             "move", "P", "N", "Q", "UCT"
         )
 
-        edges = self.edges.copy()
-
-        edges.sort(key=lambda edge: edge.getN())
-
-        edges.reverse()
-
-        for edge in edges:
-            move = edge.getMove()
-
-            P = edge.getP()
-
-            N = edge.getN()
-
-            Q = edge.getQ()
-
-            UCT = calcUCT(edge, self.N)
+        UCT = calcUCT(self)
 
+        for edge in np.argsort(-(self.child_N + self.virtual_losses), kind="stable"):
             string += "|{: ^10}|{:10.4f}|{:10.4f}|{:10.4f}|{:10.4f}|\n".format(
-                str(move), P, N, Q, UCT
+                str(self.getMove(edge)),
+                self.P[edge],
+                self.getEdgeN(edge),
+                self.getEdgeQ(edge),
+                UCT[edge],
             )
 
         return string
@@ -158,76 +239,96 @@ class Node:
         """
         Checks if this node is terminal.'
         """
-        return len(self.edges) == 0
-
-
-class Edge:
-    """
-    An edge in the search tree.
-    Each edge stores a move, a move probability,
-    virtual losses and a child.
-    """
+        return len(self.moves) == 0
 
-    def __init__(self, move, move_probability):
+    def findEdge(self, move):
         """
+        Get the edge for the given move.
+
         Args:
-            move (chess.Move) the move this edge represents
-            move_probability (float) this move's probability from the neural network
+            move (chess.Move) the move to look for
+
+        Returns:
+            (int) the index of the edge representing the move, or None if the move is not legal here
         """
 
-        self.move = move
+        edges = np.flatnonzero(self.moves == encodeMoves([move], 1)[0])
 
-        self.P = move_probability
+        if len(edges) == 0:
+            return None
 
-        self.child = None
+        return int(edges[0])
+
+    def getMove(self, edge):
+        """
+        Args:
+            edge (int) the index of the edge
+
+        Returns:
+            (chess.Move) the edge's move
+        """
 
-        self.virtualLosses = 0.0
+        return decodeMove(self.moves[edge])
 
-    def has_child(self):
+    def hasChild(self, edge):
         """
+        Args:
+            edge (int) the index of the edge
+
         Returns:
-            (bool) whether this edge has a child
+            (bool) whether the edge has a child
         """
 
-        return self.child != None
+        return edge in self.children
 
-    def getN(self):
+    def getChild(self, edge):
         """
+        Args:
+            edge (int) the index of the edge
+
         Returns:
-            (int) the child's N
+            (Node) the edge's child node
         """
 
-        if self.has_child():
-            return self.child.N + self.virtualLosses  # type: ignore
-        else:
-            return 0.0 + self.virtualLosses
+        return self.children.get(edge)
 
-    def getQ(self):
+    def getEdgeN(self, edge):
         """
+        Args:
+            edge (int) the index of the edge
+
         Returns:
-            (int) the child's Q
+            (float) the child's N
         """
-        if self.has_child():
-            return 1.0 - (
-                (self.child.sum_Q + self.virtualLosses)  # type: ignore
-                / (self.child.N + self.virtualLosses)  # type: ignore
-            )
-        else:
-            return 0.0
 
-    def getP(self):
+        return float(self.child_N[edge] + self.virtual_losses[edge])
+
+    def getEdgeQ(self, edge):
         """
+        Args:
+            edge (int) the index of the edge
+
         Returns:
-            (int) this move's probability (P)
+            (float) the child's Q
         """
 
-        return self.P
+        if self.child_N[edge] > 0:
+            return float(
+                1.0
+                - (
+                    (self.child_sum_Q[edge] + self.virtual_losses[edge])
+                    / (self.child_N[edge] + self.virtual_losses[edge])
+                )
+            )
+        else:
+            return 0.0
 
-    def expand(self, board, new_Q, move_probabilities):
+    def expand(self, edge, board, new_Q, move_probabilities):
         """
-        Create the child node with the given board position. Return
+        Create the child node of an edge with the given board position. Return
         True if we are expanding an unexpanded node, and otherwise false.
         Args:
+            edge (int) the index of the edge
             board (chess.Board) the chess position
             new_Q (float) the probability of winning according to the neural network
             move_probabilities (numpy.array (200) float) the move probabilities according to the neural network
@@ -236,59 +337,101 @@ class Edge:
             (bool) whether we are expanding an unexpanded node
         """
 
-        if self.child == None:
-            self.child = Node(board, new_Q, move_probabilities)
+        if edge not in self.children:
+            child = Node(board, new_Q, move_probabilities)
 
-            return True
+            self.children[edge] = child
 
-        else:
-            return False
+            self.child_N[edge] = child.N
 
-    def getChild(self):
-        """
-        Returns:
-            (Node) this edge's child node
-        """
-
-        return self.child
+            self.child_sum_Q[edge] = child.sum_Q
 
-    def getMove(self):
-        """
-        Returns:
-            (chess.Move) this edge's move
-        """
+            return True
 
-        return self.move
+        else:
+            return False
 
-    def addVirtualLoss(self):
+    def addVirtualLoss(self, edge):
         """
         When doing multiple rollouts in parallel,
         we can discourage threads from taking
         the same path by adding fake losses
         to visited nodes.
+
+        Args:
+            edge (int) the index of the edge
         """
 
-        self.virtualLosses += 1
+        self.virtual_losses[edge] += 1
+
+    def clearVirtualLoss(self, edge):
+        self.virtual_losses[edge] = 0.0
+
+
+def backup(node_path, edge_path, new_Q):
+    """
+    Propagate a win probability up the path of a rollout.
+
+    Args:
+        node_path (list of Node) ordered list of nodes traversed
+        edge_path (list of int) ordered list of edges traversed
+        new_Q (float) the win probability from the point of view of the last node
+    """
+
+    last_node_idx = len(node_path) - 1
+
+    for r in range(last_node_idx, -1, -1):
+        node = node_path[r]
+
+        node.N += 1.0
+
+        if (last_node_idx - r) % 2 == 0:
+            node.sum_Q += new_Q
+
+        else:
+            node.sum_Q += 1.0 - new_Q
 
-    def clearVirtualLoss(self):
-        self.virtualLosses = 0.0
+        # Keep the parent's arrays in sync with this node's statistics
+        if r > 0:
+            parent = node_path[r - 1]
+
+            parent.child_N[edge_path[r - 1]] = node.N
+
+            parent.child_sum_Q[edge_path[r - 1]] = node.sum_Q
 
 
 class Root(Node):
-    def __init__(self, board, neuralNetwork):
+    def __init__(self, board, neuralNetwork, node=None, transpositionTable=None):
         """
         Create the root of the search tree.
 
         Args:
             board (chess.Board) the chess position
             neuralNetwork (torch.nn.Module) the neural network
+            node (Node) an already expanded node for this position. If given,
+                the root takes over its statistics and subtree instead of
+                calling the neural network again.
+            transpositionTable (TranspositionTable) the table of already
+                evaluated positions shared by the rollouts, or None
 
         """
-        value, move_probabilities = encoder.callNeuralNetwork(board, neuralNetwork)
+        self.transpositionTable = transpositionTable
+
+        if node is None:
+            values, move_probabilities = callNeuralNetworkCached(
+                [board], neuralNetwork, transpositionTable
+            )
+
+            Q = values[0] / 2.0 + 0.5
 
-        Q = value / 2.0 + 0.5
+            move_probabilities = move_probabilities[0]
 
-        super().__init__(board, Q, move_probabilities)
+            super().__init__(board, Q, move_probabilities)
+
+        else:
+            self.__dict__.update(node.__dict__)
+
+            self.transpositionTable = transpositionTable
 
         self.same_paths = 0
 
@@ -301,7 +444,7 @@ class Root(Node):
                 on return, either the positon of the selected unexpanded node,
                 or the last node visited, if that is terminal
             node_path (list of Node) ordered list of nodes traversed
-            edge_path (list of Edge) ordered list of edges traversed
+            edge_path (list of int) ordered list of edges traversed
         """
 
         cNode = self
@@ -321,17 +464,17 @@ class Root(Node):
 
                 break
 
-            cEdge.addVirtualLoss()
+            cNode.addVirtualLoss(cEdge)
 
-            board.push(cEdge.getMove())
+            board.push(cNode.getMove(cEdge))
 
-            if not cEdge.has_child():
+            if not cNode.hasChild(cEdge):
                 # cEdge has not been expanded. Return with board set to the same
                 # position as the unexpanded Node
 
                 break
 
-            cNode = cEdge.getChild()
+            cNode = cNode.getChild(cEdge)
 
     def rollout(self, board, neuralNetwork):
         """
@@ -355,11 +498,13 @@ class Root(Node):
         edge = edge_path[-1]
 
         if edge != None:
-            value, move_probabilities = encoder.callNeuralNetwork(board, neuralNetwork)
+            values, move_probabilities = callNeuralNetworkCached(
+                [board], neuralNetwork, self.transpositionTable
+            )
 
-            new_Q = value / 2.0 + 0.5
+            new_Q = values[0] / 2.0 + 0.5
 
-            edge.expand(board, new_Q, move_probabilities)
+            node_path[-1].expand(edge, board, new_Q, move_probabilities[0])
 
             new_Q = 1.0 - new_Q
 
@@ -371,66 +516,64 @@ class Root(Node):
 
             new_Q = float(winner) / 2.0 + 0.5
 
-        last_node_idx = len(node_path) - 1
+        backup(node_path, edge_path, new_Q)
 
-        for i in range(last_node_idx, -1, -1):
-            node = node_path[i]
-
-            node.N += 1
-
-            if (last_node_idx - i) % 2 == 0:
-                node.sum_Q += new_Q
-
-            else:
-                node.sum_Q += 1.0 - new_Q
-
-        for edge in edge_path[i]:  # type: ignore
+        for node, edge in zip(node_path, edge_path):
             if edge != None:
-                edge.clearVirtualLoss()
+                node.clearVirtualLoss(edge)
 
-    def parallelRollouts(self, board, neuralNetwork, num_parallel_rollouts):
+    def parallelRollouts(self, board, neuralNetwork, batch_size):
         """
-        Same as rollout, except done in parallel.
+        Same as rollout, except a batch of leaves is evaluated at once.
+        The leaves are selected one after another, with virtual losses
+        steering each selection away from the paths already taken, then
+        all of them are evaluated in a single forward pass of the neural
+        network and their results are backed up.
 
         Args:
             board (chess.Board) the chess position
             neuralNetwork (torch.nn.Module) the neural network
-            num_parallel_rollouts (int) the number of rollouts done in parallel
+            batch_size (int) the number of leaves evaluated together
         """
 
         boards = []
         node_paths = []
         edge_paths = []
-        threads = []
 
-        for i in range(num_parallel_rollouts):
+        for i in range(batch_size):
             boards.append(board.copy())
             node_paths.append([])
             edge_paths.append([])
-            threads.append(
-                Thread(
-                    target=self.selectTask,
-                    args=(boards[i], node_paths[i], edge_paths[i]),
-                )
-            )
-            threads[i].start()
-            time.sleep(0.0001)
+            self.selectTask(boards[i], node_paths[i], edge_paths[i])
 
-        for i in range(num_parallel_rollouts):
-            threads[i].join()
+        # Only unexpanded leaves need the neural network, and a leaf selected
+        # more than once is only evaluated the first time
+        batch_idx = {}
+        batch_boards = []
 
-        values, move_probabilities = encoder.callNeuralNetworkBatched(
-            boards, neuralNetwork
-        )
+        for i in range(batch_size):
+            edge = edge_paths[i][-1]
+            leaf = (id(node_paths[i][-1]), edge)
+            if edge != None and leaf not in batch_idx:
+                batch_idx[leaf] = len(batch_boards)
+                batch_boards.append(boards[i])
+
+        if len(batch_boards) > 0:
+            values, move_probabilities = callNeuralNetworkCached(
+                batch_boards, neuralNetwork, self.transpositionTable
+            )
 
-        for i in range(num_parallel_rollouts):
+        for i in range(batch_size):
             edge = edge_paths[i][-1]
             board = boards[i]
-            value = values[i]
             if edge != None:
-                new_Q = value / 2.0 + 0.5
+                j = batch_idx[(id(node_paths[i][-1]), edge)]
 
-                isunexpanded = edge.expand(board, new_Q, move_probabilities[i])
+                new_Q = values[j] / 2.0 + 0.5  # type: ignore
+
+                isunexpanded = node_paths[i][-1].expand(
+                    edge, board, new_Q, move_probabilities[j]  # type: ignore
+                )
 
                 if not isunexpanded:
                     self.same_paths += 1
@@ -445,19 +588,9 @@ class Root(Node):
 
                 new_Q = float(winner) / 2.0 + 0.5
 
-            last_node_idx = len(node_paths[i]) - 1
-
-            for r in range(last_node_idx, -1, -1):
-                node = node_paths[i][r]
-
-                node.N += 1.0
-
-                if (last_node_idx - r) % 2 == 0:
-                    node.sum_Q += new_Q
-
-                else:
-                    node.sum_Q += 1.0 - new_Q
+            backup(node_paths[i], edge_paths[i], new_Q)
 
-            for edge in edge_paths[i]:
+        for i in range(batch_size):
+            for node, edge in zip(node_paths[i], edge_paths[i]):
                 if edge != None:
-                    edge.clearVirtualLoss()
+                    node.clearVirtualLoss(edge)
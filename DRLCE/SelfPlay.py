@@ -0,0 +1,327 @@
+"""
+This file contains a headless runner for DRLCE self play games and matches against Stockfish.
+Games are played in parallel worker processes, and the PGNs and the timing of every move are written to disk.
+
+Example:
+    python -m DRLCE.SelfPlay --weights DRLCE/weights/AlphaZeroNet_20x256.pt --stockfish stockfish.exe --levels 1 2 --games 8 --workers 4
+"""
+
+import argparse
+import csv
+import multiprocessing
+import os
+import time
+import chess
+from chess import pgn
+import torch
+import DRLCE.DRLCE as DRLCE
+
+stockfish_engines = {}  # Stockfish engines of the worker process, keyed by difficulty level
+
+
+def get_stockfish(stockfish_path: str, level: int):
+    """
+    Returns the Stockfish engine of this worker process for the given level, starting it on first use.
+
+    Args:
+    -   stockfish_path (str): The path to the Stockfish engine.
+    -   level (int): The difficulty level as used by CE.set_engine_difficulty.
+
+    Returns:
+    -   stockfish_engine: The Stockfish engine object.
+    """
+
+    import CE as ce  # Imported here so DRLCE-only runs do not need the GUI dependencies
+
+    if level not in stockfish_engines:
+        stockfish = ce.init_stockfish(
+            stockfish_path, ponder=False
+        )  # No pondering, it would take CPU time from DRLCE
+        stockfish_engines[level] = ce.set_engine_difficulty(stockfish, level)
+
+    return stockfish_engines[level]
+
+
+def init_worker(torch_threads: int):
+    """
+    Initializes a worker process.
+
+    Args:
+    -   torch_threads (int): The number of threads torch may use in this process.
+
+    Returns:
+    -   None
+    """
+
+    torch.set_num_threads(torch_threads)  # Keep the workers from oversubscribing the CPU
+
+
+def play_game(game_args: dict):
+    """
+    Plays one game between DRLCE and an opponent.
+
+    Args:
+    -   game_args (dict): The game settings, with the keys:
+        -   game_id (int): The number of the game.
+        -   weights (str): The path to the DRLCE weights.
+        -   opponent (str): "self" for DRLCE against itself, or "stockfish".
+        -   level (int): The Stockfish difficulty level.
+        -   stockfish (str): The path to the Stockfish engine.
+        -   DRLCE_white (bool): Whether DRLCE plays the white pieces.
+        -   move_time (float): The DRLCE search time per move in seconds, or None for the fixed number of rollouts.
+        -   max_moves (int): The number of plies after which the game is adjudicated a draw.
+        -   fen (str): The starting position.
+
+    Returns:
+    -   dict: The game id, the PGN as a string, the result, and the timing of every move.
+    """
+
+    board = chess.Board(game_args["fen"])
+
+    moves = []  # Timing of every move
+
+    DRLCE.clear_tree()  # Start every game with an empty search tree
+
+    while not board.is_game_over(claim_draw=True) and len(moves) < game_args["max_moves"]:
+        DRLCE_turn = game_args["opponent"] == "self" or (
+            board.turn == chess.WHITE
+        ) == game_args["DRLCE_white"]
+
+        move_start = time.perf_counter()
+
+        if DRLCE_turn:
+            player = "DRLCE"
+            move, nodes = DRLCE.search(
+                game_args["weights"], board, time_budget=game_args["move_time"]
+            )
+            tt_hit_rate = DRLCE.search_stats["tt_hit_rate"]
+        else:
+            import CE as ce
+
+            player = "Stockfish {}".format(game_args["level"])
+            stockfish = get_stockfish(game_args["stockfish"], game_args["level"])
+            move = chess.Move.from_uci(ce.get_stockfish_move(stockfish, board))
+            nodes = None
+            tt_hit_rate = None
+
+        moves.append(
+            {
+                "game_id": game_args["game_id"],
+                "ply": len(moves) + 1,
+                "player": player,
+                "move": move.uci(),
+                "time": time.perf_counter() - move_start,
+                "nodes": nodes,
+                "tt_hit_rate": tt_hit_rate,
+            }
+        )
+
+        board.push(move)
+
+    if board.is_game_over(claim_draw=True):
+        result = board.result(claim_draw=True)
+    else:
+        result = "1/2-1/2"  # Adjudicated after max_moves plies
+
+    # Build the PGN, with the time of every move as a comment
+    game = pgn.Game.from_board(board)
+    game.headers["Event"] = "DRLCE match"
+    game.headers["Round"] = str(game_args["game_id"])
+    game.headers["Result"] = result
+
+    if game_args["opponent"] == "self":
+        game.headers["White"] = game.headers["Black"] = "DRLCE"
+    else:
+        opponent_name = "Stockfish {}".format(game_args["level"])
+        game.headers["White"] = "DRLCE" if game_args["DRLCE_white"] else opponent_name
+        game.headers["Black"] = opponent_name if game_args["DRLCE_white"] else "DRLCE"
+
+    for node, move_info in zip(game.mainline(), moves):
+        node.comment = "[%emt {:.3f}]".format(move_info["time"])
+
+    return {
+        "game_id": game_args["game_id"],
+        "pgn": str(game),
+        "result": result,
+        "white": game.headers["White"],
+        "black": game.headers["Black"],
+        "moves": moves,
+    }
+
+
+def run_match(
+    weights: str,
+    out_dir: str,
+    games: int,
+    workers: int,
+    opponent: str = "stockfish",
+    levels: tuple = (1,),
+    stockfish: str = None,  # type: ignore
+    move_time: float = None,  # type: ignore
+    max_moves: int = 200,
+    fen: str = chess.STARTING_FEN,
+):
+    """
+    Plays games in parallel worker processes and writes the PGNs and per move timing to out_dir.
+
+    Args:
+    -   weights (str): The path to the DRLCE weights.
+    -   out_dir (str): The directory the results are written to.
+    -   games (int): The number of games played against each level.
+    -   workers (int): The number of worker processes.
+    -   opponent (str): "self" for DRLCE against itself, or "stockfish".
+    -   levels (tuple): The Stockfish difficulty levels to play against.
+    -   stockfish (str): The path to the Stockfish engine.
+    -   move_time (float): The DRLCE search time per move in seconds, or None for the fixed number of rollouts.
+    -   max_moves (int): The number of plies after which a game is adjudicated a draw.
+    -   fen (str): The starting position of every game.
+
+    Returns:
+    -   list: The results of the games, as returned by play_game.
+    """
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    if opponent == "self":
+        levels = (0,)
+
+    games_args = []
+
+    for level in levels:
+        for i in range(games):
+            games_args.append(
+                {
+                    "game_id": len(games_args) + 1,
+                    "weights": weights,
+                    "opponent": opponent,
+                    "level": level,
+                    "stockfish": stockfish,
+                    "DRLCE_white": i % 2 == 0,  # Alternate the colors
+                    "move_time": move_time,
+                    "max_moves": max_moves,
+                    "fen": fen,
+                }
+            )
+
+    torch_threads = max(1, (os.cpu_count() or 1) // workers)
+
+    results = []
+
+    # Spawn rather than fork, torch does not support forking after it started its threads
+    context = multiprocessing.get_context("spawn")
+
+    with context.Pool(workers, init_worker, (torch_threads,)) as pool:
+        with open(os.path.join(out_dir, "games.pgn"), "w") as pgn_file, open(
+            os.path.join(out_dir, "moves.csv"), "w", newline=""
+        ) as moves_file:
+            moves_writer = csv.DictWriter(
+                moves_file,
+                fieldnames=[
+                    "game_id",
+                    "ply",
+                    "player",
+                    "move",
+                    "time",
+                    "nodes",
+                    "tt_hit_rate",
+                ],
+            )
+            moves_writer.writeheader()
+
+            # Write every game as soon as it finishes
+            for result in pool.imap_unordered(play_game, games_args):
+                pgn_file.write(result["pgn"] + "\n\n")
+                pgn_file.flush()
+
+                moves_writer.writerows(result["moves"])
+                moves_file.flush()
+
+                print(
+                    "Game {}: {} - {} {}".format(
+                        result["game_id"], result["white"], result["black"], result["result"]
+                    )
+                )
+
+                results.append(result)
+
+    return results
+
+
+def print_summary(results: list):
+    """
+    Prints the score of DRLCE and its average time and nodes per move against every opponent.
+
+    Args:
+    -   results (list): The results of the games, as returned by play_game.
+
+    Returns:
+    -   None
+    """
+
+    summary = {}
+
+    for result in results:
+        opponent = result["black"] if result["white"] == "DRLCE" else result["white"]
+
+        entry = summary.setdefault(
+            opponent, {"games": 0, "score": 0.0, "time": 0.0, "nodes": 0, "moves": 0}
+        )
+
+        entry["games"] += 1
+
+        if result["result"] == "1/2-1/2":
+            entry["score"] += 0.5
+        elif (result["result"] == "1-0") == (result["white"] == "DRLCE"):
+            entry["score"] += 1.0
+
+        for move in result["moves"]:
+            if move["player"] == "DRLCE":
+                entry["time"] += move["time"]
+                entry["nodes"] += move["nodes"]
+                entry["moves"] += 1
+
+    for opponent, entry in summary.items():
+        moves = max(entry["moves"], 1)
+
+        print(
+            "DRLCE vs {}: {}/{}, {:.3f} s and {:.0f} nodes per move".format(
+                opponent,
+                entry["score"],
+                entry["games"],
+                entry["time"] / moves,
+                entry["nodes"] / moves,
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--weights", required=True, help="path to the DRLCE weights")
+    parser.add_argument("--out", default="selfplay_output", help="output directory")
+    parser.add_argument("--games", type=int, default=2, help="games per level")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--opponent", choices=["stockfish", "self"], default="stockfish")
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 2, 3, 4])
+    parser.add_argument("--stockfish", help="path to the Stockfish engine")
+    parser.add_argument("--move-time", type=float, help="DRLCE seconds per move")
+    parser.add_argument("--max-moves", type=int, default=200, help="plies before adjudication")
+    parser.add_argument("--fen", default=chess.STARTING_FEN, help="starting position")
+    args = parser.parse_args()
+
+    if args.opponent == "stockfish" and args.stockfish is None:
+        parser.error("--stockfish is required when playing against Stockfish")
+
+    match_results = run_match(
+        args.weights,
+        args.out,
+        args.games,
+        args.workers,
+        args.opponent,
+        args.levels,
+        args.stockfish,
+        args.move_time,
+        args.max_moves,
+        args.fen,
+    )
+
+    print_summary(match_results)
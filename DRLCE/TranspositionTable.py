@@ -0,0 +1,111 @@
+"""
+This module contains the TranspositionTable class, which caches the neural network's outputs by position.
+"""
+
+from collections import OrderedDict
+import chess.polyglot
+
+
+class TranspositionTable:
+    """
+    A bounded cache of neural network outputs keyed by the Zobrist hash of the position.
+    The same position reached through different move orders is only evaluated once.
+    When the table is full, the least recently used entry is evicted.
+    """
+
+    def __init__(self, max_size):
+        """
+        Args:
+            max_size (int) the maximum number of positions stored
+        """
+
+        self.max_size = max_size
+
+        self.entries = OrderedDict()
+
+        self.hits = 0
+
+        self.misses = 0
+
+    def getKey(self, board):
+        """
+        Args:
+            board (chess.Board) the chess position
+
+        Returns:
+            (int) the Zobrist hash of the position
+        """
+
+        return chess.polyglot.zobrist_hash(board)
+
+    def lookup(self, key):
+        """
+        Get the stored outputs for a position, counting the hit or miss.
+
+        Args:
+            key (int) the Zobrist hash of the position
+
+        Returns:
+            (tuple) the value (float) and move probabilities (numpy.array (num_moves) float32), or None if not stored
+        """
+
+        entry = self.entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+
+            return None
+
+        self.hits += 1
+
+        self.entries.move_to_end(key)  # Mark as most recently used
+
+        return entry
+
+    def store(self, key, value, move_probabilities):
+        """
+        Store the outputs for a position, evicting the least recently used one if full.
+
+        Args:
+            key (int) the Zobrist hash of the position
+            value (float) the value of this position
+            move_probabilities (numpy.array (num_moves) float32) the move probabilities
+        """
+
+        self.entries[key] = (value, move_probabilities)
+
+        self.entries.move_to_end(key)
+
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def getHitRate(self):
+        """
+        Returns:
+            (float) the fraction of lookups that were hits since the statistics were last reset
+        """
+
+        lookups = self.hits + self.misses
+
+        if lookups == 0:
+            return 0.0
+
+        return self.hits / lookups
+
+    def resetStatistics(self):
+        """
+        Reset the hit and miss counts, e.g. at the start of a search.
+        """
+
+        self.hits = 0
+
+        self.misses = 0
+
+    def clear(self):
+        """
+        Remove every stored position.
+        """
+
+        self.entries.clear()
+
+        self.resetStatistics()
@@ -30,132 +30,103 @@ def parseResult(result):
         raise Exception("Unexpected result string {}. Exiting".format(result))
 
 
-def encodePosition(board):
+def encodePosition(board, planes=None, mirror=False):
     """
     Encodes a chess position as a vector. The first 12 planes represent
     the different pieces. The next 4 represent castling rights.
+    The piece planes are unpacked straight from the board's bitboards,
+    bit n of a bitboard being square n, i.e. rank n // 8 and file n % 8.
 
     Args:
         board (chess.Board) the position to be encoded.
+        planes (numpy.array (16,8,8) float32) optional buffer to write the
+            encoding into, e.g. one entry of a preallocated batch.
+        mirror (bool) whether to encode board.mirror() instead, without
+            building the mirrored board.
 
     Returns:
         planes (numpy.array (16,8,8) float32) the array encoding this position
     """
-    planes = np.zeros((16, 8, 8), dtype=np.float32)
-
-    # white pawns
-    wPawns = board.pieces(chess.PAWN, chess.WHITE)
-    wPawns = [(chess.square_rank(sq), chess.square_file(sq)) for sq in wPawns]
-    for r, f in wPawns:
-        planes[0, r, f] = 1.0
-
-    # black pawns
-    bPawns = board.pieces(chess.PAWN, chess.BLACK)
-    bPawns = [(chess.square_rank(sq), chess.square_file(sq)) for sq in bPawns]
-    for r, f in bPawns:
-        planes[1, r, f] = 1.0
-
-    # white rooks
-    wRooks = board.pieces(chess.ROOK, chess.WHITE)
-    wRooks = [(chess.square_rank(sq), chess.square_file(sq)) for sq in wRooks]
-    for r, f in wRooks:
-        planes[2, r, f] = 1.0
-
-    # black rooks
-    bRooks = board.pieces(chess.ROOK, chess.BLACK)
-    bRooks = [(chess.square_rank(sq), chess.square_file(sq)) for sq in bRooks]
-    for r, f in bRooks:
-        planes[3, r, f] = 1.0
-
-    # white bishops
-    wBishops = board.pieces(chess.BISHOP, chess.WHITE)
-    wBishops = [(chess.square_rank(sq), chess.square_file(sq)) for sq in wBishops]
-    for r, f in wBishops:
-        planes[4, r, f] = 1.0
-
-    # black bishops
-    bBishops = board.pieces(chess.BISHOP, chess.BLACK)
-    bBishops = [(chess.square_rank(sq), chess.square_file(sq)) for sq in bBishops]
-    for r, f in bBishops:
-        planes[5, r, f] = 1.0
-
-    # white knights
-    wKnights = board.pieces(chess.KNIGHT, chess.WHITE)
-    wKnights = [(chess.square_rank(sq), chess.square_file(sq)) for sq in wKnights]
-    for r, f in wKnights:
-        planes[6, r, f] = 1.0
-
-    # black knights
-    bKnights = board.pieces(chess.KNIGHT, chess.BLACK)
-    bKnights = [(chess.square_rank(sq), chess.square_file(sq)) for sq in bKnights]
-    for r, f in bKnights:
-        planes[7, r, f] = 1.0
-
-    # white queens
-    wQueens = board.pieces(chess.QUEEN, chess.WHITE)
-    wQueens = [(chess.square_rank(sq), chess.square_file(sq)) for sq in wQueens]
-    for r, f in wQueens:
-        planes[8, r, f] = 1.0
-
-    # black queens
-    bQueens = board.pieces(chess.QUEEN, chess.BLACK)
-    bQueens = [(chess.square_rank(sq), chess.square_file(sq)) for sq in bQueens]
-    for r, f in bQueens:
-        planes[9, r, f] = 1.0
-
-    # white kings
-    wKings = board.pieces(chess.KING, chess.WHITE)
-    wKings = [(chess.square_rank(sq), chess.square_file(sq)) for sq in wKings]
-    for r, f in wKings:
-        planes[10, r, f] = 1.0
-
-    # black kings
-    bKings = board.pieces(chess.KING, chess.BLACK)
-    bKings = [(chess.square_rank(sq), chess.square_file(sq)) for sq in bKings]
-    for r, f in bKings:
-        planes[11, r, f] = 1.0
+    if planes is None:
+        planes = np.empty((16, 8, 8), dtype=np.float32)
+
+    white = board.occupied_co[chess.WHITE]
+    black = board.occupied_co[chess.BLACK]
+
+    castling_squares = (chess.BB_H1, chess.BB_H8, chess.BB_A1, chess.BB_A8)
+
+    # Mirroring swaps the colors and flips the ranks
+    if mirror:
+        white, black = black, white
+        castling_squares = (chess.BB_H8, chess.BB_H1, chess.BB_A8, chess.BB_A1)
+
+    # Piece bitboards in plane order: pawns, rooks, bishops, knights,
+    # queens and kings, white then black
+    bitboards = np.array(
+        [
+            board.pawns & white,
+            board.pawns & black,
+            board.rooks & white,
+            board.rooks & black,
+            board.bishops & white,
+            board.bishops & black,
+            board.knights & white,
+            board.knights & black,
+            board.queens & white,
+            board.queens & black,
+            board.kings & white,
+            board.kings & black,
+        ],
+        dtype="<u8",
+    )
+
+    bits = np.unpackbits(bitboards.view(np.uint8), bitorder="little")
+
+    if mirror:
+        planes[:12] = bits.reshape(12, 8, 8)[:, ::-1, :]
+    else:
+        planes[:12] = bits.reshape(12, 8, 8)
+
+    castling_rights = board.clean_castling_rights()
 
     # white can kingside castle
-    if board.has_kingside_castling_rights(chess.WHITE):
-        planes[12, :, :] = 1.0
+    planes[12] = 1.0 if castling_rights & castling_squares[0] else 0.0
 
     # black can kingside castle
-    if board.has_kingside_castling_rights(chess.BLACK):
-        planes[13, :, :] = 1.0
+    planes[13] = 1.0 if castling_rights & castling_squares[1] else 0.0
 
     # white can queenside castle
-    if board.has_queenside_castling_rights(chess.WHITE):
-        planes[14, :, :] = 1.0
+    planes[14] = 1.0 if castling_rights & castling_squares[2] else 0.0
 
     # black can queenside castle
-    if board.has_queenside_castling_rights(chess.BLACK):
-        planes[15, :, :] = 1.0
+    planes[15] = 1.0 if castling_rights & castling_squares[3] else 0.0
 
     return planes
 
 
-def moveToIdx(move):
+def calcDirectionAndDistancePlane(from_square, to_square):
     """
-    Maps a legal move to an index in (72, 8, 8)
+    Maps a pair of squares to one of the 72 planes of the policy.
     Each of the 72 planes represents a different direction
     and distance: rook and bishop directions with distance (64 planes)
     and 8 horse directions.
-    The location in the plane specifies the start square.
 
     Args:
-        move (chess.Move) the move to be encoded.
+        from_square (int) the moves starting square
+        to_square (int) the moves destination square
 
     Returns:
-        directionAndDistancePlane (int) the plane the move maps to
-        from_rank (int) the moves starting rank
-        from_file (int) the moves starting file
+        directionAndDistancePlane (int) the plane the move maps to, or -1
+            if no queen or knight move connects the two squares
     """
 
-    from_rank = chess.square_rank(move.from_square)
-    from_file = chess.square_file(move.from_square)
+    from_rank = chess.square_rank(from_square)
+    from_file = chess.square_file(from_square)
+
+    to_rank = chess.square_rank(to_square)
+    to_file = chess.square_file(to_square)
 
-    to_rank = chess.square_rank(move.to_square)
-    to_file = chess.square_file(move.to_square)
+    directionAndDistancePlane = -1
 
     if from_rank == to_rank and from_file < to_file:
         directionPlane = 0
@@ -206,26 +177,125 @@ def moveToIdx(move):
     elif to_file - from_file == -1 and to_rank - from_rank == -2:
         directionAndDistancePlane = 71
 
-    return directionAndDistancePlane, from_rank, from_file # type: ignore
+    return directionAndDistancePlane
+
+
+def buildMoveIndexTable():
+    """
+    Builds the lookup table from a (from square, to square) pair to the
+    index of the move in the flattened (72, 8, 8) policy.
+
+    Returns:
+        table (numpy.array (64, 64) int64) the policy index of every square
+            pair, -1 where no queen or knight move connects the squares
+    """
+
+    table = np.full((64, 64), -1, dtype=np.int64)
+
+    for from_square in chess.SQUARES:
+        for to_square in chess.SQUARES:
+            plane = calcDirectionAndDistancePlane(from_square, to_square)
+
+            if plane != -1:
+                table[from_square, to_square] = plane * 64 + from_square
+
+    return table
+
+
+# Policy index of a move by its (from square, to square), built once at import
+moveIndexTable = buildMoveIndexTable()
+
+# Underpromotions share the policy index of the queen promotion (the pawn move),
+# as the network has no planes of its own for them. Their prior is the queen
+# promotion's prior scaled down, so they never outrank it.
+underpromotionPriorScale = 0.1
+
+
+def getMoveIndices(moves, mirror=False, priorScales=False):
+    """
+    Maps moves to their indices in the flattened (72, 8, 8) policy in one NumPy operation.
+
+    Args:
+        moves (list of chess.Move) the moves to be encoded
+        mirror (bool) whether to mirror the moves vertically first
+        priorScales (bool) whether to also return the factor each move's prior is scaled by
+
+    Returns:
+        indices (numpy.array (num_moves) int64) the policy index of each move
+        scales (numpy.array (num_moves) float32) the prior scale of each move,
+            underpromotionPriorScale for underpromotions and 1 otherwise, only if priorScales
+    """
+
+    num_moves = len(moves)
+
+    squares = np.fromiter(
+        (
+            square
+            for move in moves
+            for square in (move.from_square, move.to_square, move.promotion or 0)
+        ),
+        dtype=np.int64,
+        count=num_moves * 3,
+    ).reshape(num_moves, 3)
+
+    from_squares = squares[:, 0]
+    to_squares = squares[:, 1]
+
+    if mirror:
+        from_squares = from_squares ^ 56
+        to_squares = to_squares ^ 56
+
+    indices = moveIndexTable[from_squares, to_squares]
+
+    if not priorScales:
+        return indices
+
+    promotions = squares[:, 2]
+
+    scales = np.ones(num_moves, dtype=np.float32)
+    scales[(promotions != 0) & (promotions != chess.QUEEN)] = underpromotionPriorScale
+
+    return indices, scales
 
 
-def getLegalMoveMask(board):
+def moveToIdx(move):
+    """
+    Maps a legal move to an index in (72, 8, 8)
+    Each of the 72 planes represents a different direction
+    and distance: rook and bishop directions with distance (64 planes)
+    and 8 horse directions.
+    The location in the plane specifies the start square.
+
+    Args:
+        move (chess.Move) the move to be encoded.
+
+    Returns:
+        directionAndDistancePlane (int) the plane the move maps to
+        from_rank (int) the moves starting rank
+        from_file (int) the moves starting file
+    """
+
+    moveIdx = int(getMoveIndices([move])[0])
+
+    return moveIdx // 64, (moveIdx // 8) % 8, moveIdx % 8
+
+
+def getLegalMoveMask(board, mirror=False):
     """
     Returns a mask encoding the legal moves.
 
     Args:
         board (chess.Board) the chess position.
+        mirror (bool) whether to encode the legal moves mirrored vertically
 
     Returns:
         mask (numpy.array (72, 8, 8) int32) the legal move mask
     """
-    mask = np.zeros((72, 8, 8), dtype=np.int32)
+    mask = np.zeros(72 * 64, dtype=np.int32)
 
-    for move in board.legal_moves:
-        planeIdx, rankIdx, fileIdx = moveToIdx(move)
-        mask[planeIdx, rankIdx, fileIdx] = 1
+    mask[getMoveIndices(list(board.legal_moves), mirror)] = 1
 
-    return mask
+    return mask.reshape((72, 8, 8))
 
 
 def mirrorMove(move):
@@ -246,7 +316,7 @@ def mirrorMove(move):
 
     new_to_square = chess.square_mirror(to_square)
 
-    return chess.Move(new_from_square, new_to_square)
+    return chess.Move(new_from_square, new_to_square, move.promotion)
 
 
 def encodeTrainingPoint(board, move, winner):
@@ -283,12 +353,14 @@ def encodeTrainingPoint(board, move, winner):
     return positionPlanes, moveIdx, float(winner), mask
 
 
-def encodePositionForInference(board):
+def encodePositionForInference(board, positionPlanes=None):
     """
     Encodes a position as a vector.
 
     Args:
         board (chess.Board) the chess position.
+        positionPlanes (numpy.array shape=(16,8,8) dtype=float32) optional buffer
+            to write the encoded position into
 
     Returns:
         positionPlanes (numpy.array shape=(16,8,8) dtype=float32) the encoded position
@@ -296,39 +368,40 @@ def encodePositionForInference(board):
     """
 
     # Flip if black's turn
-    if not board.turn:
-        board = board.mirror()
+    positionPlanes = encodePosition(board, positionPlanes, mirror=not board.turn)
 
-    positionPlanes = encodePosition(board)
-
-    mask = getLegalMoveMask(board)
+    mask = getLegalMoveMask(board, mirror=not board.turn)
 
     return positionPlanes, mask
 
 
-def decodePolicyOutput(board, policy):
+def decodePolicyOutput(board, policy, moveIndices=None, priorScales=None):
     """
     Decode the policy output from the neural network.
 
     Args:
         board (chess.Board) the board
         policy (numpy.array) the policy output
+        moveIndices (numpy.array (num_moves) int64) the policy indices of the
+            legal moves, if they were already computed
+        priorScales (numpy.array (num_moves) float32) the prior scales of the
+            legal moves, computed along with moveIndices
 
+    Returns:
+        move_probabilities (numpy.array (num_moves) float32) the probability of each legal move
     """
 
-    move_probabilities = np.zeros(200, dtype=np.float32)
+    if moveIndices is None:
+        moveIndices, priorScales = getMoveIndices(
+            list(board.legal_moves), not board.turn, priorScales=True
+        )
 
-    num_moves = 0
+    move_probabilities = policy[moveIndices].astype(np.float32)
 
-    for idx, move in enumerate(board.legal_moves):
-        if not board.turn:
-            move = mirrorMove(move)
-        planeIdx, rankIdx, fileIdx = moveToIdx(move)
-        moveIdx = planeIdx * 64 + rankIdx * 8 + fileIdx
-        move_probabilities[idx] = policy[moveIdx]
-        num_moves += 1
+    if priorScales is not None:
+        move_probabilities *= priorScales
 
-    return move_probabilities[:num_moves]
+    return move_probabilities
 
 
 def callNeuralNetwork(board, neuralNetwork):
@@ -345,25 +418,11 @@ def callNeuralNetwork(board, neuralNetwork):
         move_probabilities (numpy.array (num_moves) float) the move probabilities
     """
 
-    position, mask = encodePositionForInference(board)
-
-    position = torch.from_numpy(position)[None, ...]
-
-    mask = torch.from_numpy(mask)[None, ...]
-
-    if cuda:
-        position = position.cuda()
-        mask = mask.cuda()
-
-    value, policy = neuralNetwork(position, policyMask=mask)
-
-    value = value.cpu().numpy()[0, 0]
+    value, move_probabilities = callNeuralNetworkBatched([board], neuralNetwork)
 
-    policy = policy.cpu().numpy()[0]
+    num_moves = board.legal_moves.count()
 
-    move_probabilities = decodePolicyOutput(board, policy)
-
-    return value, move_probabilities
+    return value[0], move_probabilities[0, :num_moves]
 
 
 def callNeuralNetworkBatched(boards, neuralNetwork):
@@ -381,16 +440,30 @@ def callNeuralNetworkBatched(boards, neuralNetwork):
 
     num_inputs = len(boards)
 
-    inputs = torch.zeros((num_inputs, 16, 8, 8), dtype=torch.float32)
+    positions = np.empty((num_inputs, 16, 8, 8), dtype=np.float32)
+
+    masks = np.zeros((num_inputs, 72 * 64), dtype=np.float32)
 
-    masks = torch.zeros((num_inputs, 72, 8, 8), dtype=torch.float32)
+    moveIndices = []
+
+    priorScales = []
 
     for i in range(num_inputs):
-        position, mask = encodePositionForInference(boards[i])
+        encodePosition(boards[i], positions[i], mirror=not boards[i].turn)
+
+        indices, scales = getMoveIndices(
+            list(boards[i].legal_moves), not boards[i].turn, priorScales=True
+        )
+
+        moveIndices.append(indices)
+
+        priorScales.append(scales)
+
+        masks[i, indices] = 1.0
 
-        inputs[i] = torch.from_numpy(position)
+    inputs = torch.from_numpy(positions)
 
-        masks[i] = torch.from_numpy(mask)
+    masks = torch.from_numpy(masks)
 
     if cuda:
         inputs = inputs.cuda()
@@ -405,7 +478,9 @@ def callNeuralNetworkBatched(boards, neuralNetwork):
     policy = policy.cpu().numpy()
 
     for i in range(num_inputs):
-        move_probabilities_tmp = decodePolicyOutput(boards[i], policy[i])
+        move_probabilities_tmp = decodePolicyOutput(
+            boards[i], policy[i], moveIndices[i], priorScales[i]
+        )
 
         move_probabilities[
             i, : move_probabilities_tmp.shape[0]
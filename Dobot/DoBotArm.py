@@ -1,9 +1,12 @@
 # /usr/bin/env python
 import Dobot.DobotDllType as dType
 import sys, os
+import math
 import time
 
-os.chdir(os.getcwd() + "\Dobot")  # type: ignore
+# The DLL is loaded from the Dobot folder, skipped when already in it
+if os.path.isdir(os.path.join(os.getcwd(), "Dobot")):
+    os.chdir(os.path.join(os.getcwd(), "Dobot"))
 sys.path.insert(1, "./DLL")
 
 CON_STR = {
@@ -13,17 +16,47 @@ CON_STR = {
 }
 
 
+# Returns the corners of a JUMP move: up from the start, across, and down to the end.
+# The arm lifts jumpHeight above the higher end, but not above zLimit.
+def jumpPath(start, end, jumpHeight, zLimit):
+    top = max(start[2], end[2]) + jumpHeight
+    top = max(min(top, zLimit), start[2], end[2])
+    return [
+        tuple(start[:3]),
+        (start[0], start[1], top),
+        (end[0], end[1], top),
+        tuple(end[:3]),
+    ]
+
+
 # Main control class for the DoBot Magician.
+# The backend is "dll" for the arm, or "sim" for the simulated arm in DobotSim.
 class DoBotArm:
-    def __init__(self, homeX, homeY, homeZ):
+    def __init__(self, homeX, homeY, homeZ, backend="dll"):
+        if backend == "sim":
+            import Dobot.DobotSim as DobotSim
+
+            self.dType = DobotSim
+        else:
+            self.dType = dType
         self.suction = False
         self.picking = False
         self.griping = False
-        self.api = dType.load()
+        self.api = self.dType.load()
         self.homeX = homeX
         self.homeY = homeY
         self.homeZ = homeZ
         self.connected = False
+        # Cartesian PTP speed (mm/s) and acceleration (mm/s^2), read from the arm on connect
+        self.ptpVelocity = 100
+        self.ptpAcceleration = 100
+        self.pollLead = 0.05  # Start polling this long before the predicted end of a move
+        self.pollInterval = 0.01  # Poll interval once polling started
+        self.timeoutFactor = 2.0  # A wait times out after this many times the predicted duration
+        self.timeoutMargin = 5.0  # Plus this many seconds
+        self.lastWait = None  # (predicted, actual) duration of the last wait
+        self.jumpHeight = 20  # JUMP move lift height and highest z, read from the arm on connect
+        self.zLimit = 100
         self.dobotConnect()
 
     def __del__(self):
@@ -34,11 +67,12 @@ class DoBotArm:
         if self.connected:
             print("You're already connected")
         else:
-            state = dType.ConnectDobot(self.api, "", 115200)[0]
+            state = self.dType.ConnectDobot(self.api, "", 115200)[0]
             if state == dType.DobotConnect.DobotConnect_NoError:  # type: ignore
                 print("Connect status:", CON_STR[state])
-                dType.SetQueuedCmdClear(self.api)
+                self.dType.SetQueuedCmdClear(self.api)
                 self.connected = True
+                self.loadMotionParams()
                 return self.connected
             else:
                 print("Unable to connect")
@@ -49,20 +83,20 @@ class DoBotArm:
         if self.connected:
             print("You're already connected")
         else:
-            state = dType.ConnectDobot(self.api, "", 115200)[0]
+            state = self.dType.ConnectDobot(self.api, "", 115200)[0]
             if state == dType.DobotConnect.DobotConnect_NoError:  # type: ignore
                 print("Connect status:", CON_STR[state])
-                dType.SetQueuedCmdClear(self.api)
+                self.dType.SetQueuedCmdClear(self.api)
 
-                dType.SetHOMEParams(
+                self.dType.SetHOMEParams(
                     self.api, self.homeX, self.homeY, self.homeZ, 0, isQueued=1
                 )
-                dType.SetPTPJointParams(
+                self.dType.SetPTPJointParams(
                     self.api, 200, 200, 200, 200, 200, 200, 200, 200, isQueued=1
                 )
-                dType.SetPTPCommonParams(self.api, 100, 100, isQueued=1)
+                self.dType.SetPTPCommonParams(self.api, 100, 100, isQueued=1)
 
-                dType.SetHOMECmd(self.api, temp=0, isQueued=1)
+                self.dType.SetHOMECmd(self.api, temp=0, isQueued=1)
                 self.connected = True
                 return self.connected
             else:
@@ -72,26 +106,71 @@ class DoBotArm:
 
     # Returns to home location and then disconnects
     def dobotDisconnect(self):
+        if not self.connected:
+            return
         self.moveHome()
-        dType.DisconnectDobot(self.api)
+        self.dType.DisconnectDobot(self.api)
+        self.connected = False
+
+    # Reads the PTP speed and acceleration used to predict how long moves take
+    def loadMotionParams(self):
+        xyzVelocity, rVelocity, xyzAcceleration, rAcceleration = (
+            self.dType.GetPTPCoordinateParams(self.api)
+        )
+        velocityRatio, accelerationRatio = self.dType.GetPTPCommonParams(self.api)
+        self.ptpVelocity = max(xyzVelocity * velocityRatio / 100, 1)
+        self.ptpAcceleration = max(xyzAcceleration * accelerationRatio / 100, 1)
+        self.jumpHeight, self.zLimit = self.dType.GetPTPJumpParams(self.api)
+
+    # Predicts the duration of a straight move with a trapezoidal speed profile
+    def estimateMoveTime(self, start, end):
+        distance = math.dist(start[:3], end[:3])
+        v = self.ptpVelocity
+        a = self.ptpAcceleration
+        if distance >= v * v / a:
+            return distance / v + v / a  # Accelerates, cruises and decelerates
+        return 2 * math.sqrt(distance / a)  # Too short to reach full speed
+
+    # Predicts the duration of a JUMP move as its three straight parts
+    def estimateJumpTime(self, path):
+        return sum(self.estimateMoveTime(a, b) for a, b in zip(path, path[1:]))
 
     # Delays commands
-    def waitCommand(self, cmdIndex):
-        dType.SetQueuedCmdStartExec(self.api)
-        while cmdIndex > dType.GetQueuedCmdCurrentIndex(self.api)[0]:
-            dType.time.sleep(0.1)
-        dType.SetQueuedCmdStopExec(self.api)
+    def waitCommand(self, cmdIndex, expectedDuration=0.0, timeout=None):
+        if timeout is None:
+            timeout = expectedDuration * self.timeoutFactor + self.timeoutMargin
+        start = self.dType.time.monotonic()
+        self.dType.SetQueuedCmdStartExec(self.api)
+        try:
+            # Sleep through most of the move, then poll finely until it finishes
+            if expectedDuration > self.pollLead:
+                self.dType.time.sleep(expectedDuration - self.pollLead)
+            while cmdIndex > self.dType.GetQueuedCmdCurrentIndex(self.api)[0]:
+                if self.dType.time.monotonic() - start > timeout:
+                    raise TimeoutError(
+                        "Command {} did not finish within {:.1f} s".format(
+                            cmdIndex, timeout
+                        )
+                    )
+                self.dType.time.sleep(self.pollInterval)
+        finally:
+            self.dType.SetQueuedCmdStopExec(self.api)
+        self.lastWait = (expectedDuration, self.dType.time.monotonic() - start)
 
     # Moves arm to X/Y/Z/R Location
     def moveArmXYR(self, x, y, r):
-        lastIndex = dType.SetPTPCmd(
+        duration = self.estimateMoveTime(self.getPos(), (x, y, self.homeZ))
+        lastIndex = self.dType.SetPTPCmd(
             self.api, dType.PTPMode.PTPMOVLXYZMode, x, y, self.homeZ, r  # type: ignore
         )[0]
-        self.waitCommand(lastIndex)
+        self.waitCommand(lastIndex, duration)
 
     # Returns to home location
     def moveHome(self):
-        lastIndex = dType.SetPTPCmd(
+        duration = self.estimateMoveTime(
+            self.getPos(), (self.homeX, self.homeY, self.homeZ)
+        )
+        lastIndex = self.dType.SetPTPCmd(
             self.api,
             dType.PTPMode.PTPMOVJXYZMode,  # type: ignore
             self.homeX,
@@ -99,12 +178,12 @@ class DoBotArm:
             self.homeZ,
             0,
         )[0]
-        self.waitCommand(lastIndex)
+        self.waitCommand(lastIndex, duration)
 
     # ============================================================================
     def pick(self, itemHeight):
-        positions = dType.GetPose(self.api)
-        cmdIndex = dType.SetPTPCmd(
+        positions = self.dType.GetPose(self.api)
+        cmdIndex = self.dType.SetPTPCmd(
             self.api,
             dType.PTPMode.PTPMOVLXYZMode,  # type: ignore
             positions[0],
@@ -112,7 +191,10 @@ class DoBotArm:
             itemHeight,
             1,
         )[0]
-        self.waitCommand(cmdIndex)
+        duration = self.estimateMoveTime(
+            positions, (positions[0], positions[1], itemHeight)
+        )
+        self.waitCommand(cmdIndex, duration)
 
     # ============================================================================
     def toggleGrip(self):
@@ -122,9 +204,11 @@ class DoBotArm:
     # ============================================================================
     def setGrip(self, state=False):
         self.griping = state
-        cmdIndex = dType.SetEndEffectorGripper(self.api, True, state, isQueued=0)[0]
+        cmdIndex = self.dType.SetEndEffectorGripper(
+            self.api, True, state, isQueued=0
+        )[0]
         self.waitCommand(cmdIndex)
-        dType.time.sleep(200)
+        self.dType.time.sleep(200)
         self.setSuction(False)
 
     # ============================================================================
@@ -135,23 +219,182 @@ class DoBotArm:
     # ============================================================================
     def setSuction(self, state=False):
         self.suction = state
-        cmdIndex = dType.SetEndEffectorSuctionCup(self.api, True, state, isQueued=0)[0]
+        cmdIndex = self.dType.SetEndEffectorSuctionCup(
+            self.api, True, state, isQueued=0
+        )[0]
         self.waitCommand(cmdIndex)
 
     # ============================================================================
     def getPos(self):
-        return dType.GetPose(self.api)
+        return self.dType.GetPose(self.api)
 
     # ============================================================================
     def move_arm_xy_linear(self, x, y):
-        lastIndex = dType.SetPTPCmd(
+        duration = self.estimateMoveTime(self.getPos(), (x, y, self.homeZ))
+        lastIndex = self.dType.SetPTPCmd(
             self.api, dType.PTPMode.PTPMOVLXYZMode, x, y, self.homeZ, 0  # type: ignore
         )[0]
-        self.waitCommand(lastIndex)
+        self.waitCommand(lastIndex, duration)
 
     # ============================================================================
     def moveArmXYR_jump(self, x, y, r):
-        lastIndex = dType.SetPTPCmd(
+        duration = self.estimateMoveTime(self.getPos(), (x, y, self.homeZ))
+        lastIndex = self.dType.SetPTPCmd(
             self.api, dType.PTPMode.PTPMOVJXYZMode, x, y, self.homeZ, r  # type: ignore
         )[0]
-        self.waitCommand(lastIndex)
+        self.waitCommand(lastIndex, duration)
+
+    # ============================================================================
+    def moveArmXYZR_jump(self, x, y, z, r):
+        duration = self.estimateMoveTime(self.getPos(), (x, y, z))
+        lastIndex = self.dType.SetPTPCmd(
+            self.api, dType.PTPMode.PTPMOVJXYZMode, x, y, z, r  # type: ignore
+        )[0]
+        self.waitCommand(lastIndex, duration)
+
+    # Sets how high JUMP moves lift, skipped when unchanged
+    def setJumpParams(self, jumpHeight, zLimit):
+        if (jumpHeight, zLimit) == (self.jumpHeight, self.zLimit):
+            return
+        self.dType.SetPTPJumpParams(self.api, jumpHeight, zLimit, isQueued=0)
+        self.jumpHeight = jumpHeight
+        self.zLimit = zLimit
+
+    # Lifts, travels and descends to X/Y/Z/R in one move
+    def jumpToXYZR(self, x, y, z, r):
+        path = jumpPath(self.getPos(), (x, y, z), self.jumpHeight, self.zLimit)
+        lastIndex = self.dType.SetPTPCmd(
+            self.api, dType.PTPMode.PTPJUMPXYZMode, x, y, z, r  # type: ignore
+        )[0]
+        self.waitCommand(lastIndex, self.estimateJumpTime(path))
+
+
+# Builds a whole arm move out of queued commands and runs it with a single wait.
+# It has the same motion methods as DoBotArm, so the DrDRA helpers accept either.
+# A dry run plan sends nothing to the arm and starts at home, it is used to compare paths.
+class MotionPlan:
+    def __init__(self, arm, dryRun=False):
+        self.arm = arm
+        self.dType = arm.dType
+        self.api = arm.api
+        self.homeX = arm.homeX
+        self.homeY = arm.homeY
+        self.homeZ = arm.homeZ
+        self.suction = arm.suction
+        self.lastIndex = None
+        self.commands = 0
+        self.duration = 0.0  # Predicted duration of the queued moves
+        self.dryRun = dryRun
+        self.jumpHeight = arm.jumpHeight
+        self.zLimit = arm.zLimit
+        # The pose the arm will be at after the commands queued so far
+        if dryRun:
+            self.x, self.y, self.z, self.r = self.homeX, self.homeY, self.homeZ, 0
+        else:
+            self.x, self.y, self.z, self.r = arm.getPos()[:4]
+        self.waypoints = [(self.x, self.y, self.z)]  # Every pose the plan passes through
+
+    # Queues a point to point command and remembers where it ends
+    def queuePTP(self, mode, x, y, z, r):
+        if not self.dryRun:
+            self.lastIndex = self.dType.SetPTPCmd(
+                self.api, mode, x, y, z, r, isQueued=1
+            )[0]
+        self.duration += self.arm.estimateMoveTime((self.x, self.y, self.z), (x, y, z))
+        self.x, self.y, self.z, self.r = x, y, z, r
+        self.waypoints.append((x, y, z))
+        self.commands += 1
+
+    # Moves arm to X/Y/Z/R Location
+    def moveArmXYR(self, x, y, r):
+        self.queuePTP(dType.PTPMode.PTPMOVLXYZMode, x, y, self.homeZ, r)  # type: ignore
+
+    # Returns to home location
+    def moveHome(self):
+        self.queuePTP(
+            dType.PTPMode.PTPMOVJXYZMode,  # type: ignore
+            self.homeX,
+            self.homeY,
+            self.homeZ,
+            0,
+        )
+
+    # ============================================================================
+    def pick(self, itemHeight):
+        # Descends from where the previous queued command ends, not the current pose
+        self.queuePTP(
+            dType.PTPMode.PTPMOVLXYZMode, self.x, self.y, itemHeight, 1  # type: ignore
+        )
+
+    # ============================================================================
+    def toggleSuction(self):
+        self.suction = not self.suction
+        self.setSuction(self.suction)
+
+    # ============================================================================
+    def setSuction(self, state=False):
+        self.suction = state
+        if not self.dryRun:
+            self.lastIndex = self.dType.SetEndEffectorSuctionCup(
+                self.api, True, state, isQueued=1
+            )[0]
+        self.commands += 1
+
+    # ============================================================================
+    def getPos(self):
+        return [self.x, self.y, self.z, self.r]
+
+    # ============================================================================
+    def move_arm_xy_linear(self, x, y):
+        self.queuePTP(dType.PTPMode.PTPMOVLXYZMode, x, y, self.homeZ, 0)  # type: ignore
+
+    # ============================================================================
+    def moveArmXYR_jump(self, x, y, r):
+        self.queuePTP(dType.PTPMode.PTPMOVJXYZMode, x, y, self.homeZ, r)  # type: ignore
+
+    # ============================================================================
+    def moveArmXYZR_jump(self, x, y, z, r):
+        self.queuePTP(dType.PTPMode.PTPMOVJXYZMode, x, y, z, r)  # type: ignore
+
+    # Sets how high the following JUMP moves lift, skipped when unchanged
+    def setJumpParams(self, jumpHeight, zLimit):
+        if (jumpHeight, zLimit) == (self.jumpHeight, self.zLimit):
+            return
+        if not self.dryRun:
+            self.lastIndex = self.dType.SetPTPJumpParams(
+                self.api, jumpHeight, zLimit, isQueued=1
+            )[0]
+        self.jumpHeight = jumpHeight
+        self.zLimit = zLimit
+        self.commands += 1
+
+    # Lifts, travels and descends to X/Y/Z/R in one move
+    def jumpToXYZR(self, x, y, z, r):
+        path = jumpPath(self.getPos(), (x, y, z), self.jumpHeight, self.zLimit)
+        if not self.dryRun:
+            self.lastIndex = self.dType.SetPTPCmd(
+                self.api,
+                dType.PTPMode.PTPJUMPXYZMode,  # type: ignore
+                x,
+                y,
+                z,
+                r,
+                isQueued=1,
+            )[0]
+        self.duration += self.arm.estimateJumpTime(path)
+        self.x, self.y, self.z, self.r = x, y, z, r
+        self.waypoints.extend(path[1:])
+        self.commands += 1
+
+    # Runs every queued command and waits once for the last one
+    def execute(self):
+        if self.dryRun:
+            return
+        if self.lastIndex is not None:
+            self.arm.waitCommand(self.lastIndex, self.duration)
+        self.arm.suction = self.suction
+        self.arm.jumpHeight = self.jumpHeight
+        self.arm.zLimit = self.zLimit
+        self.lastIndex = None
+        self.commands = 0
+        self.duration = 0.0
@@ -687,45 +687,32 @@ def DobotExec(api):
     return [api.DobotExec()]
 
 
-def GetQueuedCmdCurrentIndex(api):
+def GetQueuedCmdCurrentIndex(api, retries=5, retryDelay=0.05):
+    # Retries a bounded number of times, so a lost connection raises instead of stalling forever
+    def getIndex(slave, queuedCmdIndex):
+        for i in range(retries + 1):
+            result = api.GetQueuedCmdCurrentIndex(
+                c_int(masterId), c_int(slave), byref(queuedCmdIndex)
+            )
+            if result == DobotCommunicate.DobotCommunicate_NoError:
+                return
+            time.sleep(retryDelay)
+        raise TimeoutError(
+            "GetQueuedCmdCurrentIndex failed {} times (error {})".format(
+                retries + 1, result
+            )
+        )
+
     queuedCmdIndex = c_uint64(0)
     queuedCmdIndex1 = c_uint64(0)
     if masterDevType == DevType.Conntroller and slaveDevType == DevType.MagicianLite:
         # if isUsingLinearRail:
-        while True:
-            result = api.GetQueuedCmdCurrentIndex(
-                c_int(masterId), c_int(-1), byref(queuedCmdIndex1)
-            )
-            if result != DobotCommunicate.DobotCommunicate_NoError:
-                time.sleep(2)
-                continue
-            break
-        while True:
-            result = api.GetQueuedCmdCurrentIndex(
-                c_int(masterId), c_int(slaveId), byref(queuedCmdIndex)
-            )
-            if result != DobotCommunicate.DobotCommunicate_NoError:
-                time.sleep(2)
-                continue
-            break
+        getIndex(-1, queuedCmdIndex1)
+        getIndex(slaveId, queuedCmdIndex)
     elif masterDevType == DevType.Conntroller and slaveDevType == DevType.Idle:
-        while True:
-            result = api.GetQueuedCmdCurrentIndex(
-                c_int(masterId), c_int(-1), byref(queuedCmdIndex1)
-            )
-            if result != DobotCommunicate.DobotCommunicate_NoError:
-                time.sleep(2)
-                continue
-            break
+        getIndex(-1, queuedCmdIndex1)
     else:
-        while True:
-            result = api.GetQueuedCmdCurrentIndex(
-                c_int(masterId), c_int(slaveId), byref(queuedCmdIndex)
-            )
-            if result != DobotCommunicate.DobotCommunicate_NoError:
-                time.sleep(2)
-                continue
-            break
+        getIndex(slaveId, queuedCmdIndex)
     return [queuedCmdIndex.value, queuedCmdIndex1.value]
 
 
@@ -0,0 +1,236 @@
+# /usr/bin/env python
+# A simulated Dobot Magician with the same functions as DobotDllType, for running without the arm.
+# It models the command queue and how long every command takes from the PTP params,
+# and runs on a virtual clock, so a whole game is simulated in a moment.
+from Dobot.DobotDllType import DobotConnect, PTPMode
+from collections import deque
+import math
+import time as systemTime
+
+realTime = False  # Sleep for real as well, e.g. to watch a game at the arm's speed
+commandOverhead = 0.01  # Seconds every queued command takes on top of its motion
+suctionTime = 0.1  # Seconds the suction cup valve takes to switch
+
+
+# The clock the simulated arm runs on, it only moves forward when slept on
+class VirtualTime:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        seconds = max(seconds, 0)
+        if realTime:
+            systemTime.sleep(seconds)
+        self.now += seconds
+
+
+time = VirtualTime()
+
+
+# The state of one simulated arm, returned by load() in place of the DLL
+class SimulatedDobot:
+    def __init__(self):
+        self.connected = False
+        self.queue = deque()  # Queued commands as (index, kind, params)
+        self.lastIndex = 0  # Index of the last queued command
+        self.currentIndex = 0  # Index of the last finished command
+        self.executing = False
+        self.cursor = 0.0  # The time the queue has been run up to
+        self.pose = [200.0, 0.0, 50.0, 0.0]
+        self.home = [200.0, 0.0, 50.0, 0.0]
+        self.suction = False
+        self.gripper = False
+        # [xyzVelocity, rVelocity, xyzAcceleration, rAcceleration], as reported by the arm
+        self.coordinateParams = [200.0, 200.0, 200.0, 200.0]
+        self.commonParams = [50.0, 50.0]  # [velocityRatio, accelerationRatio]
+        self.jumpParams = [20.0, 100.0]  # [jumpHeight, zLimit]
+        self.log = []  # Finished commands as (index, kind, start, end)
+
+    # Predicts the duration of a straight move with a trapezoidal speed profile
+    def moveTime(self, start, end):
+        distance = math.dist(start[:3], end[:3])
+        v = max(self.coordinateParams[0] * self.commonParams[0] / 100, 1)
+        a = max(self.coordinateParams[2] * self.commonParams[1] / 100, 1)
+        if distance >= v * v / a:
+            return distance / v + v / a
+        return 2 * math.sqrt(distance / a)
+
+    # Returns how long a command takes to run from the current pose
+    def duration(self, kind, params):
+        if kind == "ptp":
+            mode, x, y, z, r = params
+            if mode == PTPMode.PTPJUMPXYZMode:
+                # Up, across and down, as high as the jump params allow
+                jumpHeight, zLimit = self.jumpParams
+                top = max(self.pose[2], z) + jumpHeight
+                top = max(min(top, zLimit), self.pose[2], z)
+                path = [
+                    self.pose,
+                    (self.pose[0], self.pose[1], top),
+                    (x, y, top),
+                    (x, y, z),
+                ]
+                motion = sum(self.moveTime(a, b) for a, b in zip(path, path[1:]))
+            else:
+                motion = self.moveTime(self.pose, (x, y, z))
+            return motion + commandOverhead
+        if kind in ("suction", "gripper"):
+            return suctionTime + commandOverhead
+        if kind == "home":
+            return self.moveTime(self.pose, self.home) + commandOverhead
+        return commandOverhead
+
+    # Applies the effect of a finished command
+    def apply(self, kind, params):
+        if kind == "ptp":
+            self.pose = list(params[1:])
+        elif kind == "home":
+            self.pose = list(self.home)
+        elif kind == "suction":
+            self.suction = params
+        elif kind == "gripper":
+            self.gripper = params
+        elif kind == "coordinateParams":
+            self.coordinateParams = list(params)
+        elif kind == "commonParams":
+            self.commonParams = list(params)
+        elif kind == "jumpParams":
+            self.jumpParams = list(params)
+        elif kind == "homeParams":
+            self.home = list(params)
+
+    # Runs the queue up to the current time
+    def advance(self):
+        now = time.monotonic()
+        while self.executing and self.queue:
+            index, kind, params = self.queue[0]
+            end = self.cursor + self.duration(kind, params)
+            if end > now:
+                return
+            self.queue.popleft()
+            self.apply(kind, params)
+            self.log.append((index, kind, self.cursor, end))
+            self.currentIndex = index
+            self.cursor = end
+        self.cursor = now  # Idle until the next command
+
+    # Queues a command, or applies it right away if it is not queued
+    def command(self, kind, params, isQueued):
+        self.advance()
+        if not isQueued and kind != "ptp":
+            self.apply(kind, params)
+            return [0]
+        # Motion always goes through the queue, the arm can only do one move at a time
+        self.lastIndex += 1
+        if not self.queue:
+            self.cursor = time.monotonic()
+        self.queue.append((self.lastIndex, kind, params))
+        return [self.lastIndex]
+
+
+def load():
+    return SimulatedDobot()
+
+
+def ConnectDobot(api, portName, baudrate):
+    api.connected = True
+    return [DobotConnect.DobotConnect_NoError, 0, 0, 0, 0, 0, 0, 0]
+
+
+def DisconnectDobot(api):
+    api.advance()
+    api.connected = False
+
+
+def SetQueuedCmdClear(api):
+    api.advance()
+    api.queue.clear()
+
+
+def SetQueuedCmdStartExec(api):
+    api.advance()
+    if not api.executing:
+        api.executing = True
+        api.cursor = time.monotonic()
+
+
+def SetQueuedCmdStopExec(api):
+    api.advance()
+    api.executing = False
+
+
+def GetQueuedCmdCurrentIndex(api, retries=5, retryDelay=0.05):
+    api.advance()
+    return [api.currentIndex, 0]
+
+
+def GetPose(api):
+    api.advance()
+    return list(api.pose) + [0.0, 0.0, 0.0, 0.0]
+
+
+def SetPTPCmd(api, ptpMode, x, y, z, rHead, isQueued=0):
+    return api.command("ptp", (ptpMode, x, y, z, rHead), isQueued)
+
+
+def SetHOMEParams(api, x, y, z, r, isQueued=0):
+    return api.command("homeParams", (x, y, z, r), isQueued)
+
+
+def SetHOMECmd(api, temp, isQueued=0):
+    return api.command("home", None, True)
+
+
+def SetPTPJointParams(api, *params, isQueued=0):
+    return api.command("jointParams", params, isQueued)
+
+
+def SetPTPCoordinateParams(
+    api, xyzVelocity, xyzAcceleration, rVelocity, rAcceleration, isQueued=0
+):
+    return api.command(
+        "coordinateParams",
+        (xyzVelocity, rVelocity, xyzAcceleration, rAcceleration),
+        isQueued,
+    )
+
+
+def GetPTPCoordinateParams(api):
+    return list(api.coordinateParams)
+
+
+def SetPTPCommonParams(api, velocityRatio, accelerationRatio, isQueued=0):
+    return api.command("commonParams", (velocityRatio, accelerationRatio), isQueued)
+
+
+def GetPTPCommonParams(api):
+    return list(api.commonParams)
+
+
+def SetPTPJumpParams(api, jumpHeight, zLimit, isQueued=0):
+    return api.command("jumpParams", (jumpHeight, zLimit), isQueued)
+
+
+def GetPTPJumpParams(api):
+    return list(api.jumpParams)
+
+
+def SetEndEffectorSuctionCup(api, enableCtrl, on, isQueued=0):
+    return api.command("suction", bool(on), isQueued)
+
+
+def SetEndEffectorGripper(api, enableCtrl, on, isQueued=0):
+    return api.command("gripper", bool(on), isQueued)
+
+
+# Returns how long the simulated arm has been moving, for benchmarks
+def GetSimStats(api):
+    api.advance()
+    busy = sum(end - start for index, kind, start, end in api.log)
+    return {"commands": len(api.log), "busy_time": busy, "time": time.monotonic()}
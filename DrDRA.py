@@ -2,6 +2,8 @@
 This module contains the functions that control the robotic arm.
 """
 
+import math
+import chess
 import Dobot.DoBotArm as db
 import xmltodict
 
@@ -10,13 +12,35 @@ home_graveyard_coordinate = (0, 0, 0)  # Initialize the home and graveyard coord
 calibration_coordinate = (0, 0, 0)  # Initialize the calibration coordinate
 z_picked = 80  # The height of the piece when it is picked up
 
+# Approximate piece heights in mm, used to find the lowest safe height to carry a piece at
+piece_heights = {"p": 22, "n": 28, "b": 30, "r": 24, "q": 34, "k": 38}
+clearance_margin = 10  # Extra height in mm kept between a carried piece and the pieces below
+cell_size = 25  # The size of a board cell in mm
+arm_links = (135, 147)  # The lengths of the rear arm and the forearm of the Dobot in mm
+tool_offset = 59.7  # The horizontal offset of the suction cup from the wrist in mm
+last_move_report = None  # The path length and time of the last move, planned and sequential
 
-def init_arm(xml_file_path: str):
+# The highest z of every JUMP move between cells. It is the same for every piece for simplicity,
+# so the lifts below are capped at z_picked, the height the pieces have always been carried at
+jump_z_limit = z_picked
+
+# The JUMP move lift above the higher end of the move, by the type of the carried piece
+# ("" when nothing is carried, None when the carried piece is not known).
+# The lift clears the tallest piece with the carried piece below the suction cup, as get_clearance does
+tallest_piece = max(piece_heights.values())  # The height of the tallest piece in mm
+jump_heights = {
+    piece: tallest_piece + height + clearance_margin
+    for piece, height in [("", 0), *piece_heights.items(), (None, tallest_piece)]
+}
+
+
+def init_arm(xml_file_path: str, backend: str = "dll"):
     """
     Initializes the DoBot arm.
 
     Args:
-    -   None
+    -   xml_file_path (str): The path to the XML file of the cell coordinates.
+    -   backend (str): "dll" for the arm, or "sim" for the simulated arm.
 
     Returns:
     -   arm (DoBotArm): The initialized DoBot arm object.
@@ -28,6 +52,7 @@ def init_arm(xml_file_path: str):
         home_graveyard_coordinate[0],
         home_graveyard_coordinate[1],
         home_graveyard_coordinate[2],
+        backend,
     )
 
     arm.setSuction(False)
@@ -107,7 +132,7 @@ def move_arm_Z(arm: db.DoBotArm, z: float):
     Moves the arm to a specified height in the Z-axis.
 
     Args:
-    -   arm (db.DoBotArm): The DoBotArm object representing the robotic arm.
+    -   arm (db.DoBotArm or db.MotionPlan): The DoBotArm object representing the robotic arm.
     -   z (float): The desired height in the Z-axis.
 
     Returns:
@@ -122,7 +147,7 @@ def toggle_suction(arm: db.DoBotArm):
     Toggles the suction on the DoBotArm.
 
     Args:
-    -   arm (db.DoBotArm): The DoBotArm object to toggle the suction on.
+    -   arm (db.DoBotArm or db.MotionPlan): The DoBotArm object to toggle the suction on.
 
     Returns:
     -   None
@@ -131,27 +156,12 @@ def toggle_suction(arm: db.DoBotArm):
     arm.toggleSuction()
 
 
-def move_arm_XYR(arm: db.DoBotArm, pos: tuple):
-    """
-    Moves the DoBot arm to the specified X, Y and R.
-
-    Args:
-    -   arm (db.DoBotArm): The DoBot arm object.
-    -   pos (tuple): A tuple containing the coordinates.
-
-    Returns:
-    -   None
-    """
-
-    arm.moveArmXYR(pos[0], pos[1], pos[3])
-
-
 def move_arm_XYR_jump(arm: db.DoBotArm, pos: tuple):
     """
     Moves the DoBot arm to the specified X, Y and R.
 
     Args:
-    -   arm (db.DoBotArm): The DoBot arm object.
+    -   arm (db.DoBotArm or db.MotionPlan): The DoBot arm object.
     -   pos (tuple): A tuple containing the coordinates.
 
     Returns:
@@ -166,7 +176,7 @@ def go_to_home(arm: db.DoBotArm):
     Moves the robotic arm to the home position.
 
     Args:
-    -   arm (db.DoBotArm): The robotic arm object.
+    -   arm (db.DoBotArm or db.MotionPlan): The robotic arm object.
 
     Returns:
     -   None
@@ -175,53 +185,56 @@ def go_to_home(arm: db.DoBotArm):
     arm.moveHome()
 
 
-def go_to_cell(arm: db.DoBotArm, pos: tuple):
+def jump_to(arm: db.DoBotArm, pos: tuple, jump_height: float, z_limit: float):
     """
-    Moves the DoBotArm to the specified cell position.
+    Lifts, moves and descends the DoBotArm to the specified position in one JUMP move.
 
     Args:
-    -   arm (db.DoBotArm): The DoBotArm object.
-    -   pos (tuple): The target cell position (x, y, z, r).
+    -   arm (db.DoBotArm or db.MotionPlan): The DoBotArm object.
+    -   pos (tuple): The target position (x, y, z, r).
+    -   jump_height (float): The lift above the higher end of the move.
+    -   z_limit (float): The highest z of the move.
 
     Returns:
     -   None
     """
 
-    move_arm_Z(arm, z_picked)
-    move_arm_XYR_jump(arm, pos)
-    move_arm_Z(arm, pos[2])
+    arm.setJumpParams(jump_height, z_limit)
+    arm.jumpToXYZR(pos[0], pos[1], pos[2], pos[3])
 
 
-def go_to_cell_str(arm: db.DoBotArm, move: str):
+def go_to_cell(arm: db.DoBotArm, pos: tuple, piece: str = None):  # type: ignore
     """
     Moves the DoBotArm to the specified cell position.
 
     Args:
-    -   arm (db.DoBotArm): The DoBotArm object.
-    -   pos (str): The target cell position in the format 'x_y'.
+    -   arm (db.DoBotArm or db.MotionPlan): The DoBotArm object.
+    -   pos (tuple): The target cell position (x, y, z, r).
+    -   piece (str): The type of the carried piece ("p", "n", ...), or None if it is not known.
 
     Returns:
     -   None
     """
 
-    go_to_cell(arm, coordinates_dict[move])
+    if not arm.suction:
+        piece = ""  # Nothing is carried
 
+    jump_to(arm, pos, jump_heights[piece], jump_z_limit)
 
-def go_to_cell_castling(arm: db.DoBotArm, pos: tuple):
+
+def go_to_cell_str(arm: db.DoBotArm, move: str):
     """
     Moves the DoBotArm to the specified cell position.
 
     Args:
-    -   arm (db.DoBotArm): The DoBotArm object.
-    -   pos (tuple): The target cell position (x, y, z, r).
+    -   arm (db.DoBotArm or db.MotionPlan): The DoBotArm object.
+    -   pos (str): The target cell position in the format 'x_y'.
 
     Returns:
     -   None
     """
 
-    # move_arm_Z(arm, z_picked)
-    move_arm_XYR(arm, pos)
-    move_arm_Z(arm, pos[2])
+    go_to_cell(arm, coordinates_dict[move])
 
 
 def go_to_calibration(arm: db.DoBotArm):
@@ -229,7 +242,7 @@ def go_to_calibration(arm: db.DoBotArm):
     Moves the robotic arm to the calibration position.
 
     Args:
-    -   arm (db.DoBotArm): The robotic arm object.
+    -   arm (db.DoBotArm or db.MotionPlan): The robotic arm object.
 
     Returns:
     -   None
@@ -238,14 +251,15 @@ def go_to_calibration(arm: db.DoBotArm):
     go_to_cell(arm, calibration_coordinate)
 
 
-def remove_killed(arm: db.DoBotArm, pos: tuple):
+def remove_killed(arm: db.DoBotArm, pos: tuple, piece: str = None):  # type: ignore
     """
     Moves the robotic arm to the specified position on the chessboard,
     removes the killed piece from that position, and moves the piece to the graveyard.
 
     Args:
-    -   arm (db.DoBotArm): The robotic arm object.
+    -   arm (db.DoBotArm or db.MotionPlan): The robotic arm object.
     -   pos (str): The position of the killed piece on the chessboard.
+    -   piece (str): The type of the killed piece ("p", "n", ...), or None if it is not known.
 
     Returns:
     -   None
@@ -253,21 +267,21 @@ def remove_killed(arm: db.DoBotArm, pos: tuple):
 
     go_to_cell(arm, pos)
     toggle_suction(arm)
-    move_arm_Z(arm, z_picked)
-    go_to_graveyard(arm)
+    go_to_graveyard(arm, piece)
 
 
-def go_to_graveyard(arm: db.DoBotArm):
+def go_to_graveyard(arm: db.DoBotArm, piece: str = None):  # type: ignore
     """
     Moves the robotic arm to the graveyard position.
 
     Args:
-    -   arm (db.DoBotArm): The robotic arm object.
+    -   arm (db.DoBotArm or db.MotionPlan): The robotic arm object.
+    -   piece (str): The type of the carried piece ("p", "n", ...), or None if it is not known.
 
     Returns:
     -   None
     """
-    go_to_home(arm)
+    go_to_cell(arm, (arm.homeX, arm.homeY, arm.homeZ, 0), piece)  # The graveyard is home
     toggle_suction(arm)
 
 
@@ -276,7 +290,7 @@ def castling_move(arm: db.DoBotArm, move: str):
     Applies castling on the chessboard using the robotic arm.
 
     Args:
-    -   arm (db.DoBotArm): The robotic arm object.
+    -   arm (db.DoBotArm or db.MotionPlan): The robotic arm object.
     -   move (str): The move to be applied in the format 'src_dest'.
 
     Returns:
@@ -284,42 +298,30 @@ def castling_move(arm: db.DoBotArm, move: str):
     """
     src_str = move[0] + move[1]
     dest_str = move[2] + move[3]
-    src = coordinates_dict[src_str]
-    dest = coordinates_dict[dest_str]
-
-    # go_to_cell(arm, src)
-    # toggle_suction(arm)
-    # go_to_cell(arm, dest)
-    # toggle_suction(arm)
+    rank = src_str[1]
 
-    if dest_str[0] == "a":
-        go_to_cell_castling(arm, src)
-        toggle_suction(arm)
-        move_arm_Z(arm, z_picked)
-        go_to_cell_castling(arm, coordinates_dict["c" + dest[1]])
-        toggle_suction(arm)
-        # move_arm_Z(arm, z_picked)
-        go_to_cell_castling(arm, dest)
-        toggle_suction(arm)
-        go_to_cell_castling(arm, coordinates_dict["d" + dest[1]])
-        toggle_suction(arm)
+    # The king's destination is either its own cell (e1g1) or the rook's cell (e1h1)
+    if dest_str[0] in ("a", "c"):
+        king_dest, rook_src, rook_dest = "c" + rank, "a" + rank, "d" + rank
     else:
-        go_to_cell_castling(arm, src)
-        toggle_suction(arm)
-        go_to_cell_castling(arm, coordinates_dict["g" + dest[1]])
-        toggle_suction(arm)
-        go_to_cell_castling(arm, dest)
-        toggle_suction(arm)
-        go_to_cell_castling(arm, coordinates_dict["f" + dest[1]])
-        toggle_suction(arm)
+        king_dest, rook_src, rook_dest = "g" + rank, "h" + rank, "f" + rank
 
+    go_to_cell(arm, coordinates_dict[src_str])
+    toggle_suction(arm)
+    go_to_cell(arm, coordinates_dict[king_dest], "k")
+    toggle_suction(arm)
+    go_to_cell(arm, coordinates_dict[rook_src])
+    toggle_suction(arm)
+    go_to_cell(arm, coordinates_dict[rook_dest], "r")
+    toggle_suction(arm)
 
-def apply_move(arm: db.DoBotArm, move: str, indicators: tuple):
+
+def apply_move_sequential(arm: db.DoBotArm, move: str, indicators: tuple):
     """
-    Applies the specified move on the chessboard using the robotic arm and goes back to the home position after finishing.
+    Applies the specified move with the fixed sequence of cell, graveyard and home moves, without planning.
 
     Args:
-    -   arm (db.DoBotArm): The robotic arm object.
+    -   arm (db.DoBotArm or db.MotionPlan): The robotic arm object.
     -   move (str): The move to be applied in the format 'src_dest'.
     -   indicators (tuple): A tuple containing the indicators for the move (killing, enpassant, castling).
 
@@ -345,6 +347,7 @@ def apply_move(arm: db.DoBotArm, move: str, indicators: tuple):
         go_to_cell(arm, src)
         toggle_suction(arm)
         go_to_cell(arm, dest)
+        toggle_suction(arm)
 
     if indicators[2] == True:
         castling_move(arm, move)
@@ -358,6 +361,286 @@ def apply_move(arm: db.DoBotArm, move: str, indicators: tuple):
     go_to_home(arm)
 
 
+def get_joint_angles(pos: tuple):
+    """
+    Approximates the base, rear arm and forearm angles of the Dobot at a position (inverse kinematics).
+
+    Args:
+    -   pos (tuple): The position (x, y, z, ...).
+
+    Returns:
+    -   tuple: The three joint angles in degrees.
+    """
+
+    base = math.atan2(pos[1], pos[0])  # The base turns towards the position
+
+    # Solve the two link arm in the vertical plane of the base
+    reach = math.hypot(pos[0], pos[1]) - tool_offset
+    distance = max(math.hypot(reach, pos[2]), 1e-6)
+    elevation = math.atan2(pos[2], reach)
+    cos_shoulder = (arm_links[0] ** 2 + distance**2 - arm_links[1] ** 2) / (
+        2 * arm_links[0] * distance
+    )
+    rear = elevation + math.acos(min(max(cos_shoulder, -1), 1))
+
+    # The forearm points from the elbow to the wrist
+    fore = math.atan2(
+        pos[2] - arm_links[0] * math.sin(rear), reach - arm_links[0] * math.cos(rear)
+    )
+
+    return math.degrees(base), 90 - math.degrees(rear), -math.degrees(fore)
+
+
+def get_path_length(waypoints: list):
+    """
+    Calculates the joint space length of a path.
+    The joints move together in a PTP move, so every segment counts the joint that turns the most.
+
+    Args:
+    -   waypoints (list): The positions (x, y, z) the path passes through.
+
+    Returns:
+    -   float: The length of the path in degrees.
+    """
+
+    length = 0.0
+    angles = [get_joint_angles(pos) for pos in waypoints]
+
+    for a, b in zip(angles, angles[1:]):
+        length += max(abs(b[i] - a[i]) for i in range(3))
+
+    return length
+
+
+def get_clearance(start: tuple, end: tuple, occupied: dict, carried: str = None):  # type: ignore
+    """
+    Finds the lowest height the arm can travel at between two positions without hitting a piece.
+    The path is approximated by interpolating the angle and distance around the base, as a joint move does.
+
+    Args:
+    -   start (tuple): The start position (x, y, z, ...).
+    -   end (tuple): The end position (x, y, z, ...).
+    -   occupied (dict): The piece type ("p", "n", ...) on every occupied cell, keyed by cell name.
+    -   carried (str): The type of the carried piece, or None if nothing is carried.
+
+    Returns:
+    -   float: The travel height.
+    """
+
+    carried_height = piece_heights[carried] if carried else 0
+
+    # The board below the start and the end itself has to be cleared
+    top = max(start[2], end[2]) if carried else min(start[2], end[2])
+
+    start_angle, end_angle = math.atan2(start[1], start[0]), math.atan2(end[1], end[0])
+    start_reach, end_reach = math.hypot(start[0], start[1]), math.hypot(end[0], end[1])
+
+    samples = []
+    for i in range(17):
+        angle = start_angle + (end_angle - start_angle) * i / 16
+        reach = start_reach + (end_reach - start_reach) * i / 16
+        samples.append((reach * math.cos(angle), reach * math.sin(angle)))
+
+    for cell, piece in occupied.items():
+        x, y, z = coordinates_dict[cell][:3]
+
+        # getPos returns a list of measured floats, so the ends are matched to the cells by distance
+        if any(math.hypot(x - px, y - py) < cell_size / 2 for px, py in (start[:2], end[:2])):
+            continue  # The arm moves straight up and down above its own cells
+
+        # Only the pieces the carried piece or the suction cup passes over
+        if any(math.hypot(x - sx, y - sy) < cell_size * 0.75 for sx, sy in samples):
+            top = max(top, z + piece_heights[piece])
+
+    return top + carried_height + clearance_margin
+
+
+def get_occupied_cells(board: chess.Board):
+    """
+    Lists the occupied cells of a board.
+
+    Args:
+    -   board (chess.Board): The board.
+
+    Returns:
+    -   dict: The piece type ("p", "n", ...) on every occupied cell, keyed by cell name.
+    """
+
+    return {
+        chess.square_name(square): piece.symbol().lower()
+        for square, piece in board.piece_map().items()
+    }
+
+
+def get_transfers(board: chess.Board, move: chess.Move):
+    """
+    Lists the possible orders of the piece transfers a move needs.
+    A transfer to None takes the piece to the graveyard.
+
+    Args:
+    -   board (chess.Board): The board before the move.
+    -   move (chess.Move): The move.
+
+    Returns:
+    -   list: Every possible order, as a list of (src, dest) cell name pairs.
+    """
+
+    src = chess.square_name(move.from_square)
+    dest = chess.square_name(move.to_square)
+
+    if board.is_castling(move):
+        rank = src[1]
+        if board.is_kingside_castling(move):
+            rook = ("h" + rank, "f" + rank)
+        else:
+            rook = ("a" + rank, "d" + rank)
+        return [[(src, dest), rook], [rook, (src, dest)]]
+
+    if board.is_en_passant(move):
+        # The captured pawn is next to the source, on the file of the destination
+        passant = dest[0] + src[1]
+        return [[(passant, None), (src, dest)], [(src, dest), (passant, None)]]
+
+    if board.is_capture(move):
+        return [[(dest, None), (src, dest)]]  # The destination has to be cleared first
+
+    return [[(src, dest)]]
+
+
+def move_above(arm: db.DoBotArm, pos: tuple, clearance: float):
+    """
+    Lifts the arm to the travel height, moves it above a position and descends on it, in one JUMP move.
+
+    Args:
+    -   arm (db.DoBotArm or db.MotionPlan): The robotic arm object.
+    -   pos (tuple): The target position (x, y, z, r).
+    -   clearance (float): The travel height.
+
+    Returns:
+    -   None
+    """
+
+    higher_end = max(arm.getPos()[2], pos[2])
+
+    jump_to(arm, pos, max(clearance - higher_end, 0), max(clearance, higher_end))
+
+
+def apply_transfers(arm: db.DoBotArm, transfers: list, occupied: dict):
+    """
+    Carries the pieces of a move cell by cell at the lowest safe height and goes back home once at the end.
+
+    Args:
+    -   arm (db.DoBotArm or db.MotionPlan): The robotic arm object.
+    -   transfers (list): The (src, dest) cell name pairs, a dest of None is the graveyard.
+    -   occupied (dict): The piece type on every occupied cell, updated as the pieces are moved.
+
+    Returns:
+    -   None
+    """
+
+    home = (arm.homeX, arm.homeY, arm.homeZ, 0)
+
+    for src, dest in transfers:
+        piece = occupied.pop(src)
+        src_pos = coordinates_dict[src]
+
+        move_above(arm, src_pos, get_clearance(arm.getPos(), src_pos, occupied))
+        arm.setSuction(True)
+
+        if dest is None:
+            # The graveyard is the home position
+            move_above(arm, home, get_clearance(src_pos, home, occupied, piece))
+        else:
+            dest_pos = coordinates_dict[dest]
+            move_above(arm, dest_pos, get_clearance(src_pos, dest_pos, occupied, piece))
+            occupied[dest] = piece
+
+        arm.setSuction(False)
+
+    # Go home, unless the last piece was dropped in the graveyard
+    if math.dist(arm.getPos()[:3], home[:3]) >= cell_size / 2:
+        move_above(arm, home, get_clearance(arm.getPos(), home, occupied))
+
+
+def plan_move(arm: db.DoBotArm, board: chess.Board, move: str):
+    """
+    Finds the order of piece transfers with the shortest joint space path, and compares it with the sequential path.
+
+    Args:
+    -   arm (db.DoBotArm): The robotic arm object.
+    -   board (chess.Board): The board before the move.
+    -   move (str): The move in UCI format.
+
+    Returns:
+    -   list: The (src, dest) cell name pairs in the planned order.
+    -   dict: The joint space length in degrees and the estimated time in seconds of the planned and the sequential paths.
+    """
+
+    move_uci = chess.Move.from_uci(move)
+
+    occupied = get_occupied_cells(board)
+
+    best = None
+
+    for transfers in get_transfers(board, move_uci):
+        plan = db.MotionPlan(arm, dryRun=True)  # Only records the path
+        apply_transfers(plan, transfers, dict(occupied))
+        length = get_path_length(plan.waypoints)
+
+        if best is None or length < best[1]:
+            best = (transfers, length, plan.duration)
+
+    # The sequential path, with the same indicators as ce.check_indicators
+    indicators = (
+        board.is_capture(move_uci) and not board.is_en_passant(move_uci),
+        board.is_en_passant(move_uci),
+        board.is_castling(move_uci),
+    )
+    plan = db.MotionPlan(arm, dryRun=True)
+    apply_move_sequential(plan, move, indicators)
+
+    report = {
+        "planned_length": best[1],  # type: ignore
+        "planned_time": best[2],  # type: ignore
+        "sequential_length": get_path_length(plan.waypoints),
+        "sequential_time": plan.duration,
+    }
+
+    return best[0], report  # type: ignore
+
+
+def apply_move(
+    arm: db.DoBotArm, move: str, indicators: tuple, board: chess.Board = None  # type: ignore
+):
+    """
+    Applies the specified move on the chessboard using the robotic arm and goes back to the home position after finishing.
+    The whole move is queued on the arm as one motion plan and waited on once, instead of waiting after every segment.
+    With the board, the order of the piece transfers and the travel heights are planned to shorten the path.
+
+    Args:
+    -   arm (db.DoBotArm): The robotic arm object.
+    -   move (str): The move to be applied in the format 'src_dest'.
+    -   indicators (tuple): A tuple containing the indicators for the move (killing, enpassant, castling).
+    -   board (chess.Board): The board before the move, or None to apply the move sequentially.
+
+    Returns:
+    -   None
+    """
+
+    global last_move_report  # Make the move report global
+
+    plan = db.MotionPlan(arm)  # Queue the whole move, the helpers below only enqueue commands
+
+    if board is None:
+        apply_move_sequential(plan, move, indicators)
+    else:
+        transfers, last_move_report = plan_move(arm, board, move)
+
+        apply_transfers(plan, transfers, get_occupied_cells(board))
+
+    plan.execute()  # Run the queued move and wait for it to finish
+
+
 def disconnect(arm: db.DoBotArm):
     """
     Disconnects the Dobot arm.
@@ -8,6 +8,12 @@ import CE as ce  # Importing the chess engine module
 import C2M as c2m  # Importing the camera to moves module
 import DrDRA as dr  # Importing the arm module
 import webbrowser  # Importing the webbrowser module to open webpages
+import threading  # Importing the threading module to run the engine in the background
+import queue  # Importing the queue module to pass the engine's move back to the GUI
+import time  # Importing the time module to time the game clock
+import logging  # Importing the logging module to report what the background threads and the arm do
+
+logger = logging.getLogger(__name__)  # The logger of the GUI module
 
 cwd = os.getcwd()  # Getting the current directory
 cwd = cwd + "/.."  # Going up one directory to the main folder
@@ -16,6 +22,10 @@ stockfish_path = (
     cwd + "/stockfish/stockfish-windows-2022-x86-64-avx2.exe"
 )  # Setting the path to the stockfish engine
 
+stockfish_pool_size = 1  # Setting the number of stockfish engines started in the background
+
+arm_backend = "sim"  # Setting the arm backend, "dll" for the Dobot arm or "sim" to simulate it
+
 cell_coordinates_path = (
     cwd + "/Calibration Files/Calibration.xml"
 )  # Setting the path to the cell coordinates file
@@ -48,19 +58,125 @@ link_txt_color = "#159acd"  # Setting the text color of the link
 entry_bg_color = "#c3c2c2"  # Setting the background color of the entry
 
 
+class chess_clock:
+    """
+    A chess clock for the player and the engine.
+    The time left is computed from a monotonic clock instead of counting ticks,
+    so it stays accurate however often (or rarely) it is read.
+    """
+
+    def __init__(self, time_ms: int, increment_ms: int = 0, delay_ms: int = 0):
+        """
+        Args:
+        -   time_ms (int): The starting time of each side in milliseconds.
+        -   increment_ms (int): The time added to a side's clock after every move it makes in milliseconds.
+        -   delay_ms (int): The time at the start of every turn before the clock starts running in milliseconds.
+        """
+        self.time_left = {
+            "player": time_ms,
+            "engine": time_ms,
+        }  # The time left of each side at the start of the running turn
+
+        self.increment_ms = increment_ms  # Setting the increment
+
+        self.delay_ms = delay_ms  # Setting the delay
+
+        self.running = None  # The side whose clock is running, None if the clock is stopped
+
+        self.turn_start = 0.0  # The monotonic time the running turn started at
+
+    def start(self, side: str):
+        """
+        Starts the clock of the given side.
+
+        Args:
+        -   side (str): "player" or "engine".
+        """
+        self.stop()  # Stop the other side's clock first
+
+        self.running = side
+        self.turn_start = time.monotonic()
+
+    def stop(self):
+        """
+        Stops the running clock.
+        """
+        if self.running is None:
+            return
+
+        self.time_left[self.running] = self.get_time_left(self.running)
+        self.running = None
+
+    def switch(self):
+        """
+        Stops the running clock, adds the increment to it and starts the other side's clock.
+        """
+        side = self.running
+
+        if side is None:
+            return
+
+        self.stop()
+
+        self.time_left[side] += self.increment_ms  # Add the increment for the move made
+
+        self.start("engine" if side == "player" else "player")
+
+    def get_time_left(self, side: str):
+        """
+        Returns the time left of the given side.
+
+        Args:
+        -   side (str): "player" or "engine".
+
+        Returns:
+        -   int: The time left in milliseconds.
+        """
+        if side != self.running:
+            return self.time_left[side]
+
+        elapsed_ms = (time.monotonic() - self.turn_start) * 1000 - self.delay_ms
+
+        return self.time_left[side] - max(0, int(elapsed_ms))
+
+
+def format_time(time_ms: int):
+    """
+    Formats the time left to be displayed on the clock.
+
+    Args:
+    -   time_ms (int): The time left in milliseconds.
+
+    Returns:
+    -   str: The time left as minutes:seconds:centiseconds.
+    """
+    time_ms = max(0, time_ms)  # Don't display negative time
+
+    time_sec = time_ms // 1000  # Getting the time left in seconds as an integer
+    time_min = time_sec // 60  # Getting the time left in minutes as an integer
+
+    return f"{time_min:02d}:{time_sec % 60:02d}:{time_ms // 10 % 100:02d}"
+
+
 class chess_game:
     def __init__(self, master: tk.Tk):
         self.player_turn = (
             True  # Creating a boolean variable to keep track of whose turn it is
         )
-        self.time_left_engine = (
-            10 * 60000  # Creating a variable to keep track of the engine's time left
+        self.time_control_ms = (
+            10 * 60000  # Creating a variable to keep track of each side's starting time
+        )
+        self.increment_ms = (
+            0  # Creating a variable to keep track of the time added after every move
         )
-        self.time_left_player = (
-            10 * 60000  # Creating a variable to keep track of the player's time left
+        self.delay_ms = (
+            0  # Creating a variable to keep track of the delay before the clock runs every turn
         )
+        self.clock = chess_clock(
+            self.time_control_ms, self.increment_ms, self.delay_ms
+        )  # Creating the clock to keep track of the player's and the engine's time left
         self.update_every_ms = (
-            1  # Creating a variable to keep track of how often to update the clock
+            50  # Creating a variable to keep track of how often to update the clock
         )
 
         self.cam_id = 0  # Setting the camera id
@@ -83,19 +199,77 @@ class chess_game:
 
         self.dobot_cam = c2m.init_cam(self.cam_id)  # Initializing the camera
 
-        # self.arm = dr.init_arm(cell_coordinates_path)  # Initializing the arm # Test
+        self.arm = dr.init_arm(cell_coordinates_path, arm_backend)  # Initializing the arm
 
         self.homography_matrix = (
             []
         )  # Creating a variable to keep track of the homography matrix
 
+        self.homography_tracker = (
+            None  # Creating a variable to keep track of the board's pose during the game
+        )
+
+        self.auto_detect_moves = (
+            True  # Creating a boolean variable to switch turns automatically when a move is seen
+        )
+
+        self.move_detector = (
+            c2m.move_detector()
+        )  # Creating a move detector to watch the camera stream during the player's turn
+
+        self.frame_queue = (
+            queue.Queue()
+        )  # Creating a queue to receive the detected moves and drift events from the frame thread
+
+        self.frame_thread = None  # Creating a variable to keep track of the frame thread
+
+        self.frame_stop = (
+            threading.Event()
+        )  # Creating an event to stop the frame thread
+
+        self.watch_moves = (
+            threading.Event()
+        )  # Creating an event that is set while the frame thread should look for the player's move
+
+        self.frame_poll_ms = (
+            50  # Creating a variable to keep track of how often to check for the frame thread's results
+        )
+
         self.player_move = ""  # Creating a variable to keep track of the player's move
 
         self.engine_move = ""  # Creating a variable to keep track of the engine's move
 
+        self.engine_queue = (
+            queue.Queue()
+        )  # Creating a queue to receive the engine's move from the engine thread
+
+        self.engine_thread = None  # Creating a variable to keep track of the engine thread
+
+        self.engine_cancel = (
+            threading.Event()
+        )  # Creating an event to cancel the engine's search
+
+        self.engine_poll_ms = (
+            50  # Creating a variable to keep track of how often to check for the engine's move
+        )
+
+        self.arm_queue = (
+            queue.Queue()
+        )  # Creating a queue to know when the arm thread has finished the engine's move
+
+        self.arm_thread = None  # Creating a variable to keep track of the arm thread
+
+        self.arm_poll_ms = (
+            50  # Creating a variable to keep track of how often to check if the arm has finished
+        )
+
         self.difficulty = 0  # Creating a variable to keep track of the difficulty level
 
-        self.engine = ce.init_stockfish(stockfish_path)  # Initializing the engine
+        self.stockfish_pool = ce.stockfish_pool(
+            stockfish_path, stockfish_pool_size
+        )  # Starting the engines in the background, so the GUI doesn't wait for them
+
+        self.engine = None  # The engine is taken from the pool once the difficulty is set
 
         self.board = (
             ce.init_board()
@@ -274,6 +448,22 @@ class chess_game:
             fg=main_txt_color,
         )  # Creating a label to display the text "Current Board Image"
 
+        self.thinking_label = tk.Label(
+            self.master,
+            text="The Engine is Thinking...",
+            font=("Courier", 20, "bold"),
+            bg=bg_color,
+            fg=engine_txt_color,
+        )  # Creating a label to show that the engine is searching for its move
+
+        self.retry_label = tk.Label(
+            self.master,
+            text="Move Not Recognized, Try Again",
+            font=("Courier", 20, "bold"),
+            bg=bg_color,
+            fg=player_txt_color,
+        )  # Creating a label to ask the player to make their move again when it isn't recognized
+
         self.virtual_img_label = tk.Label(
             self.master,
             text="Virtual Board Image",
@@ -786,6 +976,8 @@ class chess_game:
         if self.cam_id < 0:  # If the camera id is negative, set it to 0
             self.cam_id = 0
 
+        c2m.release_cam(self.dobot_cam)  # Releasing the old camera
+
         self.dobot_cam = c2m.init_cam(self.cam_id)  # Initializing the camera
 
         if (
@@ -855,9 +1047,19 @@ class chess_game:
         # Remove the visible widgets
         self.remove_visible_widgets()
 
+        # Taking an engine from the pool, waiting if it is still starting
+        if self.engine is None:
+            self.engine = self.stockfish_pool.acquire()
+
         # Setting the difficulty of the engine
         self.engine = ce.set_engine_difficulty(self.engine, self.difficulty)
 
+        # Loading the DRLCE engine before the game starts so its moves only run the search
+        if self.difficulty == 5:
+            self.DRLCE_model = ce.init_DRLCE(DRLCE_weights_path)
+
+            logger.info("DRLCE metrics: %s", self.DRLCE_model.get_metrics())
+
         # Calling the start_game method to start the game
         self.init_game()
 
@@ -888,16 +1090,9 @@ class chess_game:
             relx=0.93, rely=0.95, anchor=tk.CENTER
         )  # Placing the exit button in the GUI window
 
-        # dr.go_to_calibration(
-        #     self.arm
-        # )  # Move the arm to the calibration position # Test
+        dr.go_to_calibration(self.arm)  # Move the arm to the calibration position
 
-        # dr.go_to_home(self.arm)  # Move the arm to the home position # Test
-        # dr.go_to_home(self.arm)  # Move the arm to the home position again # Test
-
-        self.filler_img = c2m.grab_img(
-            self.dobot_cam  # type: ignore
-        )  # Take a filler picture to make sure the camera is focused
+        dr.go_to_home(self.arm)  # Move the arm to the home position
 
         self.empty_img = c2m.grab_img(
             self.dobot_cam  # type: ignore
@@ -910,11 +1105,13 @@ class chess_game:
             self.game_state = 2  # Set the game state to 2 (Player wins)
             self.check_result()  # Check the game state to display the result of the game
 
-        self.homography_matrix = c2m.get_homography_matrix(
+        self.homography_tracker = c2m.homography_tracker(
             self.empty_img, motherboard_path  # type: ignore
-        )  # Find the homography matrix between the empty board image and the reference board image
+        )  # Find the homography matrix between the empty board image and the reference board image, and keep tracking the board
+
+        self.homography_matrix = self.homography_tracker.homography_matrix
 
-        if self.homography_matrix.any() == None:  # type: ignore
+        if self.homography_matrix is None:
             self.game_state = 2  # Set the game state to 2 (Player wins)
             self.check_result()  # Check the game state to display the result of the game
 
@@ -981,10 +1178,6 @@ class chess_game:
             relx=0.8, rely=0.91, anchor=tk.CENTER
         )  # Placing Raheem's label in the GUI window
 
-        self.filler_img = c2m.grab_img(
-            self.dobot_cam  # type: ignore
-        )  # Take a filler picture to make sure the camera is focused
-
         self.prev_img = c2m.grab_img(
             self.dobot_cam  # type: ignore
         )  # Take a picture of the board with the pieces on it befor the move is made
@@ -996,6 +1189,8 @@ class chess_game:
             self.game_state = 2  # Set the game state to 2 (Player wins)
             self.check_result()  # Check the game state to display the result of the game
 
+        self.update_homography(self.prev_img)  # Check if the board moved since the last image
+
         self.prev_img, flip = c2m.warp_img(
             self.prev_img, self.homography_matrix  # type: ignore
         )  # Warp the image to a top-down view
@@ -1032,70 +1227,148 @@ class chess_game:
             image=self.prev_img_tk,
         )
 
+        self.clock.start("player")  # Start the player's clock
+
+        self.watch_moves.set()  # Start watching the board for the player's move
+
+        self.start_frame_thread()  # Start tracking the board and detecting moves on every camera frame
+
         # Calling the game_loop method to start the game loop
         self.game_loop()
 
     def game_loop(self):
         # Check if the game is over
         if self.check_result() == 1:
-            # give the player 5 seconds to see the result
-            # dr.go_to_home(self.arm)  # Move the arm to the home position # Test
-            # dr.disconnect(self.arm)  # Disconnect the arm # Test
-            self.master.after(5000, self.master.destroy)
+            self.clock.stop()  # Stop the clock
+            self.cancel_engine_move()  # Stop the engine if it is still thinking
+            self.stop_frame_thread()  # Stop watching the camera
+
+            # give the player 5 seconds to see the result, exit moves the arm home and disconnects it
+            self.master.after(5000, self.exit)
             return
 
-        # Update the clock every ms based on whose turn it is
-        if self.player_turn:
-            self.time_left_player -= 1
-        else:
-            self.time_left_engine -= 1
-
-        time_ms_player = (
-            self.time_left_player
-        )  # Getting the player time left in milliseconds as an integer
-        time_sec_player = (
-            time_ms_player // 1000
-        )  # Getting the player time left in seconds as an integer
-        time_min_player = (
-            time_sec_player // 60
-        )  # Getting the player time left in minutes as an integer
-
-        # Formatting the player time string to display in the GUI window
-        time_str_player = f"{time_min_player:02d}:{time_sec_player % 60:02d}:{time_ms_player % 100:02d}"
-
-        self.label_time_player.config(
-            text=time_str_player
-        )  # Displaying the player time left in the GUI window
-
-        time_ms_engine = (
-            self.time_left_engine
-        )  # Getting the engine time left in milliseconds as an integer
-        time_sec_engine = (
-            time_ms_engine // 1000
-        )  # Getting the engine time left in seconds as an integer
-        time_min_engine = (
-            time_sec_engine // 60
-        )  # Getting the engine time left in minutes as an integer
-
-        # Formatting the engine time string to display in the GUI window
-        time_str_engine = f"{time_min_engine:02d}:{time_sec_engine % 60:02d}:{time_ms_engine % 100:02d}"
-
-        self.label_time_engine.config(
-            text=time_str_engine
-        )  # Displaying the engine time left in the GUI window
+        # Only redraw the labels when the displayed time changes
+        time_str_player = format_time(self.clock.get_time_left("player"))
+
+        if self.label_time_player["text"] != time_str_player:
+            self.label_time_player.config(
+                text=time_str_player
+            )  # Displaying the player time left in the GUI window
+
+        time_str_engine = format_time(self.clock.get_time_left("engine"))
+
+        if self.label_time_engine["text"] != time_str_engine:
+            self.label_time_engine.config(
+                text=time_str_engine
+            )  # Displaying the engine time left in the GUI window
 
         # Calling the update_clock method again after the specified time
         self.master.after(self.update_every_ms, self.game_loop)
 
+    def start_frame_thread(self):
+        """
+        Starts the frame thread, which runs at the camera's frame rate, and checks for its results.
+        Only a camera stream has frames to watch, still images are tracked when they are taken.
+        """
+        if not isinstance(self.dobot_cam, c2m.camera_stream):
+            return
+
+        self.frame_stop = (
+            threading.Event()
+        )  # A new event for every thread, so a stopped thread can't stop the next one
+
+        self.frame_thread = threading.Thread(
+            target=self.watch_frames,
+            args=(self.frame_stop,),
+            daemon=True,
+        )  # Creating the frame thread
+
+        self.frame_thread.start()  # Start watching the camera
+
+        self.master.after(
+            self.frame_poll_ms, self.poll_frame_thread
+        )  # Check for the frame thread's results after the specified time
+
+    def watch_frames(self, stop_event):
+        """
+        Runs in the frame thread, waits for every new camera frame, tracks the board in it,
+        and gives it to the move detector during the player's turn.
+        The results are put in the frame queue, it must not touch any tkinter widget.
+
+        Args:
+        -   stop_event (threading.Event): The event that stops the thread.
+        """
+        last_frame_time = 0.0  # The time of the last frame that was processed
+
+        watching = False  # Whether the move detector is watching the current turn
+
+        while not stop_event.is_set():
+            # Wait for the next frame, the timeout only lets the thread notice it was stopped
+            frame_time, frame = self.dobot_cam.read(  # type: ignore
+                newer_than=last_frame_time, timeout=0.5
+            )
+
+            if frame is None:
+                continue
+
+            last_frame_time = frame_time
+
+            drift_events = len(self.homography_tracker.drift_events)  # type: ignore
+
+            self.homography_matrix = self.homography_tracker.update(frame)  # type: ignore
+
+            for event in self.homography_tracker.drift_events[drift_events:]:  # type: ignore
+                self.frame_queue.put(("drift", event))
+
+            # Reset the move detector at the start of every turn it watches
+            if not self.watch_moves.is_set() or not self.auto_detect_moves:
+                watching = False
+                continue
+
+            if not watching:
+                self.move_detector.reset()
+                watching = True
+
+            if self.homography_matrix is None:
+                continue
+
+            if self.move_detector.update(frame, self.homography_matrix, frame_time):
+                self.watch_moves.clear()  # Report the move once, the GUI sets it again on the next turn
+                self.frame_queue.put(("move", self.move_detector.change_grid))
+
+    def poll_frame_thread(self):
+        """
+        Handles the results of the frame thread, and switches the turn when the player made a move
+        and took their hand off the board.
+        """
+        while True:
+            try:
+                kind, result = self.frame_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if kind == "drift":
+                logger.warning("Board drift: %s", result)
+
+            elif kind == "move" and self.player_turn and self.game_state == 0:
+                logger.info("Move detected: %s", result)
+                self.switch_turn()  # Switch the turn as if the button was pressed
+
+        # Check again after the specified time while the thread is running
+        if not self.frame_stop.is_set():
+            self.master.after(self.frame_poll_ms, self.poll_frame_thread)
+
+    def stop_frame_thread(self):
+        """
+        Stops the frame thread if it is running, it finishes the frame it is on.
+        """
+        self.frame_stop.set()
+
     def switch_turn(self):
         # Check the game state to display the result of the game
         if self.check_result() == 1:
             return
 
-        self.filler_img = c2m.grab_img(
-            self.dobot_cam  # type: ignore
-        )  # Take a filler picture to make sure the camera is focused
-
         self.cur_img = c2m.grab_img(
             self.dobot_cam  # type: ignore
         )  # Take a picture of the board with the pieces on it after the move is made
@@ -1107,6 +1380,8 @@ class chess_game:
             self.game_state = 2  # Set the game state to 2 (Player wins)
             self.check_result()  # Check the game state to display the result of the game
 
+        self.update_homography(self.cur_img)  # Check if the board moved since the last image
+
         self.cur_img, flip = c2m.warp_img(
             self.cur_img, self.homography_matrix  # type: ignore
         )  # Warp the image to a top-down view
@@ -1119,16 +1394,27 @@ class chess_game:
             self.cur_img
         )  # Convert the numpy array to a tkinter image
 
-        self.player_moves_list, _ = c2m.find_moves(
-            self.prev_img, self.cur_img  # type: ignore
-        )  # Get the player's moves from the images
+        self.player_moves_list, _, heatmap = c2m.find_moves(
+            self.prev_img, self.cur_img, return_heatmap=True  # type: ignore
+        )  # Get the changed squares and the change of every square from the images
 
         if self.player_moves_list == None:
             self.game_state = 2  # Set the game state to 2 (Player wins)
             self.check_result()  # Check the game state to display the result of the game
 
-        self.player_move = ce.moves_to_ACN(
-            self.board, self.player_moves_list  # type: ignore
+        ranked_moves = ce.recognize_move(
+            self.board, heatmap
+        )  # Rank the legal moves by how well they match the changed squares
+
+        logger.debug("Ranked moves: %s", ranked_moves[:3])
+
+        # Only play the most likely move if it clearly stands out (nothing changed, or a bumped board, a change in the lighting or a half made move)
+        if not ce.is_move_recognized(ranked_moves, self.board, heatmap):
+            self.retry_move()  # Ask the player to make their move again
+            return
+
+        self.player_move = (
+            ranked_moves[0][0] if ranked_moves else ""
         )  # Get the player's move
 
         print("Player Moves List:", self.player_moves_list)  # Test
@@ -1148,6 +1434,8 @@ class chess_game:
             self.check_result()  # Check the game state to display the result of the game
             return  # Return if the move is invalid
 
+        self.retry_label.place_forget()  # Hide the retry label
+
         # Make the move on the board
         self.board.push_san(self.player_move)
 
@@ -1163,15 +1451,114 @@ class chess_game:
 
         self.player_turn = not self.player_turn  # Toggling the value of player_turn
 
+        self.watch_moves.clear()  # Stop watching the board while the engine plays
+
+        self.clock.switch()  # Switch the clock to the other side
+
         self.get_engine_move()  # Calling the get_engine_move method to get the engine's move
 
+    def retry_move(self):
+        """
+        Asks the player to make their move again when it wasn't recognized, without ending their turn.
+        The previous image is kept, so the move is compared to the board before it was made.
+        """
+        self.retry_label.place(
+            relx=0.5, rely=0.65, anchor=tk.CENTER
+        )  # Placing the retry label in the GUI window
+
+        self.curr_board_img_canvas.create_image(
+            0, 0, anchor=tk.NW, image=self.cur_img_tk
+        )  # Display the current board image in the GUI window
+
+        self.watch_moves.set()  # Keep watching the board for the player's move
+
     def get_engine_move(self):
-        # Get the best move from the engine based on the difficulty level
-        if self.difficulty == 5:
-            self.engine_move = ce.get_DRLCE_move(DRLCE_weights_path, self.board)
-        else:
-            self.engine_move = ce.get_stockfish_move(self.engine, self.board)
+        """
+        Starts searching for the engine's move in a background thread so the GUI and the clock keep running.
+        The move is picked up by poll_engine_move once the search is done.
+        """
+        self.engine_cancel = (
+            threading.Event()
+        )  # A new event for every search, so a cancelled search can't cancel the next one
+
+        self.engine_thread = threading.Thread(
+            target=self.search_engine_move,
+            args=(
+                self.board.copy(),  # The thread gets its own copy of the board
+                self.clock.get_time_left("engine"),
+                self.engine_cancel,
+            ),
+            daemon=True,
+        )  # Creating the engine thread
+
+        self.thinking_label.place(
+            relx=0.5, rely=0.65, anchor=tk.CENTER
+        )  # Placing the thinking label in the GUI window
+
+        self.engine_thread.start()  # Start the search
+
+        self.master.after(
+            self.engine_poll_ms, self.poll_engine_move
+        )  # Check for the engine's move after the specified time
+
+    def search_engine_move(self, board, time_left_engine, cancel_event):
+        """
+        Runs in the engine thread, searches for the best move and puts it in the engine queue.
+        It must not touch any tkinter widget.
+
+        Args:
+        -   board (chess.Board): A copy of the current board.
+        -   time_left_engine (int): The time left on the engine's clock in milliseconds.
+        -   cancel_event (threading.Event): The event that cancels the search.
+        """
+        try:
+            # Get the best move from the engine based on the difficulty level
+            if self.difficulty == 5:
+                engine_move = ce.get_DRLCE_move(
+                    DRLCE_weights_path,
+                    board,
+                    time_left_engine,
+                    self.increment_ms,
+                    stop_event=cancel_event,
+                )
+            else:
+                engine_move = ce.get_stockfish_move(self.engine, board)
+        except Exception:
+            logger.exception("Engine error")
+            engine_move = ""  # An empty move is treated as an invalid move
+
+        self.engine_queue.put(
+            (cancel_event, engine_move)
+        )  # Hand the move back to the GUI thread
+
+    def poll_engine_move(self):
+        """
+        Checks if the engine thread has found its move, and applies it if the search wasn't cancelled.
+        """
+        try:
+            cancel_event, engine_move = self.engine_queue.get_nowait()
+        except queue.Empty:
+            # The engine is still thinking, check again after the specified time
+            self.master.after(self.engine_poll_ms, self.poll_engine_move)
+            return
+
+        self.thinking_label.place_forget()  # Hide the thinking label
+
+        # Discard the move if the search was cancelled (resign, exit or game over)
+        if cancel_event.is_set():
+            return
+
+        self.engine_move = engine_move
+
+        self.apply_engine_move()  # Calling the apply_engine_move method to make the engine's move
 
+    def cancel_engine_move(self):
+        """
+        Cancels the engine's search if it is running, its move will be discarded.
+        """
+        self.engine_cancel.set()
+
+    def apply_engine_move(self):
         # Check the move and return if it is invalid
         if not ce.check_move(self.board, self.engine_move):  # type: ignore
             self.game_state = 2  # Set the game state to 2 (Player wins)
@@ -1183,14 +1570,68 @@ class chess_game:
 
         print("Engine Move:", self.engine_move)  # Test
 
-        # dr.apply_move(
-        #     self.arm,
-        #     self.engine_move,  # type: ignore
-        #     self.chess_move_indicators,
-        # )  # Apply the move to the arm # Test
+        self.arm_thread = threading.Thread(
+            target=self.move_arm,
+            args=(
+                self.engine_move,
+                self.chess_move_indicators,
+                self.board.copy(),  # The thread gets its own copy of the board
+            ),
+            daemon=True,
+        )  # Creating the arm thread
+
+        self.arm_thread.start()  # Start moving the arm
 
-        # dr.go_to_home(self.arm)  # Move the arm to the home position # Test
+        self.master.after(
+            self.arm_poll_ms, self.poll_arm_move
+        )  # Check if the arm has finished after the specified time
 
+    def move_arm(self, engine_move, chess_move_indicators, board):
+        """
+        Runs in the arm thread, applies the engine's move with the arm and puts the result in the arm queue.
+        It must not touch any tkinter widget.
+
+        Args:
+        -   engine_move (str): The engine's move in UCI format.
+        -   chess_move_indicators (tuple): The kill, enpassant and castling indicators of the move.
+        -   board (chess.Board): A copy of the board before the move.
+        """
+        try:
+            dr.apply_move(
+                self.arm, engine_move, chess_move_indicators, board
+            )  # Apply the move to the arm, it ends at the home position
+            arm_error = None
+        except Exception as e:
+            arm_error = e
+
+        self.arm_queue.put(arm_error)  # Tell the GUI thread the arm has finished
+
+    def poll_arm_move(self):
+        """
+        Checks if the arm thread has finished the engine's move, and finishes the engine's turn if the game isn't over.
+        """
+        try:
+            arm_error = self.arm_queue.get_nowait()
+        except queue.Empty:
+            # The arm is still moving, check again after the specified time
+            self.master.after(self.arm_poll_ms, self.poll_arm_move)
+            return
+
+        if arm_error is not None:
+            logger.error("Arm error: %s", arm_error, exc_info=arm_error)
+
+        logger.info("Arm path: %s", dr.last_move_report)
+
+        # The game ended while the arm was moving (resign or time out)
+        if self.game_state != 0:
+            return
+
+        self.finish_engine_move()  # Calling the finish_engine_move method to make the move on the board
+
+    def finish_engine_move(self):
+        """
+        Makes the engine's move on the board once the arm has made it, and gives the turn back to the player.
+        """
         # Make the move on the board
         self.board.push_san(self.engine_move)  # type: ignore
 
@@ -1202,14 +1643,12 @@ class chess_game:
             0, 0, anchor=tk.NW, image=self.board_img
         )
 
-        self.filler_img = c2m.grab_img(
-            self.dobot_cam  # type: ignore
-        )  # Take a filler picture to make sure the camera is focused
-
         self.prev_img = c2m.grab_img(
             self.dobot_cam  # type: ignore
         )  # Take a picture of the board with the pieces on it befor the move is made
 
+        self.update_homography(self.prev_img)  # Check if the board moved since the last image
+
         self.prev_img, flip = c2m.warp_img(
             self.prev_img, self.homography_matrix  # type: ignore
         )  # Warp the image to a top-down view
@@ -1235,6 +1674,32 @@ class chess_game:
 
         self.player_turn = not self.player_turn  # Toggling the value of player_turn
 
+        self.clock.switch()  # Switch the clock to the other side
+
+        self.watch_moves.set()  # Start watching the board for the player's move
+
+    def update_homography(self, img):
+        """
+        Tracks the board in a still image, re-estimating the homography matrix if the camera or the board was bumped.
+        A camera stream is tracked on every frame by the frame thread instead, so its stills are skipped.
+
+        Args:
+        -   img (np.ndarray): The new image of the board.
+        """
+        if (
+            isinstance(self.dobot_cam, c2m.camera_stream)
+            or self.homography_tracker is None
+            or img is None
+        ):
+            return
+
+        drift_events = len(self.homography_tracker.drift_events)
+
+        self.homography_matrix = self.homography_tracker.update(img)
+
+        for event in self.homography_tracker.drift_events[drift_events:]:
+            logger.warning("Board drift: %s", event)
+
     def resign(self):
         """
         Resigns the game, sets the game state to 1 (Engine wins) and displays the result of the game.
@@ -1242,6 +1707,8 @@ class chess_game:
         if self.game_state != 0:
             return
 
+        self.cancel_engine_move()  # Stop the engine if it is still thinking
+
         self.game_state = 1
         self.check_result()
 
@@ -1258,10 +1725,10 @@ class chess_game:
         Returns:
         -   The result of the game as displayed on the board.
         """
-        if self.time_left_player <= 0:
+        if self.clock.get_time_left("player") <= 0:
             self.game_state = 1  # Set the game state to 1 (Engine wins)
 
-        elif self.time_left_engine <= 0:
+        elif self.clock.get_time_left("engine") <= 0:
             self.game_state = 2  # Set the game state to 2 (Player wins)
 
         if ce.check_game_state(self.board) == 1:
@@ -1339,6 +1806,16 @@ class chess_game:
         """
         Exits the game.
         """
-        # dr.go_to_home(self.arm)  # Move the arm to the home position # Test
-        # dr.disconnect(self.arm)  # Disconnect the arm # Test
+        if self.arm_thread is not None:
+            self.arm_thread.join()  # Let the arm finish its move before sending it home
+
+        dr.go_to_home(self.arm)  # Move the arm to the home position
+        dr.disconnect(self.arm)  # Disconnect the arm
+        self.cancel_engine_move()  # Stop the engine if it is still thinking
+        self.stop_frame_thread()  # Stop watching the camera
+        self.stockfish_pool.close()  # Stop the Stockfish engines
+        if isinstance(self.dobot_cam, c2m.camera_stream):
+            logger.info("Camera stats: %s", self.dobot_cam.get_stats())
+
+        c2m.release_cam(self.dobot_cam)  # Release the camera
         self.master.destroy()  # Destroy the master window
@@ -4,8 +4,14 @@ This is the main file of the chess game. It creates a root window object and a c
 
 from GUI import chess_game  # Importing the chess game class from the GUI module
 import tkinter as tk  # Importing tkinter for the GUI window
+import logging  # Importing logging to show the GUI's reports in the console
+
 
 if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )  # Showing the info reports (moves, arm paths, drift) and above
+
     root = tk.Tk()  # Creating a root window object
     game = chess_game(root)  # Creating a chess game object with the root window object
     root.mainloop()  # Running the mainloop of the root window object
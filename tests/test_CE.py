@@ -0,0 +1,106 @@
+"""
+Tests of the chess engine module, the Stockfish tests need a Stockfish binary in STOCKFISH_PATH, on the PATH, or at the GUI's path.
+"""
+
+import os
+import shutil
+
+import chess
+import numpy as np
+import pytest
+
+import CE as ce
+
+
+def find_stockfish():
+    candidates = [
+        os.environ.get("STOCKFISH_PATH"),
+        shutil.which("stockfish"),
+        os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            "stockfish",
+            "stockfish-windows-2022-x86-64-avx2.exe",
+        ),
+    ]
+    for path in candidates:
+        if path and os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+@pytest.fixture
+def stockfish():
+    stockfish_path = find_stockfish()
+    if stockfish_path is None:
+        pytest.skip("Stockfish is not installed")
+
+    engine = ce.stockfish_engine(stockfish_path, ponder=False)
+    yield engine
+    engine.engine.quit()
+
+
+@pytest.mark.parametrize("difficulty", sorted(ce.difficulty_settings))
+def test_set_engine_difficulty_applies_multipv(stockfish, difficulty):
+    ce.set_engine_difficulty(stockfish, difficulty)
+
+    assert stockfish.multipv == ce.difficulty_settings[difficulty]["MultiPV"]
+
+
+def test_get_stockfish_analysis_returns_multipv_lines(stockfish):
+    board = chess.Board()
+    ce.set_engine_difficulty(stockfish, 1)
+    stockfish.multipv = 3
+
+    lines = ce.get_stockfish_analysis(stockfish, board)
+
+    assert len(lines) == 3
+    assert len({move for move, _ in lines}) == 3
+    for move, score in lines:
+        assert chess.Move.from_uci(move) in board.legal_moves
+        assert isinstance(score, int)
+    scores = [score for _, score in lines]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_get_stockfish_analysis_finds_mate(stockfish):
+    board = chess.Board("6k1/5ppp/8/8/8/8/8/R5K1 w - - 0 1")
+    ce.set_engine_difficulty(stockfish, 4)
+
+    lines = ce.get_stockfish_analysis(stockfish, board)
+
+    assert lines[0][0] == "a1a8"
+    assert lines[0][1] > 10000
+
+
+def test_recognize_move_finds_a_clean_move():
+    board = chess.Board()
+    heatmap = np.zeros((8, 8))
+    heatmap[1, 4] = heatmap[3, 4] = 1.0  # e2 and e4 changed
+
+    ranked_moves = ce.recognize_move(board, heatmap)
+
+    assert ranked_moves[0][0] == "e2e4"
+    assert ce.is_move_recognized(ranked_moves, board, heatmap)
+
+
+def test_recognize_move_rejects_a_half_made_move():
+    board = chess.Board()
+    heatmap = np.zeros((8, 8))
+    heatmap[1, 4] = 1.0  # Only the pawn on e2 was lifted
+
+    assert not ce.is_move_recognized(ce.recognize_move(board, heatmap), board, heatmap)
+
+
+def test_recognize_move_rejects_a_lighting_change():
+    board = chess.Board()
+    heatmap = np.random.default_rng(0).uniform(0.5, 1.0, size=(8, 8))  # Every square changed a little
+
+    ranked_moves = ce.recognize_move(board, heatmap)
+
+    assert ce.is_move_recognized(ranked_moves)  # The move stands out from the other moves
+    assert not ce.is_move_recognized(ranked_moves, board, heatmap)  # But not from the rest of the board
+
+
+def test_is_move_recognized_rejects_no_change():
+    assert not ce.is_move_recognized(ce.recognize_move(chess.Board(), np.zeros((8, 8))))
+    assert not ce.is_move_recognized([])
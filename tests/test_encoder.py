@@ -0,0 +1,58 @@
+"""
+Tests of the policy encoding of the DRLCE engine.
+"""
+
+import chess
+import numpy as np
+import pytest
+
+from DRLCE import encoder
+
+promotion_fen = "r1r1k3/1P6/8/8/8/8/8/4K3 w - - 0 1"  # A pawn that can promote straight and by capturing on both sides
+
+
+def promotion_boards():
+    board = chess.Board(promotion_fen)
+    return [board, board.mirror()]
+
+
+def random_policy(seed):
+    logits = np.random.default_rng(seed).normal(size=72 * 8 * 8) * 5
+    policy = np.exp(logits - logits.max())
+    return policy / policy.sum()  # A softmax output, as the network returns
+
+
+@pytest.mark.parametrize("board", promotion_boards(), ids=["white", "black"])
+def test_underpromotions_share_the_queen_promotion_index(board):
+    moves = list(board.legal_moves)
+
+    indices, scales = encoder.getMoveIndices(moves, not board.turn, priorScales=True)
+
+    assert np.array_equal(indices, encoder.getMoveIndices(moves, not board.turn))
+
+    by_move = {move: (index, scale) for move, index, scale in zip(moves, indices, scales)}
+    underpromotions = [move for move in moves if move.promotion not in (None, chess.QUEEN)]
+    assert len(underpromotions) == 9
+
+    for move in underpromotions:
+        queen_promotion = chess.Move(move.from_square, move.to_square, chess.QUEEN)
+        assert by_move[move][0] == by_move[queen_promotion][0]
+        assert by_move[move][1] == pytest.approx(encoder.underpromotionPriorScale)
+        assert by_move[queen_promotion][1] == 1
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("board", promotion_boards(), ids=["white", "black"])
+def test_underpromotions_never_outrank_the_queen_promotion(board, seed):
+    moves = list(board.legal_moves)
+
+    priors = dict(zip(moves, encoder.decodePolicyOutput(board, random_policy(seed))))
+
+    for move in moves:
+        if move.promotion in (None, chess.QUEEN):
+            continue
+        queen_promotion = chess.Move(move.from_square, move.to_square, chess.QUEEN)
+        assert priors[move] <= priors[queen_promotion]
+        assert priors[move] == pytest.approx(
+            priors[queen_promotion] * encoder.underpromotionPriorScale
+        )